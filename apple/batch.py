@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Batch processing of disk images
+
+The images are found from directories (walked recursively), globs or
+plain filenames, then they are spread over a pool of processes.
+The compressed images (.dsk.gz, .po.bz2, .dsk.xz) are found too, and
+each image of a zip file is a job of its own (collection.zip!game.dsk),
+decompressed in memory by its worker (see apple.source).
+Each worker opens its images with the mmap storage, so only the
+sectors really used are read from the files.
+
+The results are given back as soon as a chunk of images is finished,
+so we can stream them (newline-delimited JSON for scan.py) without
+keeping the whole batch in memory.
+
+A patch is a list of changes applied to each image (patch.py):
+    {"track": 17, "sector": 0, "offset": 6, "data": "FE", "expect": "01"}
+    {"block": 2, "offset": 4, "data": "F4"}
+"data" and "expect" are in hexa, "expect" (optional) are the bytes
+which must be there before the change. An image is changed only if
+all its changes can be done, and only the sectors changed are written.
+"""
+from functools import partial
+from multiprocessing import Pool
+import glob
+import os
+import time
+
+from apple import stats
+from apple.cache import default_cache
+from apple.disk import DiskfileError, STORAGE_MMAP
+from apple.dos import DiskDos33
+from apple.probe import open_disk
+from apple.prodos import DiskProdos
+from apple.source import image_extension, image_name, iter_archive, source_size, ARCHIVE_EXTENSIONS
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.9'
+
+# Extensions of the disk images we're looking for in the directories
+IMAGE_EXTENSIONS = ('.dsk', '.do', '.po', '.d13', '.nib', '.hdv', '.2mg', '.2img')
+
+# How many images are sent to a worker at once
+DEFAULT_CHUNKSIZE = 64
+
+
+def _is_archive(filename):
+    return os.path.splitext(filename)[1].lower() in ARCHIVE_EXTENSIONS
+
+
+def _expand(filename, extensions):
+    # The images of a zip file, or the file itself
+    if _is_archive(filename) and os.path.isfile(filename):
+        return list(iter_archive(filename, extensions))
+    return [filename]
+
+
+def find_images(sources, extensions=IMAGE_EXTENSIONS):
+    # Return the list of all the images from the sources:
+    # - a directory is walked recursively and we only keep the files
+    #   with one of the extensions (compressed or not) and the zip files
+    # - a glob pattern is expanded ('**' is allowed)
+    # - anything else is used as a filename
+    # Each zip file is replaced by the images it contains
+    images = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for filename in sorted(files):
+                    if image_extension(filename) in extensions or _is_archive(filename):
+                        images.extend(_expand(os.path.join(root, filename), extensions))
+        elif glob.has_magic(source):
+            for filename in sorted(glob.glob(source, recursive=True)):
+                images.extend(_expand(filename, extensions))
+        else:
+            images.extend(_expand(source, extensions))
+    return images
+
+
+def scan_image(diskname):
+    # Read the image as a DOS 3.3/3.2, ProDOS or Pascal disk (or get
+    # it from the cache if the image didn't change)
+    # Any error is kept in the result, so the batch never stops
+    result = {'path': diskname}
+    try:
+        result['size'] = source_size(diskname)
+        result.update(default_cache().load(diskname))
+    except DiskfileError as error:
+        result['error'] = str(error)
+    except Exception as error:
+        # A damaged image can fail anywhere in the parsing
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+def _safe_filename(name):
+    # DOS filenames can use any character, but not our filesystem
+    return ''.join('_' if char in '/\\:' or ord(char) < 32 else char for char in name) or '_'
+
+
+def extract_image(diskname, destination, raw=False):
+    # Extract all the files (not deleted) of a DOS 3.3 image (in any
+    # order) in destination/<image name>/<filename>.<type letter>
+    result = {'path': diskname, 'files': 0, 'bytes': 0}
+    try:
+        result['size'] = source_size(diskname)
+        directory = os.path.join(destination, os.path.splitext(image_name(diskname))[0])
+        with open_disk(diskname, STORAGE_MMAP) as dsk:
+            if not isinstance(dsk, DiskDos33):
+                raise DiskfileError(diskname, 'is not a DOS disk')
+            for entry in dsk.iter_catalog():
+                if entry.deleted:
+                    continue
+                os.makedirs(directory, exist_ok=True)
+                filename = '{}.{}'.format(_safe_filename(entry.name), entry.type_letter)
+                with open(os.path.join(directory, filename), 'wb') as fileobj:
+                    result['bytes'] += dsk.extract_file(entry, fileobj, raw)
+                result['files'] += 1
+    except DiskfileError as error:
+        result['error'] = str(error)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+def _patch_one(dsk, change):
+    # Apply one change to an opened disk, return False if the bytes
+    # are not the ones expected
+    data = bytes.fromhex(change['data'])
+    offset = change.get('offset', 0)
+    if 'block' in change:
+        if not isinstance(dsk, DiskProdos):
+            raise DiskfileError(dsk._diskname, 'is not a ProDOS disk')
+        current = bytearray(dsk.read_block(change['block']))
+    else:
+        current = bytearray(dsk.read_ts(change['track'], change['sector']) or b'')
+    if not current or offset + len(data) > len(current):
+        raise ValueError('the change {} is out of its sector/block'.format(change))
+
+    expect = change.get('expect')
+    if expect is not None and current[offset:offset + len(bytes.fromhex(expect))] != bytes.fromhex(expect):
+        return False
+
+    current[offset:offset + len(data)] = data
+    if 'block' in change:
+        dsk.write_block(change['block'], current)
+    else:
+        dsk.write_ts(change['track'], change['sector'], current)
+    return True
+
+
+def patch_image(diskname, changes, dry_run=False):
+    # Apply the changes of a patch to an image, all of them or none
+    # With dry_run, we only check that the image can be patched
+    result = {'path': diskname, 'sectors': 0}
+    try:
+        result['size'] = source_size(diskname)
+        with open_disk(diskname, STORAGE_MMAP) as dsk:
+            for index, change in enumerate(changes):
+                if not _patch_one(dsk, change):
+                    result['skipped'] = 'change {}: the bytes expected are not there'.format(index)
+                    dsk.discard()
+                    return result
+            if dry_run:
+                result['sectors'] = dsk.dirty_sectors
+                dsk.discard()
+            else:
+                result['sectors'] = dsk.flush()
+    except DiskfileError as error:
+        result['error'] = str(error)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+def run_batch(function, items, workers=None, chunksize=DEFAULT_CHUNKSIZE, initializer=None, initargs=()):
+    # Call function for each item with a pool of processes and
+    # yield the results as soon as they are ready (not in order)
+    # With only one worker, everything is done in this process
+    # initializer(*initargs) is called once by each process
+    # The counters of the workers are added to ours (see apple.stats)
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield function(item)
+        return
+
+    if stats.is_enabled():
+        # Each worker measures its own reads and sends them with its results
+        with Pool(workers, stats.init_worker, (initializer, initargs)) as pool:
+            for result, values in pool.imap_unordered(partial(stats.call_with_stats, function), items, chunksize):
+                stats.merge(values)
+                yield result
+        return
+
+    with Pool(workers, initializer, initargs) as pool:
+        for result in pool.imap_unordered(function, items, chunksize):
+            yield result
+
+
+def scan_images(images, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Scan all the images and yield one result (a dict) per image
+    return run_batch(scan_image, images, workers, chunksize)
+
+
+def extract_images(images, destination, raw=False, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Extract the files of all the images and yield one result per image
+    return run_batch(partial(extract_image, destination=destination, raw=raw), images, workers, chunksize)
+
+
+def patch_images(images, changes, dry_run=False, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Apply the same patch to all the images and yield one result per image
+    return run_batch(partial(patch_image, changes=changes, dry_run=dry_run), images, workers, chunksize)
+
+
+class Throughput:
+    # Count the images and bytes processed by a batch
+    # to display a summary at the end
+    def __init__(self):
+        self.images = 0
+        self.errors = 0
+        self.bytes = 0
+        self._start = time.perf_counter()
+
+    def add(self, result):
+        self.images += 1
+        self.bytes += result.get('size', 0)
+        if 'error' in result:
+            self.errors += 1
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self._start, 1e-9)
+        return '{} images ({} errors) in {:.2f}s: {:.1f} images/s, {:.2f} MB/s'.format(
+            self.images, self.errors, elapsed, self.images / elapsed, self.bytes / elapsed / 1000000)
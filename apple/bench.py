@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths
+
+The images are built by apple.synth in a directory (write_images),
+then each benchmark times one operation on them: open and probe, VTOC,
+catalog walks, sector and block reads, files, hexa dumps and batch
+scans. A benchmark is a context manager registered with @_benchmark:
+its setup (opening the disk...) is done once, and it yields the
+function to time.
+
+Each function is called in a loop long enough to be measured (see
+timeit.Timer.autorange), and the loop is repeated: the best time is
+the one to compare, the median shows the noise. The results of a run
+are a dictionnary saved in JSON, compare_results gives the ratio of 2
+runs for each benchmark.
+"""
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+import os
+import platform
+import statistics
+import time
+import timeit
+
+from apple.batch import run_batch
+from apple.cache import read_metadata
+from apple.disk import DiskfileError, STORAGE_MMAP
+from apple.forensics import check_image
+from apple.helpers import dump_dos, dump_tracks
+from apple.order import reorder_image, ORDER_DOS, ORDER_PRODOS
+from apple.probe import open_disk, probe
+from apple.synth import dos_image, prodos_image, corrupt_image, MAX_BLOCKS, VTOC_TRACK, DOS_SECTORS, SECTOR_SIZE
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+RESULTS_VERSION = 1
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.10
+
+# How many times the images are given to a batch scan
+BATCH_COPIES = 16
+
+
+def _large_file_size(index):
+    # A tree file (200 KB) every 8 files, the others are saplings
+    return 200 * 1024 if index % 8 == 0 else 5000
+
+
+# Name of each image and how to build it
+IMAGES = OrderedDict([
+    ('dos_full.dsk', lambda: dos_image(files=105)),
+    ('dos_long.dsk', lambda: dos_image(files=200, catalog_sectors=40, deleted=20)),
+    ('dos_corrupted.dsk', lambda: corrupt_image(dos_image(files=105, deleted=10), 64,
+                                                (VTOC_TRACK * DOS_SECTORS + 1) * SECTOR_SIZE,
+                                                (VTOC_TRACK + 1) * DOS_SECTORS * SECTOR_SIZE)),
+    ('prodos_floppy.dsk', lambda: reorder_image(prodos_image(files=12, file_size=1024, depth=1, subdirectories=2),
+                                                ORDER_PRODOS, ORDER_DOS)),
+    ('prodos_deep.po', lambda: prodos_image(1600, files=3, file_size=700, depth=20)),
+    ('prodos_large.hdv', lambda: prodos_image(MAX_BLOCKS, files=40, file_size=_large_file_size, depth=2,
+                                              subdirectories=3)),
+])
+
+BENCHMARKS = OrderedDict()
+
+
+def _benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = contextmanager(function)
+        return function
+    return register
+
+
+def write_images(directory):
+    # Build the images in directory, return {name: path}
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for name, build in IMAGES.items():
+        paths[name] = os.path.join(directory, name)
+        with open(paths[name], 'wb') as diskfile:
+            diskfile.write(build())
+    return paths
+
+
+def _null_writer():
+    # A writer for the dumps keeping nothing
+    return deque(maxlen=0).append
+
+
+def _scan(diskname):
+    # scan_image without the cache: the image is always parsed
+    try:
+        return read_metadata(diskname)
+    except DiskfileError as error:
+        return {'error': str(error)}
+    except Exception as error:
+        return {'error': '{}: {}'.format(type(error).__name__, error)}
+
+
+@_benchmark('open_dos')
+def _open_dos(paths):
+    def run():
+        with open_disk(paths['dos_full.dsk'], STORAGE_MMAP):
+            pass
+    yield run
+
+
+@_benchmark('open_prodos_large')
+def _open_prodos_large(paths):
+    def run():
+        with open_disk(paths['prodos_large.hdv'], STORAGE_MMAP):
+            pass
+    yield run
+
+
+@_benchmark('probe_prodos_floppy')
+def _probe_prodos(paths):
+    yield lambda: probe(paths['prodos_floppy.dsk'])
+
+
+@_benchmark('vtoc')
+def _vtoc(paths):
+    with open_disk(paths['dos_full.dsk'], STORAGE_MMAP) as dsk:
+        def run():
+            dsk._read_vtoc()
+            dsk._free_map = None
+            return dsk.free_sectors()
+        yield run
+
+
+@_benchmark('catalog_dos_full')
+def _catalog_dos_full(paths):
+    with open_disk(paths['dos_full.dsk'], STORAGE_MMAP) as dsk:
+        yield lambda: list(dsk.iter_catalog())
+
+
+@_benchmark('catalog_dos_long')
+def _catalog_dos_long(paths):
+    with open_disk(paths['dos_long.dsk'], STORAGE_MMAP) as dsk:
+        yield lambda: list(dsk.iter_catalog())
+
+
+@_benchmark('catalog_prodos_deep')
+def _catalog_prodos_deep(paths):
+    with open_disk(paths['prodos_deep.po'], STORAGE_MMAP) as dsk:
+        def run():
+            dsk._block_cache.clear()
+            return list(dsk.iter_files())
+        yield run
+
+
+@_benchmark('catalog_prodos_large')
+def _catalog_prodos_large(paths):
+    with open_disk(paths['prodos_large.hdv'], STORAGE_MMAP) as dsk:
+        def run():
+            dsk._block_cache.clear()
+            return list(dsk.iter_files())
+        yield run
+
+
+@_benchmark('read_ts_disk')
+def _read_ts_disk(paths):
+    with open_disk(paths['dos_full.dsk'], STORAGE_MMAP) as dsk:
+        def run():
+            for track in range(dsk._total_tracks):
+                for sector in range(dsk._sector_per_track):
+                    dsk.read_ts(track, sector)
+        yield run
+
+
+@_benchmark('read_block_floppy')
+def _read_block_floppy(paths):
+    # DOS order: each block is 2 sectors far from each other
+    with open_disk(paths['prodos_floppy.dsk'], STORAGE_MMAP) as dsk:
+        def run():
+            for block in range(dsk.total_blocks):
+                dsk.read_block(block)
+        yield run
+
+
+@_benchmark('read_blocks_large')
+def _read_blocks_large(paths):
+    with open_disk(paths['prodos_large.hdv'], STORAGE_MMAP) as dsk:
+        buffer = bytearray(dsk.total_blocks * 512)
+        yield lambda: dsk.read_blocks(0, dsk.total_blocks, buffer)
+
+
+@_benchmark('read_files_dos')
+def _read_files_dos(paths):
+    with open_disk(paths['dos_full.dsk'], STORAGE_MMAP) as dsk:
+        entries = list(dsk.iter_catalog())
+
+        def run():
+            for entry in entries:
+                dsk.read_file(entry)
+        yield run
+
+
+@_benchmark('read_files_prodos_large')
+def _read_files_prodos_large(paths):
+    with open_disk(paths['prodos_large.hdv'], STORAGE_MMAP) as dsk:
+        entries = [entry for entry in dsk.iter_files() if not entry.is_directory]
+
+        def run():
+            for entry in entries:
+                dsk.read_file(entry)
+        yield run
+
+
+@_benchmark('dump_sector')
+def _dump_sector(paths):
+    with open_disk(paths['dos_full.dsk'], STORAGE_MMAP) as dsk:
+        writer = _null_writer()
+        yield lambda: dump_dos(dsk.read_ts(VTOC_TRACK, 0), VTOC_TRACK, 0, writer)
+
+
+@_benchmark('dump_disk')
+def _dump_disk(paths):
+    with open_disk(paths['dos_full.dsk'], STORAGE_MMAP) as dsk:
+        writer = _null_writer()
+        yield lambda: dump_tracks(dsk, writer)
+
+
+@_benchmark('check_corrupted')
+def _check_corrupted(paths):
+    yield lambda: check_image(paths['dos_corrupted.dsk'])
+
+
+@_benchmark('scan_batch')
+def _scan_batch(paths):
+    # All the images parsed in this process, without the cache
+    images = list(paths.values()) * BATCH_COPIES
+    yield lambda: list(run_batch(_scan, images, workers=1))
+
+
+@_benchmark('scan_batch_pool')
+def _scan_batch_pool(paths):
+    # The same with a pool of processes (its start is measured too)
+    images = list(paths.values()) * BATCH_COPIES
+    yield lambda: list(run_batch(_scan, images))
+
+
+def measure(function, repeat=DEFAULT_REPEAT):
+    # Time of one call of function (in seconds): best and median
+    # of repeat loops
+    timer = timeit.Timer(function)
+    loops = timer.autorange()[0]
+    times = [value / loops for value in timer.repeat(repeat, loops)]
+    return {'best': min(times), 'median': statistics.median(times), 'loops': loops, 'repeat': repeat}
+
+
+def run_benchmarks(paths, names=None, repeat=DEFAULT_REPEAT):
+    # Run the benchmarks (all of them, or only the names given) and
+    # yield (name, result) for each one
+    for name, benchmark in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        with benchmark(paths) as function:
+            yield name, measure(function, repeat)
+
+
+def new_results():
+    # The results of a run, without the benchmarks yet
+    return {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'processor': platform.machine(),
+        'cpus': os.cpu_count(),
+        'benchmarks': {},
+    }
+
+
+def compare_results(old, new, tolerance=DEFAULT_TOLERANCE):
+    # Compare the best times of 2 runs, return one dictionnary per
+    # benchmark: ratio (new / old) and status (same, faster, slower,
+    # or added, removed when only one run has it)
+    rows = []
+    old_benchmarks, new_benchmarks = old['benchmarks'], new['benchmarks']
+    for name in list(old_benchmarks) + [name for name in new_benchmarks if name not in old_benchmarks]:
+        row = {'name': name,
+               'old': old_benchmarks.get(name, {}).get('best'),
+               'new': new_benchmarks.get(name, {}).get('best')}
+        if row['new'] is None:
+            row['status'] = 'removed'
+        elif row['old'] is None:
+            row['status'] = 'added'
+        else:
+            row['ratio'] = row['new'] / row['old']
+            if row['ratio'] > 1 + tolerance:
+                row['status'] = 'slower'
+            elif row['ratio'] < 1 / (1 + tolerance):
+                row['status'] = 'faster'
+            else:
+                row['status'] = 'same'
+        rows.append(row)
+    return rows
+
+
+def format_time(seconds):
+    # A time with its unit (s, ms, us)
+    if seconds is None:
+        return '-'
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3g} {}'.format(seconds / scale, unit)
+    return '{:.3g} ns'.format(seconds / 1e-9)
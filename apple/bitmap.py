@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Allocation bitmaps
+
+DOS 3.3 keeps its free sectors in the VTOC and ProDOS keeps its free
+blocks in the volume bitmap blocks. Both are read in a Bitmap: a
+compact bitset where the bit of unit n (sector or block) is the bit
+7 - n % 8 of the byte n // 8 (the ProDOS order), a bit set is a free
+unit.
+
+The bits are counted with a table (number of bits of each byte value)
+applied with bytes.translate, so the whole bitmap is counted at once.
+"""
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+# Number of bits set in each byte value
+POPCOUNT_TABLE = bytes(bin(value).count('1') for value in range(256))
+
+# Each byte value with its bits in the reverse order
+REVERSE_TABLE = bytes(int('{:08b}'.format(value)[::-1], 2) for value in range(256))
+
+# Each byte value as 8 bytes (1 for a bit set), the highest bit first
+EXPAND_TABLE = [bytes((value >> (7 - bit)) & 1 for bit in range(8)) for value in range(256)]
+
+
+class Bitmap:
+    __slots__ = ('_bits', 'size')
+
+    def __init__(self, bits, size):
+        # bits: the bytes of the bitmap, size: the number of units
+        self._bits = bytes(bits[:(size + 7) // 8])
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return self._bits
+
+    def units(self):
+        # One byte for each unit (1 if the bit is set, else 0), so the
+        # bitmap can be compared with other maps of the units at once
+        return b''.join([EXPAND_TABLE[byte] for byte in self._bits])[:self.size]
+
+    def is_set(self, unit):
+        if not 0 <= unit < self.size:
+            raise IndexError('unit {} out of the bitmap (size={})'.format(unit, self.size))
+        return bool(self._bits[unit >> 3] & (0x80 >> (unit & 7)))
+
+    def count(self, start=0, stop=None):
+        # Number of bits set from unit start to unit stop (not included)
+        if stop is None:
+            stop = self.size
+        if stop <= start:
+            return 0
+
+        first, last = start >> 3, (stop - 1) >> 3
+        if first == last:
+            mask = (0xFF >> (start & 7)) & (0xFF << (7 - ((stop - 1) & 7)))
+            return POPCOUNT_TABLE[self._bits[first] & mask]
+
+        # Whole bytes in the middle, the first and last bytes are masked
+        total = sum(self._bits[first + 1:last].translate(POPCOUNT_TABLE))
+        total += POPCOUNT_TABLE[self._bits[first] & (0xFF >> (start & 7))]
+        total += POPCOUNT_TABLE[self._bits[last] & (0xFF << (7 - ((stop - 1) & 7))) & 0xFF]
+        return total
+
+    def iter_runs(self, start=0, stop=None):
+        # Yield (first unit, number of units) for each run of bits set
+        # The bytes $00 and $FF are skipped at once
+        if stop is None:
+            stop = self.size
+        run_start = None
+        unit = start
+        while unit < stop:
+            byte = self._bits[unit >> 3]
+            if not unit & 7 and unit + 8 <= stop and byte in (0x00, 0xFF):
+                if byte == 0x00 and run_start is not None:
+                    yield run_start, unit - run_start
+                    run_start = None
+                elif byte == 0xFF and run_start is None:
+                    run_start = unit
+                unit += 8
+                continue
+
+            if byte & (0x80 >> (unit & 7)):
+                if run_start is None:
+                    run_start = unit
+            elif run_start is not None:
+                yield run_start, unit - run_start
+                run_start = None
+            unit += 1
+
+        if run_start is not None:
+            yield run_start, stop - run_start
+
+
+def dos_bitmap(vtoc, total_tracks, sector_per_track):
+    # Read the bitmap of the free sectors from the VTOC
+    # Each track uses 4 bytes from $38: FEDCBA98 76543210 (+ 2 unused),
+    # so with 16 sectors the bitmap is bytes 1 and 0 of each track with
+    # their bits in the reverse order (unit = track * 16 + sector)
+    entries = bytes(vtoc[0x38:0x38 + 4 * total_tracks])
+    if sector_per_track == 16:
+        bits = bytearray(2 * total_tracks)
+        bits[0::2] = entries[1::4]
+        bits[1::2] = entries[0::4]
+        return Bitmap(bits.translate(REVERSE_TABLE), 16 * total_tracks)
+
+    # Other sizes (13 sectors): the highest sector is the highest bit
+    value = 0
+    for track in range(total_tracks):
+        sectors = int.from_bytes(entries[4 * track:4 * track + 4], 'big') >> (32 - sector_per_track)
+        reverse = int('{:0{width}b}'.format(sectors, width=sector_per_track)[::-1], 2)
+        value = (value << sector_per_track) | reverse
+    size = total_tracks * sector_per_track
+    return Bitmap((value << (-size % 8)).to_bytes((size + 7) // 8, 'big'), size)
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of the catalogs
+
+The metadata of an image (VTOC, catalog entries, ProDOS volume header
+and files, free space) is kept in a SQLite database in the user cache
+directory, so the next run doesn't need to parse the image again.
+
+An entry is found from the path of the image and is valid while the
+size and the modification time of the file are the same. When they
+change, the image is parsed again. A member of a zip file
+(collection.zip!game.dsk) is valid while the zip file is the same.
+
+For a path not in the cache, a copy of the image already in the cache
+is found from the hash of its whole content, only for the files up to
+COPY_MAX_SIZE (the floppies): hashing a big volume costs more than
+parsing it (only its directories are read, see apple.paged).
+
+The images in memory (bytes, MemoryImage) are never in the cache.
+
+The database is bounded in size: the entries used the least recently
+are removed when the total size of the metadata is too big.
+
+Environment:
+    ADIR_CACHE_DIR:     Directory of the cache (default: ~/.cache/adir)
+    ADIR_NO_CACHE:      Set to 1 to never use the cache
+"""
+from functools import partial
+from hashlib import blake2b
+import json
+import os
+import sqlite3
+import time
+
+from apple.disk import DiskfileError, load_source, STORAGE_MMAP, \
+    SYSTEM_UNKNOWN, SYSTEM_DOS32, SYSTEM_DOS33, SYSTEM_PRODOS, SYSTEM_PASCAL
+from apple.probe import probe, open_disk, pascal_volume_name
+from apple.source import split_member, source_name
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.6'
+
+# Change it when the metadata change, the old database is not used
+CACHE_VERSION = 4
+
+# Maximum size of all the metadata (JSON) kept in the cache
+DEFAULT_MAX_SIZE = 128 * 1024 * 1024
+
+# The file is hashed by chunks of this size
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Copies are found only for the files up to this size (a 800 KB
+# floppy), the bigger ones are never hashed
+COPY_MAX_SIZE = 1024 * 1024
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash BLOB,
+    data TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_hash ON images (hash);
+CREATE INDEX IF NOT EXISTS images_accessed ON images (accessed);
+CREATE TABLE IF NOT EXISTS total (length INTEGER NOT NULL);
+INSERT INTO total SELECT 0 WHERE NOT EXISTS (SELECT * FROM total);
+CREATE TRIGGER IF NOT EXISTS images_insert AFTER INSERT ON images
+    BEGIN UPDATE total SET length = length + NEW.length; END;
+CREATE TRIGGER IF NOT EXISTS images_delete AFTER DELETE ON images
+    BEGIN UPDATE total SET length = length - OLD.length; END;
+'''
+
+
+def cache_directory():
+    directory = os.environ.get('ADIR_CACHE_DIR')
+    if directory:
+        return directory
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'adir')
+
+
+def content_hash(diskname, size):
+    # Hash of the whole content of a file (with its size), read by
+    # chunks, for a member of a zip file: the zip file and the name
+    # of the member
+    diskname, member = split_member(diskname)
+    digest = blake2b(str(size).encode(), digest_size=16)
+    if member is not None:
+        digest.update(member.encode('utf-8', 'surrogateescape'))
+    with open(diskname, 'rb') as diskfile:
+        for chunk in iter(partial(diskfile.read, HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def read_metadata(diskname, storage=STORAGE_MMAP):
+    # Parse an image (DOS 3.3, DOS 3.2, ProDOS or Pascal) and return
+    # its metadata as a dictionnary that can be saved in JSON
+    # The system and the order are found first (see apple.probe),
+    # so the image is only parsed (and decompressed) once
+    diskname = load_source(diskname)
+    result = probe(diskname)
+    if result.system == SYSTEM_UNKNOWN:
+        raise DiskfileError(source_name(diskname), 'is not a DOS, ProDOS or Pascal disk')
+    with open_disk(diskname, storage, result) as dsk:
+        return describe_disk(dsk)
+
+
+def describe_disk(dsk):
+    # The metadata of a disk already opened (see apple.probe.open_disk)
+    metadata = {'format': dsk.system, 'order': dsk.order, 'nibble': bool(dsk._nibble_track_size)}
+
+    if dsk.system in (SYSTEM_DOS33, SYSTEM_DOS32):
+        metadata.update({
+            'volume': dsk._disk_volume,
+            'vtoc': dict(dsk._vtoc),
+            'total_sectors': dsk._total_tracks * dsk._sector_per_track,
+            'free_sectors': dsk.free_sectors(),
+            'files': [dict(entry.as_dict(), type=entry.type_letter) for entry in dsk.iter_catalog()],
+        })
+    elif dsk.system == SYSTEM_PRODOS:
+        header = dsk.read_volume_header()
+        metadata.update({
+            'volume': header['name'],
+            'header': header,
+            'total_blocks': header['total_blocks'],
+            'free_blocks': dsk.free_blocks(),
+            'files': [dict(entry.as_dict(), type=entry.type_name) for entry in dsk.iter_files()],
+        })
+    elif dsk.system == SYSTEM_PASCAL:
+        # Only the name of the volume for now (directory in block 2)
+        metadata['volume'] = pascal_volume_name(dsk)
+    else:
+        raise DiskfileError(dsk._diskname, 'is not a DOS, ProDOS or Pascal disk')
+    return metadata
+
+
+class CatalogCache:
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._connection = None
+        self._path = None
+        if os.environ.get('ADIR_NO_CACHE', '') not in ('', '0'):
+            return
+        try:
+            directory = directory or cache_directory()
+            os.makedirs(directory, exist_ok=True)
+            self._path = os.path.join(directory, 'catalog-v{}.sqlite'.format(CACHE_VERSION))
+            self._connection = sqlite3.connect(self._path, timeout=30)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(_SCHEMA)
+        except (OSError, sqlite3.Error):
+            # No cache, everything is parsed again
+            self._connection = None
+
+    @property
+    def enabled(self):
+        return self._connection is not None
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get(self, diskname):
+        # Return the metadata of an image if it's in the cache and
+        # still valid, else None (nothing is parsed, see load)
+        return self.lookup(diskname)[0]
+
+    def _usable(self, diskname):
+        # Only the images in a file (or in a zip file) are cached
+        return self._connection is not None and isinstance(diskname, str)
+
+    def lookup(self, diskname):
+        # Return (metadata or None, hash of the content or None), the
+        # hash is given to put when the image is parsed (not computed
+        # twice)
+        if not self._usable(diskname):
+            return None, None
+        try:
+            path = os.path.abspath(diskname)
+            stat = os.stat(split_member(path)[0])
+            row = self._connection.execute('SELECT size, mtime, data FROM images WHERE path = ?',
+                                           (path,)).fetchone()
+            if row:
+                if row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+                    # Changed: never the metadata of another image
+                    return None, None
+                with self._connection:
+                    self._connection.execute('UPDATE images SET accessed = ? WHERE path = ?', (time.time(), path))
+                return json.loads(row[2]), None
+
+            # New path: look for the same content (a copy), the hash of
+            # the whole content is the check that it's the same image
+            if stat.st_size > COPY_MAX_SIZE:
+                return None, None
+            digest = content_hash(path, stat.st_size)
+            row = self._connection.execute('SELECT data FROM images WHERE hash = ? AND size = ? LIMIT 1',
+                                           (digest, stat.st_size)).fetchone()
+            if row is None:
+                return None, digest
+            self._store(path, stat, digest, row[0])
+            return json.loads(row[0]), digest
+        except (OSError, sqlite3.Error, ValueError):
+            return None, None
+
+    def put(self, diskname, metadata, digest=None):
+        if not self._usable(diskname):
+            return
+        try:
+            path = os.path.abspath(diskname)
+            stat = os.stat(split_member(path)[0])
+            if digest is None and stat.st_size <= COPY_MAX_SIZE:
+                digest = content_hash(path, stat.st_size)
+            self._store(path, stat, digest, json.dumps(metadata))
+            self._evict()
+        except (OSError, sqlite3.Error):
+            pass
+
+    def _store(self, path, stat, digest, data):
+        with self._connection:
+            # Delete then insert, so the triggers keep the total size
+            self._connection.execute('DELETE FROM images WHERE path = ?', (path,))
+            self._connection.execute('INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (path, stat.st_size, stat.st_mtime_ns, digest, data, len(data),
+                                      time.time()))
+
+    def _evict(self):
+        # Remove the entries used the least recently until the
+        # total size is 90% of the maximum
+        total = self._connection.execute('SELECT length FROM total').fetchone()[0]
+        if total <= self.max_size:
+            return
+        target = total - self.max_size * 9 // 10
+        paths = []
+        for path, length in self._connection.execute('SELECT path, length FROM images ORDER BY accessed'):
+            paths.append((path,))
+            target -= length
+            if target <= 0:
+                break
+        with self._connection:
+            self._connection.executemany('DELETE FROM images WHERE path = ?', paths)
+
+    def load(self, diskname, storage=STORAGE_MMAP):
+        # The metadata of an image, from the cache or parsed (and saved)
+        if not self._usable(diskname):
+            return read_metadata(diskname, storage)
+        metadata, digest = self.lookup(diskname)
+        if metadata is None:
+            metadata = read_metadata(diskname, storage)
+            self.put(diskname, metadata, digest)
+        return metadata
+
+
+# One cache for each process (the workers of a batch open their own)
+_default_cache = None
+
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = CatalogCache()
+    return _default_cache
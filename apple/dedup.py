@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the sectors and files shared by the images of a library
+
+Each sector (each block of a ProDOS volume) and each file (DOS 3.3 or
+ProDOS) of an image is hashed (blake2b, 16 bytes), and the hashes are
+kept in a SQLite database:
+    images          one row per image: path, size and date of its file
+                    (the zip file for a member)
+    image_units     hash of each different sector/block of an image
+                    and how many times it's there
+    units           each different sector/block: size, number of
+                    images using it
+    image_files     name, hash and size of each file of an image
+    files           each different file: size, number of images
+The number of images using a hash is kept up to date when an image is
+added or removed, so the queries are only lookups in an index:
+- images_with: the images containing a sector/block or a file
+- unique: the bytes of an image found in no other image
+
+The index is updated incrementally (see apple.index): an image already
+indexed is hashed again only if its file changed (size or modification
+time), and prune removes the images which are not there anymore. The
+images are hashed by a pool of processes, only this process writes in
+the database.
+"""
+from collections import Counter
+from hashlib import blake2b
+
+from apple.batch import DEFAULT_CHUNKSIZE
+from apple.diff import logical_image
+from apple.disk import DiskfileError, STORAGE_MMAP
+from apple.dos import DiskDos33
+from apple.index import ImageIndex, image_stamp, update_images
+from apple.probe import open_disk
+from apple.prodos import DiskProdos
+from apple.source import source_size
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.3'
+
+HASH_SIZE = 16
+
+DEDUP_FILENAME = 'dedup.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    unit_size INTEGER NOT NULL,
+    units INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    hash BLOB PRIMARY KEY,
+    size INTEGER NOT NULL,
+    images INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS image_units (
+    image INTEGER NOT NULL,
+    hash BLOB NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (image, hash)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS image_units_hash ON image_units (hash);
+CREATE TABLE IF NOT EXISTS files (
+    hash BLOB PRIMARY KEY,
+    size INTEGER NOT NULL,
+    images INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS image_files (
+    image INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    hash BLOB NOT NULL,
+    PRIMARY KEY (image, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS image_files_hash ON image_files (hash);
+'''
+
+
+def hash_data(data):
+    return blake2b(data, digest_size=HASH_SIZE).digest()
+
+
+def hash_chunks(chunks):
+    # (hash, length) of data given by chunks, nothing is joined
+    digest = blake2b(digest_size=HASH_SIZE)
+    length = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        length += len(chunk)
+    return digest.digest(), length
+
+
+def _iter_files(dsk):
+    # (name, hash, length) of each file of a DOS 3.3 or ProDOS disk,
+    # the content is hashed chunk by chunk (a view of the image with
+    # the mmap storage), a file is never copied in memory
+    if isinstance(dsk, DiskDos33):
+        for entry in dsk.iter_catalog():
+            if not entry.deleted:
+                yield (entry.name,) + hash_chunks(dsk.iter_file(entry))
+    elif isinstance(dsk, DiskProdos):
+        for entry in dsk.iter_files():
+            if not entry.is_directory:
+                yield (entry.path,) + hash_chunks(dsk.iter_file(entry))
+
+
+def hash_image(diskname):
+    # Hash the sectors (or blocks) and the files of an image (in a worker)
+    # The hashes of the units are joined in one bytes object
+    result = {'path': diskname}
+    try:
+        result['stamp'] = image_stamp(diskname)
+        result['size'] = source_size(diskname)
+        with open_disk(diskname, STORAGE_MMAP) as dsk:
+            data, unit_size = logical_image(dsk)
+            result['unit_size'] = unit_size
+            result['units'] = b''.join(hash_data(data[start:start + unit_size])
+                                       for start in range(0, len(data), unit_size))
+            files = []
+            try:
+                files.extend(_iter_files(dsk))
+            except DiskfileError as error:
+                # A damaged catalog: the files found until there
+                result['files_error'] = str(error)
+            result['files'] = files
+    except DiskfileError as error:
+        result['error'] = str(error)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+class DedupIndex(ImageIndex):
+    filename = DEDUP_FILENAME
+    schema = _SCHEMA
+
+    def _remove(self, image):
+        # Remove an image (in a transaction), the hashes used by no
+        # other image are removed too
+        execute = self._connection.execute
+        execute('UPDATE units SET images = images - 1 WHERE hash IN '
+                '(SELECT hash FROM image_units WHERE image = ?)', (image,))
+        execute('DELETE FROM units WHERE images = 0')
+        execute('UPDATE files SET images = images - 1 WHERE hash IN '
+                '(SELECT DISTINCT hash FROM image_files WHERE image = ?)', (image,))
+        execute('DELETE FROM files WHERE images = 0')
+        execute('DELETE FROM image_units WHERE image = ?', (image,))
+        execute('DELETE FROM image_files WHERE image = ?', (image,))
+        execute('DELETE FROM images WHERE id = ?', (image,))
+
+    def add(self, result):
+        # Add (or replace) an image from the result of hash_image
+        units = result['units']
+        counts = Counter(units[index:index + HASH_SIZE] for index in range(0, len(units), HASH_SIZE))
+        unit_size = result['unit_size']
+        with self._connection:
+            self._remove_path(result['path'])
+            execute = self._connection.execute
+            image = execute('INSERT INTO images (path, size, mtime, unit_size, units) VALUES (?, ?, ?, ?, ?)',
+                            (result['path'], result['stamp'][0], result['stamp'][1], unit_size,
+                             len(units) // HASH_SIZE)).lastrowid
+            self._connection.executemany('INSERT INTO image_units VALUES (?, ?, ?)',
+                                         [(image, digest, count) for digest, count in counts.items()])
+            self._connection.executemany('INSERT INTO units VALUES (?, ?, 1) ON CONFLICT (hash) '
+                                         'DO UPDATE SET images = images + 1',
+                                         [(digest, unit_size) for digest in counts])
+            # The same name twice in a damaged catalog: the first one
+            files = {}
+            for name, digest, size in result['files']:
+                files.setdefault(name, (digest, size))
+            self._connection.executemany('INSERT INTO image_files VALUES (?, ?, ?)',
+                                         [(image, name, digest) for name, (digest, size) in files.items()])
+            self._connection.executemany('INSERT INTO files VALUES (?, ?, 1) ON CONFLICT (hash) '
+                                         'DO UPDATE SET images = images + 1',
+                                         list({digest: size for digest, size in files.values()}.items()))
+
+    def images_with(self, digest):
+        # The images containing a sector/block or a file from its hash:
+        # {'units': [{path, count}], 'files': [{path, name}]}
+        execute = self._connection.execute
+        return {
+            'units': [{'path': path, 'count': count} for path, count in execute(
+                'SELECT path, count FROM image_units JOIN images ON images.id = image '
+                'WHERE hash = ? ORDER BY path', (digest,))],
+            'files': [{'path': path, 'name': name} for path, name in execute(
+                'SELECT path, name FROM image_files JOIN images ON images.id = image '
+                'WHERE hash = ? ORDER BY path, name', (digest,))],
+        }
+
+    def unique(self, path):
+        # The bytes (sectors/blocks) and the files of an image found in
+        # no other image, None if the image is not indexed
+        execute = self._connection.execute
+        row = execute('SELECT id, unit_size, units FROM images WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        image, unit_size, total = row
+        unique_units, unique_bytes = execute(
+            'SELECT COALESCE(SUM(count), 0), COALESCE(SUM(count * size), 0) FROM image_units '
+            'JOIN units USING (hash) WHERE image = ? AND images = 1', (image,)).fetchone()
+        unique_files = [name for name, in execute(
+            'SELECT name FROM image_files JOIN files USING (hash) WHERE image = ? AND images = 1 '
+            'ORDER BY name', (image,))]
+        return {
+            'path': path,
+            'unit_size': unit_size,
+            'units': total,
+            'bytes': total * unit_size,
+            'unique_units': unique_units,
+            'unique_bytes': unique_bytes,
+            'shared_bytes': total * unit_size - unique_bytes,
+            'files': execute('SELECT COUNT(*) FROM image_files WHERE image = ?', (image,)).fetchone()[0],
+            'unique_files': unique_files,
+        }
+
+    def stats(self):
+        execute = self._connection.execute
+        images, total_bytes = execute('SELECT COUNT(*), COALESCE(SUM(units * unit_size), 0) FROM images').fetchone()
+        units, unit_bytes = execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM units').fetchone()
+        return {
+            'images': images,
+            'bytes': total_bytes,
+            'different_units': units,
+            'different_bytes': unit_bytes,
+            'different_files': execute('SELECT COUNT(*) FROM files').fetchone()[0],
+        }
+
+
+def _summary(result):
+    summary = {'size': result['size'], 'units': len(result['units']) // HASH_SIZE, 'files': len(result['files'])}
+    if 'files_error' in result:
+        summary['files_error'] = result['files_error']
+    return summary
+
+
+def update_index(index, images, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Hash the images not indexed yet (or changed) and add them to the
+    # index, yield one result per image (without the hashes)
+    return update_images(index, images, hash_image, _summary, workers, chunksize)
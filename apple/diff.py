@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Differences between disk images
+
+Both images are compared in the same logical order, whatever the order
+of their files (.dsk, .po, .nib): by DOS 3.3 sectors, or by ProDOS
+blocks when both disks are ProDOS volumes. There is no loop over the
+bytes:
+1. the whole images are compared at once (equal: nothing else to do)
+2. then each track (4 KB) of the images, a memcmp for each
+3. the bytes of the tracks which are not the same are XORed as big
+   integers, so the changed sectors (or blocks) and the number of bytes
+   changed in each of them are found with bytes.count
+
+The changed sectors following each other are given as ranges, with the
+files using them (in one image or the other): the owners of the sectors
+of a DOS disk come from apple.forensics.build_ownership, the owners of
+the blocks of a ProDOS volume from its directories and index blocks.
+
+One image can be compared with many others: the reference is loaded
+(with its owners) only once in each process (diff_many).
+"""
+from apple.batch import run_batch, DEFAULT_CHUNKSIZE
+from apple.disk import DiskfileError, STORAGE_MMAP
+from apple.dos import DiskDos33
+from apple.forensics import build_ownership
+from apple.order import reorder_image, ORDER_DOS, ORDER_PRODOS
+from apple.probe import open_disk
+from apple.prodos import DiskProdos, VOLUME_DIRECTORY_BLOCK, STORAGE_SAPLING, STORAGE_TREE, \
+    STORAGE_EXTENDED
+from apple.source import source_size
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+UNIT_SECTOR = 'sector'
+UNIT_BLOCK = 'block'
+
+# The images are compared by tracks first
+TRACK_SIZE = 4096
+
+SECTOR_SIZE = 256
+BLOCK_SIZE = 512
+
+# Owners of the blocks of a ProDOS volume which are not files
+BOOT_BLOCKS = 2
+OWNER_BOOT = 'boot'
+OWNER_VOLUME = 'volume directory'
+OWNER_BITMAP = 'bitmap'
+
+
+class DiffImage:
+    """An image read for a diff: its content in the logical order of
+    the units compared (sectors or blocks) and the owner of each unit"""
+
+    def __init__(self, diskname):
+        self.path = diskname
+        with open_disk(diskname, STORAGE_MMAP) as dsk:
+            self.system = dsk.system
+            self.sector_per_track = dsk._sector_per_track
+            self.block = isinstance(dsk, DiskProdos)
+            self.data, unit_size = logical_image(dsk)
+            # Name of the owner of each unit ({unit: name})
+            try:
+                if isinstance(dsk, DiskDos33):
+                    self.owners = dos_owners(dsk)
+                elif self.block:
+                    self.owners = prodos_owners(dsk)
+                else:
+                    self.owners = {}
+            except DiskfileError:
+                # A damaged catalog, the ranges are given without owners
+                self.owners = {}
+
+
+def logical_image(dsk):
+    # The content of an opened disk in the logical order of its units
+    # (in one pass) and the size of a unit: the blocks of a ProDOS volume
+    # follow each other, else the DOS 3.3 sectors
+    if isinstance(dsk, DiskProdos):
+        return reorder_image(dsk._memview()[0:dsk._disksize_raw], dsk.order, ORDER_PRODOS), BLOCK_SIZE
+    return reorder_image(dsk._memview()[0:dsk._disksize_raw], dsk.order, ORDER_DOS), SECTOR_SIZE
+
+
+def dos_owners(dsk):
+    # Name of the owner of each sector of a DOS disk ({unit: name}),
+    # a unit is track * sector_per_track + sector
+    ownership, error = build_ownership(dsk)
+    names = {}
+    for unit in range(len(ownership.owners)):
+        owner = ownership.owners[unit]
+        if owner:
+            names[unit] = ownership.owner_name(owner)
+    return names
+
+
+def _chain(dsk, block):
+    # The blocks of a directory, from its key block
+    blocks = []
+    while block and block not in blocks:
+        blocks.append(block)
+        data = dsk.read_block_cached(block)
+        block = data[0x02] + (data[0x03] << 8)
+    return blocks
+
+
+def prodos_owners(dsk):
+    # Name of the owner of each block of a ProDOS volume ({block: name})
+    names = {block: OWNER_BOOT for block in range(BOOT_BLOCKS)}
+    for block in _chain(dsk, VOLUME_DIRECTORY_BLOCK):
+        names[block] = OWNER_VOLUME
+    header = dsk.read_volume_header()
+    for index in range(-(-header['total_blocks'] // (BLOCK_SIZE * 8))):
+        names[header['bit_map_pointer'] + index] = OWNER_BITMAP
+
+    for entry in dsk.iter_files():
+        if entry.is_directory:
+            blocks = _chain(dsk, entry.key_pointer)
+        else:
+            # The index blocks (or the extended key block), then the data blocks
+            blocks = []
+            if entry.storage_type in (STORAGE_SAPLING, STORAGE_TREE, STORAGE_EXTENDED):
+                blocks.append(entry.key_pointer)
+            if entry.storage_type == STORAGE_TREE:
+                blocks.extend(block for block in dsk._index_pointers(entry.key_pointer) if block)
+            blocks.extend(block for block in dsk.iter_file_blocks(entry) if block)
+        for block in blocks:
+            names.setdefault(block, entry.path)
+    return names
+
+
+def changed_units(reference, other, unit_size):
+    # Compare 2 buffers (bytes) of the same size and return the list
+    # of (unit, bytes changed) of the units which are not the same
+    if reference == other:
+        return []
+    changes = []
+    size = len(reference)
+    for start in range(0, size, TRACK_SIZE):
+        end = min(start + TRACK_SIZE, size)
+        first, second = reference[start:end], other[start:end]
+        if first == second:
+            continue
+        # The bytes not the same are the bytes not 0 after a XOR
+        xor = (int.from_bytes(first, 'big') ^ int.from_bytes(second, 'big')).to_bytes(end - start, 'big')
+        for offset in range(0, end - start, unit_size):
+            same = xor.count(0, offset, offset + unit_size)
+            if same != min(unit_size, end - start - offset):
+                changes.append(((start + offset) // unit_size, min(unit_size, end - start - offset) - same))
+    return changes
+
+
+def _ranges(changes, names):
+    # Join the units following each other: [first, last, bytes changed]
+    ranges = []
+    for unit, count in changes:
+        if ranges and ranges[-1][1] == unit - 1:
+            ranges[-1][1] = unit
+            ranges[-1][2] += count
+            ranges[-1][3].update(names(unit))
+        else:
+            ranges.append([unit, unit, count, set(names(unit))])
+    return ranges
+
+
+def diff_disks(reference, other):
+    # Compare 2 DiffImage and return a report (a dictionnary for JSON)
+    if reference.sector_per_track != other.sector_per_track:
+        raise DiskfileError(other.path, 'has {} sectors per track, not {}'.format(
+            other.sector_per_track, reference.sector_per_track))
+
+    block = reference.block and other.block
+    if block != reference.block or block != other.block:
+        # A ProDOS volume and another disk: both by sectors
+        reference_data = reorder_image(reference.data, ORDER_PRODOS, ORDER_DOS) if reference.block \
+            else reference.data
+        other_data = reorder_image(other.data, ORDER_PRODOS, ORDER_DOS) if other.block else other.data
+        reference_owners, other_owners = ({}, {})
+    else:
+        reference_data, other_data = reference.data, other.data
+        reference_owners, other_owners = reference.owners, other.owners
+    unit_size = BLOCK_SIZE if block else SECTOR_SIZE
+
+    common = min(len(reference_data), len(other_data))
+    changes = changed_units(reference_data[:common], other_data[:common], unit_size)
+    # The units of only one image are all changed
+    longest = max(len(reference_data), len(other_data))
+    changes.extend((unit, unit_size) for unit in range(common // unit_size, -(-longest // unit_size)))
+
+    def names(unit):
+        return [name for name in (reference_owners.get(unit), other_owners.get(unit)) if name]
+
+    report = {
+        'path': other.path,
+        'reference': reference.path,
+        'unit': UNIT_BLOCK if block else UNIT_SECTOR,
+        'identical': not changes and reference.system == other.system,
+        'changed': len(changes),
+        'changed_bytes': sum(count for unit, count in changes),
+        'ranges': [],
+    }
+    if reference.system != other.system:
+        report['systems'] = [reference.system, other.system]
+    if len(reference_data) != len(other_data):
+        report['sizes'] = [len(reference_data), len(other_data)]
+
+    files = set()
+    for first, last, count, owners in _ranges(changes, names):
+        if block:
+            values = {'start': first, 'end': last, 'blocks': last - first + 1}
+        else:
+            values = {'start': list(divmod(first, reference.sector_per_track)),
+                      'end': list(divmod(last, reference.sector_per_track)),
+                      'sectors': last - first + 1}
+        values['bytes'] = count
+        values['files'] = sorted(owners)
+        files.update(owners)
+        report['ranges'].append(values)
+    report['files'] = sorted(files)
+    return report
+
+
+def diff_images(reference, other):
+    # Compare 2 images (filenames), raise a DiskfileError if one
+    # of them cannot be read
+    return diff_disks(DiffImage(reference), DiffImage(other))
+
+
+# The reference of diff_many, loaded once by each process
+_reference = None
+
+
+def _load_reference(diskname):
+    # (a process forked after the first load already has it)
+    global _reference
+    if _reference is None or _reference.path != diskname:
+        _reference = DiffImage(diskname)
+
+
+def diff_one(diskname):
+    # Compare an image with the reference, any error is kept in the result
+    result = {'path': diskname, 'reference': _reference.path}
+    try:
+        result['size'] = source_size(diskname)
+        result.update(diff_disks(_reference, DiffImage(diskname)))
+    except DiskfileError as error:
+        result['error'] = str(error)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+def diff_many(reference, images, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Compare each image with the reference and yield one report per image
+    # (a DiskfileError if the reference cannot be read)
+    _load_reference(reference)
+    return run_batch(diff_one, images, workers, chunksize, _load_reference, (reference,))
@@ -7,8 +7,8 @@ Apple II Disk Image Reader
 - DiskDoss33: child class for Dos disk with a catalog 
 - DiskProdos: child class for ProDOS disk
 
-    TODO:
-    - NIB format (http://boutillon.free.fr/Underground/Cours/Nibbles/Nibbles.html)
+    NIB format (http://boutillon.free.fr/Underground/Cours/Nibbles/Nibbles.html)
+    decoded track by track by apple.nib (6&2 encoding, 16 sectors)
     Le .NIB permet de gérer ces disquettes au format non standardisé.
     
     Le .DSK est rangé bien proprement. Les secteurs se suivent dans l'ordre et tout est pour le mieux dans 
@@ -32,11 +32,98 @@ Apple II Disk Image Reader
     static int SECTOR_SIZE = 409;
 """
 from array import array
+import mmap
 import sys
 import os
+import threading
+
+from apple.journal import replay_journal, write_changes
+from apple.nib import NibbleImage, nibble_track_size, NIB_TRACK_SIZE
+from apple.order import ORDER_DOS, check_order, sector_map
+from apple.paged import PagedImage
+from apple.source import MemoryImage, open_source, source_name, image_extension, SOURCE_ERRORS
+from apple.twoimg import read_2img_header, parse_2img_header, TWOIMG_EXTENSIONS, TWOIMG_FORMAT_NIBBLE, \
+    TWOIMG_MAGIC
 
 __author__ = 'Nicolas Djurovic'
-__version__ = '0.14'
+__version__ = '0.23'
+
+# How the disk image is kept in memory:
+# - STORAGE_ARRAY: the whole file is copied in an array('B'), each read
+#   returns a new array that the caller can modify
+# - STORAGE_MMAP: the file is memory-mapped (read-only), each read returns
+#   a memoryview on the mapping, nothing is copied and only the pages
+#   really used are read from the file
+# - STORAGE_PAGED: the file is read by pages when they are needed and
+#   only the last pages used are kept (see apple.paged), the reads are
+#   read-only views. An image bigger than PAGED_THRESHOLD (a hard disk
+#   volume) is always paged with STORAGE_ARRAY
+#
+# An image in memory (bytes, or decompressed, see apple.source) is
+# copied in an array with STORAGE_ARRAY, else it's read with views
+# on its buffer, like a mapped file.
+#
+# The writes (write_ts) never go to the file directly: the array is
+# already a copy, and the mapping becomes a copy-on-write mapping (only
+# the pages written are copied). The sectors written are kept in a
+# dirty set and flush writes only them back to the file (see apple.journal)
+STORAGE_ARRAY = 'array'
+STORAGE_MMAP = 'mmap'
+STORAGE_PAGED = 'paged'
+STORAGES = (STORAGE_ARRAY, STORAGE_MMAP, STORAGE_PAGED)
+
+# The biggest floppy image (a 3.5" disk is 800 KB) is still copied in memory
+PAGED_THRESHOLD = 1024 * 1024
+
+# Operating system found on a disk (see apple.probe)
+SYSTEM_UNKNOWN = 'unknown'
+SYSTEM_DOS33 = 'dos33'
+SYSTEM_DOS32 = 'dos32'
+SYSTEM_PRODOS = 'prodos'
+SYSTEM_PASCAL = 'pascal'
+
+# Size of a track of a 13 sectors image (DOS 3.2)
+TRACK_SIZE_13 = 13 * 256
+
+# Threads:
+# The reads don't change the Disk (read_ts, read_sector, read_block...
+# keep nothing in the object), so one Disk can be read by many threads
+# at the same time. The image is loaded (or mapped) once under a lock,
+# and the caches (directory blocks, pages, see apple.helpers.LRUCache)
+# have their own lock. What is computed the first time it's needed
+# (the bitmap of the free sectors, a decoded nibble track) can be
+# computed twice, but it's always the same value.
+# The writes (write_ts, write_block, flush) and close are not safe:
+# nobody else must use the Disk while they run.
+
+
+class Sector:
+    """Data read from an image, with where it comes from
+
+    track, sector:  logical (DOS 3.3) track and first sector
+    block:          ProDOS block (None for a read by track/sector)
+    position:       position in the image of the first byte
+    data:           as read by read_ts or read_block (a view of the
+                    image with the mmap storage)
+    """
+    __slots__ = ('track', 'sector', 'block', 'position', 'data')
+
+    def __init__(self, track, sector, position, data, block=None):
+        self.track = track
+        self.sector = sector
+        self.block = block
+        self.position = position
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bytes__(self):
+        return bytes(self.data)
+
+    def __repr__(self):
+        return 'Sector(track={}, sector={}, block={}, position={}, size={})'.format(
+            self.track, self.sector, self.block, self.position, len(self.data))
 
 
 class DiskfileError(Exception):
@@ -51,6 +138,17 @@ class DiskfileError(Exception):
         return "The disk file \"{}\" {} !".format(self._diskfile, self._message)
 
 
+def load_source(diskname):
+    # The image to read (see apple.source.open_source), the errors
+    # of the decompression are a DiskfileError
+    try:
+        return open_source(diskname)
+    except FileNotFoundError:
+        raise DiskfileError(source_name(diskname), 'not found !')
+    except SOURCE_ERRORS as error:
+        raise DiskfileError(source_name(diskname), 'cannot be decompressed ({})'.format(error))
+
+
 class Disk:
     # Disk File System Format
     __FS_UNKNOW = 0
@@ -64,26 +162,45 @@ class Disk:
     __DSK_PRODOS = 2
     __DSK_PASCAL = 3
 
-    def __init__(self, diskname):
+    def __init__(self, diskname, storage=STORAGE_ARRAY, order=ORDER_DOS):
         # From sys, put this flag to remove Traceback display
         sys.tracebacklimit = None
 
+        # An image in memory, compressed or in a zip file is read
+        # (and decompressed) now in _data, None for a plain file
+        source = load_source(diskname)
+        self._data = source.data if isinstance(source, MemoryImage) else None
+
         # Keep the name of our disk
-        self._diskname = diskname
+        self._diskname = source_name(source)
 
         # What kind of disk we're opening?
         self._dsk_format = self.__DSK_UNKNOW
+        self._system = SYSTEM_UNKNOWN
 
         # and init its size to 0
         self._disksize_raw = 0
 
-        # Init memory for the disk
-        # the size will be given by the disk size
-        self.memdisk = array('B')
+        # How to keep the disk in memory (array or mmap)
+        if storage not in STORAGES:
+            raise ValueError('Unknown storage "{}"'.format(storage))
+        self._storage = storage
+
+        # Order of the sectors in the image (see apple.order)
+        self._order = check_order(order)
 
-        # Set a default track/sector, so we can return the values
-        self.track = 0x00
-        self.sector = 0x00
+        # Memory for the disk, it will be created by the _load method
+        # the first time we need it (see the memdisk property), only
+        # by one thread
+        self._memdisk = None
+        self._load_lock = threading.Lock()
+        self._mmap = None
+        self._mmap_access = mmap.ACCESS_READ
+        # Copy of an image in memory, once it's written
+        self._buffer = None
+
+        # Position in the image of the sectors written and not flushed
+        self._dirty = set()
 
         # Number of tracks (usually 35)
         self._total_tracks = 35
@@ -94,27 +211,217 @@ class Disk:
         # Default total sector per track
         self._sector_per_track = 16
 
-        # Load our disk in memory and
-        # check the disk format:
-        # DOS, PRODOS, APPLE, ...
-        self._load()
+        # We only need the size of the disk for now, the file
+        # itself is opened the first time we read from it
+        self._file_size = self._get_file_size()
+
+        # A 2IMG file (.2mg) has a header before the image, which gives
+        # the position, the size and the order of the image
+        self._image_header = None
+        self._data_offset = 0
+        self._image_size = self._file_size
+        if image_extension(self._diskname) in TWOIMG_EXTENSIONS or \
+                (self._data is not None and self._data[:len(TWOIMG_MAGIC)] == TWOIMG_MAGIC):
+            self._image_header = self._read_image_header()
+            self._data_offset = self._image_header['data_offset']
+            self._image_size = self._image_header['data_length']
+            self._order = self._image_header['order']
+        self._disksize_raw = self._image_size
+
+        # A nibble image (.nib) is decoded to a sector image (DOS order),
+        # so the size of the disk is the size of its sectors
+        self._fs_format = self.__FS_SEQUENTIAL
+        self._nibble_track_size = nibble_track_size(self._image_size)
+        if self._image_header is not None and self._image_header['format'] != TWOIMG_FORMAT_NIBBLE:
+            self._nibble_track_size = 0
+        if self._nibble_track_size:
+            if self._nibble_track_size == NIB_TRACK_SIZE:
+                self._fs_format = self.__FS_NIBBLE_6656
+            else:
+                self._fs_format = self.__FS_NIBBLE_6384
+            self._total_tracks = self._image_size // self._nibble_track_size
+            self._disksize_raw = self._total_tracks * self._sector_per_track * self._sector_size
+            # and always decoded in DOS order
+            self._order = ORDER_DOS
+        elif self._image_size in (35 * TRACK_SIZE_13, 40 * TRACK_SIZE_13):
+            # 13 sectors image (DOS 3.2), there is no other order
+            self._sector_per_track = 13
+            self._total_tracks = self._image_size // TRACK_SIZE_13
+            self._order = ORDER_DOS
+        elif self._image_size > 35 * self._sector_per_track * self._sector_size:
+            # 40 tracks, or a hard disk volume seen as tracks of 16 sectors
+            self._total_tracks = self._image_size // (self._sector_per_track * self._sector_size)
+
+        # A big image (a hard disk volume) is read by pages
+        # (an image in memory is already there, it's read like a mapped file)
+        if self._data is not None:
+            if self._storage == STORAGE_PAGED:
+                self._storage = STORAGE_MMAP
+        elif self._storage == STORAGE_ARRAY and self._image_size > PAGED_THRESHOLD and not self._nibble_track_size:
+            self._storage = STORAGE_PAGED
+
+        # Position of each logical sector in a track of the image,
+        # None when the image is in DOS order
+        self._sector_position = sector_map(self._order)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Operating system of the disk, set by the child classes
+    # (or by apple.probe.open_disk)
+    @property
+    def system(self):
+        return self._system
+
+    @property
+    def order(self):
+        return self._order
+
+    def _set_system(self, system):
+        self._system = system
+        self._dsk_format = {
+            SYSTEM_DOS33: self.__DSK_DOS,
+            SYSTEM_DOS32: self.__DSK_DOS,
+            SYSTEM_PRODOS: self.__DSK_PRODOS,
+            SYSTEM_PASCAL: self.__DSK_PASCAL,
+        }.get(system, self.__DSK_UNKNOW)
+
+    # The disk is loaded (or mapped) only when we need it
+    @property
+    def memdisk(self):
+        memdisk = self._memdisk
+        if memdisk is None:
+            with self._load_lock:
+                if self._memdisk is None:
+                    self._load()
+                memdisk = self._memdisk
+        return memdisk
 
     # Return the real size of the file
     # to be used with the _load method
     def _get_file_size(self):
+        if self._data is not None:
+            return len(self._data)
         try:
             return os.stat(self._diskname).st_size
         except:
             raise DiskfileError(self._diskname, 'not found !')
 
-    # Load the disk file in the array
+    # Header of a 2IMG file (see apple.twoimg)
+    def _read_image_header(self):
+        try:
+            if self._data is not None:
+                header = parse_2img_header(self._data, len(self._data))
+            else:
+                header = read_2img_header(self._diskname)
+        except OSError as error:
+            raise DiskfileError(self._diskname, 'cannot be read ({})'.format(error))
+        if header is None:
+            raise DiskfileError(self._diskname, 'is not a valid 2IMG image')
+        return header
+
+    @property
+    def image_header(self):
+        # Header of a 2IMG file, None for the other images
+        return self._image_header
+
+    # Load the disk file in the array or map it
     def _load(self):
+        if self._data is not None:
+            self._memdisk = self._load_memory()
+            return
+
+        # A write stopped before its end is finished first
+        try:
+            replay_journal(self._diskname)
+        except OSError as error:
+            raise DiskfileError(self._diskname, 'has a journal which cannot be applied ({})'.format(error))
+
+        start, end = self._data_offset, self._data_offset + self._image_size
+        if self._storage == STORAGE_PAGED:
+            # Nothing is read now, only the pages used later
+            try:
+                self._memdisk = PagedImage(self._diskname, start, self._image_size)
+            except OSError as error:
+                raise DiskfileError(self._diskname, 'cannot be read ({})'.format(error))
+            return
+
         with open(self._diskname, 'rb') as diskfile:
-            # memdisk is an array, so we use array method 'fromfile'
-            # to load and populate our array with the real size
-            # of the file
-            self._disksize_raw = self._get_file_size()
-            self.memdisk.fromfile(diskfile, self._disksize_raw)
+            if self._storage == STORAGE_MMAP:
+                try:
+                    self._mmap = mmap.mmap(diskfile.fileno(), 0, access=self._mmap_access)
+                except ValueError:
+                    raise DiskfileError(self._diskname, 'is empty')
+                # The reads are always read-only views
+                # (of the image only, after the header of a 2IMG file)
+                memdisk = memoryview(self._mmap).toreadonly()
+                if start or end != self._file_size:
+                    memdisk = memdisk[start:end]
+            else:
+                # memdisk is an array, so we use array method 'fromfile'
+                # to load and populate our array with the real size
+                # of the image
+                memdisk = array('B')
+                diskfile.seek(start)
+                memdisk.fromfile(diskfile, self._image_size)
+
+        # The tracks of a nibble image are decoded when we read them
+        # (the sectors are always read-only views)
+        if self._nibble_track_size:
+            memdisk = NibbleImage(memdisk, self._nibble_track_size, self._diskname)
+        self._memdisk = memdisk
+
+    # The memdisk of an image in memory
+    def _load_memory(self):
+        data = self._data[self._data_offset:self._data_offset + self._image_size]
+        if self._storage == STORAGE_ARRAY:
+            memdisk = array('B')
+            memdisk.frombytes(data)
+        else:
+            # The image given is never changed, it's copied
+            # before the first write
+            if self._mmap_access == mmap.ACCESS_COPY:
+                self._buffer = bytearray(data)
+                data = self._buffer
+            memdisk = memoryview(data).toreadonly()
+        if self._nibble_track_size:
+            memdisk = NibbleImage(memdisk, self._nibble_track_size, self._diskname)
+        return memdisk
+
+    # The memdisk as something we can slice without copying it
+    def _memview(self):
+        memdisk = self.memdisk
+        if isinstance(memdisk, array):
+            return memoryview(memdisk)
+        return memdisk
+
+    @property
+    def storage(self):
+        # STORAGE_PAGED for a big image opened with STORAGE_ARRAY
+        return self._storage
+
+    # Release the memory used by the disk, it will be
+    # loaded again if we need to read it after that
+    # (the sectors written and not flushed are lost)
+    def close(self):
+        if self._mmap is not None:
+            if self._memdisk is not None:
+                self._memdisk.release()
+            try:
+                self._mmap.close()
+            except BufferError:
+                # A caller still holds a view on the disk,
+                # the mapping will be closed with its last view
+                pass
+            self._mmap = None
+        elif isinstance(self._memdisk, PagedImage):
+            self._memdisk.release()
+        self._memdisk = None
+        self._buffer = None
+        self._dirty.clear()
 
     # Get part of the memory corresponding of the
     # track/sector and how many byte to read
@@ -130,14 +437,119 @@ class Disk:
             sector = 0  # But we need to give a number for the position
             byte_to_read = self._sector_size * self._sector_per_track
 
-        position = (int(track) * self._sector_size * self._sector_per_track) + \
-                   (int(sector) * self._sector_size)
-        self.track = track
-        self.sector = sector
+        position = self._ts_position(int(track), int(sector))
 
+        # With the mmap storage, the result is a read-only view (no copy)
         if position < self._disksize_raw:
-            result = self.memdisk[position:position + int(byte_to_read)]
-            return result
+            byte_to_read = int(byte_to_read)
+            if self._sector_position is None or byte_to_read <= self._sector_size:
+                result = self.memdisk[position:position + byte_to_read]
+                return result
+
+            # The next sectors are not the next ones in the image
+            # so we join them in a new buffer
+            index = int(track) * self._sector_per_track + int(sector)
+            parts = []
+            while byte_to_read > 0:
+                position = self._ts_position(*divmod(index, self._sector_per_track))
+                if position >= self._disksize_raw:
+                    break
+                parts.append(self.memdisk[position:position + min(byte_to_read, self._sector_size)])
+                byte_to_read -= self._sector_size
+                index += 1
+            if self._storage == STORAGE_ARRAY:
+                return array('B', b''.join(parts))
+            return memoryview(b''.join(parts))
+
+    # The same read as read_ts, with the track, the sector and the
+    # position in the image (a whole track for sector=None)
+    def read_sector(self, track=0, sector=0, byte_to_read=None):
+        data = self.read_ts(track, sector, byte_to_read)
+        if data is None:
+            return None
+        track, sector = int(track), int(sector or 0)
+        return Sector(track, sector, self._ts_position(track, sector), data)
+
+    # Write data from track/sector (in the next sectors if it's more
+    # than one sector), the file is changed only by flush
+    def write_ts(self, track, sector, data):
+        data = memoryview(data).cast('B')
+        index = int(track) * self._sector_per_track + int(sector)
+        if index * self._sector_size + len(data) > self._disksize_raw:
+            raise DiskfileError(self._diskname, 'has no room for {} bytes at T${:02X} S${:02X}'.format(
+                len(data), int(track), int(sector)))
+        self._make_writable()
+
+        for start in range(0, len(data), self._sector_size):
+            position = self._ts_position(*divmod(index, self._sector_per_track))
+            self._write_at(position, data[start:start + self._sector_size])
+            index += 1
+        self._written()
+
+    # Write in the copy of the image at position (in one sector),
+    # nothing to do (and to flush) if the bytes are the same
+    def _write_at(self, position, data):
+        if self._memview()[position:position + len(data)] == data:
+            return
+        if self._mmap is not None:
+            position_in_file = self._data_offset + position
+            self._mmap[position_in_file:position_in_file + len(data)] = data
+        elif isinstance(self._memdisk, PagedImage):
+            self._memdisk[position:position + len(data)] = data
+        elif self._buffer is not None:
+            self._buffer[position:position + len(data)] = data
+        else:
+            memoryview(self._memdisk)[position:position + len(data)] = data
+        self._dirty.add(position - position % self._sector_size)
+
+    def _make_writable(self):
+        # The copy of the image must be writable before the first write
+        if self._nibble_track_size:
+            raise DiskfileError(self._diskname, 'is a nibble image, it cannot be written')
+        if self._storage == STORAGE_MMAP and self._mmap_access != mmap.ACCESS_COPY:
+            # Map the file again, copy-on-write
+            self.close()
+            self._mmap_access = mmap.ACCESS_COPY
+        self.memdisk
+
+    # Called after each write, so the child classes can forget
+    # what they read before (VTOC, blocks...)
+    def _written(self):
+        pass
+
+    @property
+    def dirty_sectors(self):
+        # Number of sectors written and not flushed
+        return len(self._dirty)
+
+    # Write the dirty sectors back to the file (only them, atomically,
+    # see apple.journal) and return the number of sectors written
+    def flush(self):
+        if not self._dirty:
+            return 0
+        if self._data is not None:
+            raise DiskfileError(self._diskname, 'is not a plain file, it cannot be written back')
+        view = self._memview()
+        size = self._sector_size
+        try:
+            write_changes(self._diskname, [(self._data_offset + position, view[position:position + size])
+                                           for position in self._dirty])
+        except OSError as error:
+            raise DiskfileError(self._diskname, 'cannot be written ({})'.format(error))
+        count = len(self._dirty)
+        self._dirty.clear()
+        return count
+
+    # Forget the sectors written and not flushed
+    def discard(self):
+        self.close()
+        self._written()
+
+    # Position in the image of a logical (DOS 3.3) track/sector
+    def _ts_position(self, track, sector):
+        if self._sector_position is not None:
+            sector = self._sector_position[sector]
+        return (track * self._sector_per_track + sector) * self._sector_size
 
     # Convert byte to ascii
     # we don't use the object itself at all, so declare it as static
@@ -155,6 +567,6 @@ class Disk:
 
 
 class DiskBin(Disk):
-    def __init__(self, diskname):
+    def __init__(self, diskname, storage=STORAGE_ARRAY, order=ORDER_DOS):
         # Init with the mother class
-        Disk.__init__(self, diskname)
+        Disk.__init__(self, diskname, storage, order)
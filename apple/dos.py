@@ -1,10 +1,138 @@
 # -*- coding: utf-8 -*-
 # For the import method:
 # https://www.python.org/dev/peps/pep-0008/#imports
-from apple.disk import Disk, DiskfileError
+import re
+
+from apple.bitmap import dos_bitmap
+from apple.disk import Disk, DiskfileError, STORAGE_ARRAY, SYSTEM_DOS32, SYSTEM_DOS33
+from apple.order import ORDER_DOS
 
 __author__ = 'Nicolas Djurovic'
-__version__ = '0.2'
+__version__ = '0.13'
+
+# Size of a File Descriptive Entry in a catalog sector
+CATALOG_ENTRY_SIZE = 0x23
+
+# Track/Sector List format:
+# 01    - Track of the next T/S list sector ($00 if it's the last one)
+# 02    - Sector of the next T/S list sector
+# 05-06 - Sector offset in the file of the first sector of this list
+# 0C-FF - Track/Sector pairs of the data sectors (122 pairs),
+#         a pair with a track $00 is a sector never written
+TS_LIST_FIRST_PAIR = 0x0C
+
+# File types with a header giving the length of the file:
+# INTEGER and APPLESOFT: length (2 bytes)
+# BINARY: address (2 bytes) and length (2 bytes)
+FILE_TYPE_TEXT = 0x00
+FILE_TYPE_INTEGER = 0x01
+FILE_TYPE_APPLESOFT = 0x02
+FILE_TYPE_BINARY = 0x04
+
+# End of a TEXT file, searched in the sector itself (a view with the
+# mmap storage) without copying it
+TEXT_END = re.compile(b'\x00')
+
+# Letter of each file type (without the lock flag $80)
+FILE_TYPES = {0x00: 'T', 0x01: 'I', 0x02: 'A', 0x04: 'B',
+              0x08: 'S', 0x10: 'R', 0x20: 'A', 0x40: 'B'}
+
+
+class CatalogEntry:
+    """One file of a DOS catalog
+
+    name:       Filename (stripped)
+    file_type:  File type without the lock flag ($00, $01, $02, $04, ...)
+    locked:     True if the file is locked (flag $80 of the type)
+    length:     Length of the file in sectors
+    track:      Track of the first track/sector list sector,
+                for a deleted file it's the original track
+    sector:     Sector of the first track/sector list sector
+    deleted:    True if the file has been deleted
+    """
+    __slots__ = ('name', 'file_type', 'locked', 'length', 'track', 'sector', 'deleted')
+
+    def __init__(self, name, file_type, locked, length, track, sector, deleted=False):
+        self.name = name
+        self.file_type = file_type
+        self.locked = locked
+        self.length = length
+        self.track = track
+        self.sector = sector
+        self.deleted = deleted
+
+    @classmethod
+    def from_fde(cls, fde, byte2ascii):
+        # Create the entry from the File Descriptive Entry bytes
+        type_file = fde[0x02]
+
+        # Extract the filename
+        filename = fde[0x03:0x21]
+
+        # and its length
+        file_length_low = fde[0x21]
+        file_length_high = fde[0x22]
+        file_length = (file_length_high << 8) + file_length_low
+
+        # Get info about the file:
+        # the first T/S list of the file
+        first_track_list_file = fde[0x00]
+        first_sector_list_file = fde[0x01]
+
+        deleted = first_track_list_file == 0xFF
+        if deleted:
+            # The original track is the last byte of the filename
+            first_track_list_file = filename[29]
+            # so change the byte at the 29th position to a space
+            # (on a copy, the sector can be a read-only view)
+            filename = bytearray(filename)
+            filename[29] = 0xA0  # $A0 = 160 (128 + 32)
+
+        # Generated the filename as a string from the list
+        # Convert to ascii, join the list to a string and strip it
+        fname = ''.join(byte2ascii(filename)).strip()
+
+        return cls(fname, type_file & 0x7F, bool(type_file & 0x80), file_length,
+                   first_track_list_file, first_sector_list_file, deleted)
+
+    @property
+    def type_letter(self):
+        # The letter displayed by the CATALOG (or the value if unknown)
+        return FILE_TYPES.get(self.file_type, self.file_type)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, values):
+        # From as_dict (the extra keys are ignored)
+        return cls(**{name: values[name] for name in cls.__slots__})
+
+    def __repr__(self):
+        return '<CatalogEntry {} {} {:03d} T${:02X} S${:02X}{}>'.format(
+            self.type_letter, self.name, self.length, self.track, self.sector, ' deleted' if self.deleted else '')
+
+
+def print_catalog(disk_volume, entries, free_sectors):
+    # Display the catalog from its entries (read from the disk or from the cache)
+
+    # Display the header
+    print('DISK VOLUME {}'.format(disk_volume))
+    print('')
+
+    for entry in entries:
+        tfile = entry.type_letter
+
+        # if file_length <> 0, show catalog
+        if entry.length != 0:
+            if entry.deleted:
+                print('>{} {:03d} {:<30s}<'.format(tfile, entry.length, entry.name))
+            else:
+                print(' {} {:03d} {:30}  [${:02X}:${:02X}]'.format(tfile, entry.length, entry.name,
+                                                                 entry.track, entry.sector))
+
+    print('')
+    print('Sectors free: {} '.format(free_sectors))
 
 
 class DiskDos33(Disk):
@@ -55,20 +183,18 @@ class DiskDos33(Disk):
             stored here.
     """
 
-    # Create a dictionnary for the VTOC
-    _vtoc = {}
-
     # Usual values used to read the VTOC
     _vtoc_track = 0x11
     _vtoc_sector = 0x00
     _vtoc_sector_size = 256
-    _vtoc_total_sectors = 16
 
-    def __init__(self, diskname):
+    def __init__(self, diskname, storage=STORAGE_ARRAY, order=ORDER_DOS):
         # Init with the mother class
-        Disk.__init__(self, diskname)
+        Disk.__init__(self, diskname, storage, order)
 
         # To get our catalog, we will need to read the VTOC
+        # (in a dictionnary for each disk)
+        self._vtoc = {}
         self._read_vtoc()
 
         # Our first Track/Sector of our catalog:
@@ -85,6 +211,9 @@ class DiskDos33(Disk):
         # Size of one sector in byte
         self._sector_size = self._vtoc['sector_size']
 
+        # Bitmap of the free sectors, read from the VTOC when needed
+        self._free_map = None
+
         # Total should be 143360 bytes for a usual Dos33 disk
         self._disksize = self._total_tracks * self._sector_per_track * self._sector_size
 
@@ -93,6 +222,8 @@ class DiskDos33(Disk):
         if self._disksize_raw != self._disksize:
             raise DiskfileError(self._diskname, 'is not a valid DOS disk, the size is {}'.format(self._disksize_raw))
 
+        self._set_system(SYSTEM_DOS32 if self._sector_per_track == 13 else SYSTEM_DOS33)
+
     def _read_vtoc(self):
         # Reading the VTOC will give us:
         # - First catalog track (first_catalog_track) byte $01
@@ -106,9 +237,8 @@ class DiskDos33(Disk):
             # Our first try to read track _vtoc_track and sector _vtoc_sector_size
             # we don't use the read_ts method because we don't know
             # yet all the info we need to read tracks and sectors
-            # So we're using usual values
-            position = (self._vtoc_track * self._vtoc_sector_size * self._vtoc_total_sectors) + \
-                       (self._vtoc_sector * self._vtoc_sector_size)
+            # So we're using the values guessed from the size of the image
+            position = self._ts_position(self._vtoc_track, self._vtoc_sector)
             cat_vtoc = self.memdisk[position:position + self._vtoc_sector_size]
 
             self._vtoc['first_catalog_track'] = cat_vtoc[0x01]
@@ -127,7 +257,38 @@ class DiskDos33(Disk):
         except:
             raise DiskfileError(self._diskname, 'cannot read VTOC, not a DOS disk !!!')
 
-    def catalog(self):
+    def _written(self):
+        # The VTOC can have been changed
+        self._free_map = None
+
+    def read_free_map(self):
+        # Bitmap of the free sectors from the VTOC ($38-$FF)
+        # a unit is track * sector_per_track + sector
+        if self._free_map is None:
+            vtoc = self.read_ts(self._vtoc_track, self._vtoc_sector)
+            self._free_map = dos_bitmap(vtoc, self._total_tracks, self._sector_per_track)
+        return self._free_map
+
+    def free_sectors(self):
+        # Number of free sectors, without reading the catalog
+        return self.read_free_map().count()
+
+    def is_free(self, track, sector):
+        return self.read_free_map().is_set(track * self._sector_per_track + sector)
+
+    def free_extents(self, track=None):
+        # List of (track, first sector, number of sectors) for each
+        # run of free sectors (of one track, or of all the tracks)
+        free_map = self.read_free_map()
+        tracks = range(self._total_tracks) if track is None else [track]
+        extents = []
+        for track in tracks:
+            start = track * self._sector_per_track
+            for first, count in free_map.iter_runs(start, start + self._sector_per_track):
+                extents.append((track, first - start, count))
+        return extents
+
+    def iter_catalog(self):
         """
             00 01 02 03 04 05 06 07 08 09 0A 0B 0C 0D 0E 0F
             -- -- -- -- -- -- -- -- -- -- -- -- -- -- -- --
@@ -153,24 +314,30 @@ class DiskDos33(Disk):
         F0: 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00  ................
         """
 
+        # Walk the catalog sectors and yield a CatalogEntry for each
+        # file (live or deleted), the entries never used are skipped.
+        # Nothing more is read when the caller stops iterating.
+
         # Get the first track and sector of our catalog
         next_track = self._first_catalog_track
         next_sector = self._first_catalog_sector
 
-        # Create a new dictionnary of all the programs
-        dict_program = {}
-        dict_index = 0
-
-        # Set total size of the programs
-        total_used_sector = 0
-
-        # Each filename has a length of 30 characters
-        size_of_file = 0x23
+        # Keep the catalog sectors already read to stop on a damaged
+        # catalog pointing to one of its previous sectors
+        visited = set()
 
         # Get the filenames from each sector and set the next sector
         while next_sector != 0x00:
+            if (next_track, next_sector) in visited:
+                raise DiskfileError(self._diskname, 'has a loop in its catalog at T${:02X} S${:02X}'.format(
+                    next_track, next_sector))
+            visited.add((next_track, next_sector))
+
             # Get a list from read_ts method
             cat_sector = self.read_ts(next_track, next_sector)
+            if cat_sector is None:
+                raise DiskfileError(self._diskname, 'has a catalog sector out of the disk at T${:02X} S${:02X}'.format(
+                    next_track, next_sector))
 
             # we only need the next sector, but maybe the track has been changed
             next_track = cat_sector[1]
@@ -181,85 +348,142 @@ class DiskDos33(Disk):
                 # Extract each part where are the filenames
                 # We start at offset $0B for the first
                 # and we add the size of each filename
-                index = 0x0B + (index_file * size_of_file)
-                # Get info from File Descriptive Entry
-                fde = cat_sector[index:index + size_of_file + 1]  # .tolist()
-
-                # Get info about the file:
-                # the first T/S list of the file
-                first_track_list_file = fde[0x00]
-                first_sector_list_file = fde[0x01]
-
-                type_file = fde[0x02]
-
-                # Extract the filename
-                filename = fde[0x03:0x21]
-
-                # and its length
-                file_length_low = fde[0x21]
-                file_length_high = fde[0x22]
-                file_length = (file_length_high << 8) + file_length_low
-
-                # Add the size to the total size if the file is not deleted
-                if first_track_list_file != 0xFF:
-                    total_used_sector += file_length
-                else:
-                    # If it's a deleted file, change the byte
-                    # at the 29th position to a space
-                    filename[29] = 0xA0  # $A0 = 160 (128 + 32)
-
-                # Generated the filename as a string from the list
-                # Convert to ascii, join the list to a string and strip it
-                fname = ''.join(self.byte2ascii(filename)).strip()
-
-                # Add the infos extracted to our dictionnary
-                dict_program[dict_index] = [fname, file_length, first_track_list_file, first_sector_list_file,
-                                            type_file]
-
-                # Increment our dictionnary index
-                dict_index += 1
-
-        # Display the header
-        print('DISK VOLUME {}'.format(self._disk_volume))
-        print('')
-
-        # Read the ITEMS of the dictionnary to display the catalog
-        for program in dict_program.items():
-            # DON'T USE program[0], it's the index
-            fname = program[1][0]
-            file_length = program[1][1]
-            first_track_list_file = program[1][2]
-            first_sector_list_file = program[1][3]
-            type_file = program[1][4]
-
-            if type_file == 0:
-                tfile = 'T'
-            elif type_file == 1:
-                tfile = 'I'
-            elif type_file == 2:
-                tfile = 'A'
-            elif type_file == 4:
-                tfile = 'B'
-            else:
-                tfile = type_file
-
-            # if file_length <> 0, show catalog
-            if file_length != 0:
-                # If Track of the current file is equal to $FF
-                if first_track_list_file == 0xFF:  # File is deleted
-                    # print('{:30} [deleted]'.format(fname))
-                    # print(' {} {:03d} {:30} [deleted]'.format(tfile, file_length, fname))
-                    print('>{} {:03d} {:<30s}<'.format(tfile, file_length, fname))
-                else:
-                    # print('{:30} {:3d} T:${:02X}({:02d}) S:{:02X}({:02d}) TYPE:{}'.format(
-                    #     fname, file_length, track_file, track_file, sector_file, sector_file, type_file
-                    # ))
-                    print(' {} {:03d} {:30}  [${:02X}:${:02X}]'.format(tfile, file_length, fname,
-                                                                       first_track_list_file, first_sector_list_file))
-
-        total_sectors = self._total_tracks * self._sector_per_track
-        total_free_sector = total_sectors - total_used_sector
-        # percent = total_used_sector / total_sectors
-        # print('--- Sectors Used: {} ({:.0%}) --- Free: {} ---'.format(total_used_sector, percent, total_free_sector))
-        print('')
-        print('Sectors free: {} '.format(total_free_sector))
+                index = 0x0B + (index_file * CATALOG_ENTRY_SIZE)
+
+                # $00: never used, so no file here
+                if cat_sector[index] != 0x00:
+                    yield CatalogEntry.from_fde(cat_sector[index:index + CATALOG_ENTRY_SIZE], self.byte2ascii)
+
+    def find_file(self, name):
+        # Return the entry of a file (not deleted) from its name,
+        # the catalog is only read until we find it
+        for entry in self.iter_catalog():
+            if entry.name == name and not entry.deleted:
+                return entry
+        return None
+
+    def iter_file_sectors(self, entry):
+        # Follow the track/sector lists of a file and yield each data
+        # sector, as read by read_ts (a view with the mmap storage).
+        # A sector never written (sparse file) is given as an empty
+        # sector, except at the end of the file.
+        zero_sector = memoryview(bytes(self._sector_size))
+        holes = 0
+
+        # Keep the T/S lists already read to stop on a damaged chain
+        visited = set()
+
+        track, sector = entry.track, entry.sector
+        while track != 0x00:
+            if (track, sector) in visited:
+                raise DiskfileError(self._diskname, 'has a loop in the T/S list of {} at T${:02X} S${:02X}'.format(
+                    entry.name, track, sector))
+            visited.add((track, sector))
+
+            ts_list = self.read_ts(track, sector)
+            if ts_list is None:
+                raise DiskfileError(self._diskname, 'has a T/S list of {} out of the disk at T${:02X} S${:02X}'.format(
+                    entry.name, track, sector))
+
+            for index in range(TS_LIST_FIRST_PAIR, len(ts_list) - 1, 2):
+                data_track = ts_list[index]
+                data_sector = ts_list[index + 1]
+
+                # Track $00 is never used for data
+                if data_track == 0x00:
+                    holes += 1
+                    continue
+
+                # There is data after the holes, so they are part of the file
+                for _ in range(holes):
+                    yield zero_sector
+                holes = 0
+
+                data = self.read_ts(data_track, data_sector)
+                if data is None:
+                    raise DiskfileError(self._diskname, 'has a sector of {} out of the disk at T${:02X} S${:02X}'.format(
+                        entry.name, data_track, data_sector))
+                yield data
+
+            # Next T/S list
+            track, sector = ts_list[1], ts_list[2]
+
+    def read_file_header(self, entry):
+        # Return (address, length) from the header of a file, only
+        # the first data sector is read. A value not stored in the
+        # file (address of a BASIC program, any TEXT file, ...) is None
+        if entry.file_type not in (FILE_TYPE_INTEGER, FILE_TYPE_APPLESOFT, FILE_TYPE_BINARY):
+            return None, None
+
+        data = next(self.iter_file_sectors(entry), None)
+        if data is None:
+            return None, None
+        if entry.file_type == FILE_TYPE_BINARY:
+            return data[0] + (data[1] << 8), data[2] + (data[3] << 8)
+        return None, data[0] + (data[1] << 8)
+
+    def iter_file(self, entry, raw=False):
+        # Yield the content of a file by chunks (slices of the sectors,
+        # so nothing is copied with the mmap storage):
+        # - TEXT: until the first $00
+        # - INTEGER, APPLESOFT, BINARY: only the length given by the header,
+        #   without the header itself
+        # - other types (or raw=True): all the sectors
+        sectors = self.iter_file_sectors(entry)
+        if raw:
+            yield from sectors
+            return
+
+        if entry.file_type == FILE_TYPE_TEXT:
+            for data in sectors:
+                match = TEXT_END.search(data)
+                if match:
+                    end = match.start()
+                    if end:
+                        yield data[:end]
+                    return
+                yield data
+            return
+
+        if entry.file_type not in (FILE_TYPE_INTEGER, FILE_TYPE_APPLESOFT, FILE_TYPE_BINARY):
+            yield from sectors
+            return
+
+        data = next(sectors, None)
+        if data is None:
+            return
+
+        # Size of the header and length of the file
+        if entry.file_type == FILE_TYPE_BINARY:
+            skip, remaining = 4, data[2] + (data[3] << 8)
+        else:
+            skip, remaining = 2, data[0] + (data[1] << 8)
+
+        data = data[skip:]
+        while remaining > 0:
+            chunk = data[:remaining]
+            if len(chunk):
+                yield chunk
+            remaining -= len(chunk)
+            if remaining > 0:
+                data = next(sectors, None)
+                # The file is shorter than its header says
+                if data is None:
+                    return
+
+    def read_file(self, entry, raw=False):
+        # The whole content of a file, see iter_file
+        return b''.join(self.iter_file(entry, raw))
+
+    def extract_file(self, entry, fileobj, raw=False):
+        # Write the content of a file in fileobj (opened in binary mode)
+        # and return how many bytes have been written
+        written = 0
+        for chunk in self.iter_file(entry, raw):
+            fileobj.write(chunk)
+            written += len(chunk)
+        return written
+
+    def catalog(self):
+        # Display the catalog, the free sectors are counted from the VTOC bitmap
+        print_catalog(self._disk_volume, self.iter_catalog(), self.free_sectors())
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Export of the catalogs in columnar files (for analytics)
+
+2 tables are written for a whole library:
+- images: one row per image, its format, the fields of the VTOC (DOS)
+  or of the volume directory header (ProDOS) and the free space
+- files:  one row per file (deleted DOS files too), its catalog entry
+  and, from the header of the file, its load address and length
+
+The load address and the length are the ones used by the system:
+- DOS 3.3: from the first data sector, address and length of a B file,
+  length of an A or I file (the others have none)
+- ProDOS: the AUX_TYPE of a BIN file is its address, the EOF of its
+  data fork its length
+
+The images are read by a pool of processes (see apple.batch), each one
+sends back its rows as tuples. The rows are kept by table and written
+ROW_GROUP_SIZE at once: one row group of a Parquet file (the columns
+are built by pyarrow from the whole group) or one writerows of a CSV
+file, so a big library costs little more than reading its images.
+
+Formats:
+- parquet: images.parquet and files.parquet, only if pyarrow is
+  installed (the default then)
+- csv:     images.csv and files.csv (the default without pyarrow), an
+  empty cell is a value not known
+- ndjson:  images.ndjson and files.ndjson, one JSON object per line
+"""
+from abc import ABC, abstractmethod
+import csv
+import json
+import os
+
+from apple.batch import run_batch, DEFAULT_CHUNKSIZE
+from apple.disk import DiskfileError, load_source, STORAGE_MMAP, \
+    SYSTEM_UNKNOWN, SYSTEM_DOS32, SYSTEM_DOS33, SYSTEM_PRODOS, SYSTEM_PASCAL
+from apple.dos import FILE_TYPE_BINARY, FILE_TYPE_INTEGER, FILE_TYPE_APPLESOFT
+from apple.probe import probe, open_disk, pascal_volume_name
+from apple.source import source_name, source_size
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.3'
+
+FORMAT_PARQUET = 'parquet'
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMATS = (FORMAT_PARQUET, FORMAT_CSV, FORMAT_NDJSON)
+
+# How many rows are written at once (a row group of a Parquet file)
+ROW_GROUP_SIZE = 128 * 1024
+
+# ProDOS file type of a binary file (its AUX_TYPE is the load address)
+PRODOS_TYPE_BINARY = 0x06
+
+# Columns of each table: (name, type), the types are 'string', 'int'
+# and 'bool', any value can be None
+IMAGE_COLUMNS = (
+    ('path', 'string'),
+    ('size', 'int'),
+    ('format', 'string'),
+    ('order', 'string'),
+    ('nibble', 'bool'),
+    ('volume', 'string'),
+    # DOS 3.3 / 3.2 (VTOC)
+    ('dos_release', 'int'),
+    ('first_catalog_track', 'int'),
+    ('first_catalog_sector', 'int'),
+    ('total_tracks', 'int'),
+    ('sector_per_track', 'int'),
+    ('sector_size', 'int'),
+    ('total_sectors', 'int'),
+    ('free_sectors', 'int'),
+    # ProDOS (volume directory header)
+    ('created', 'string'),
+    ('access', 'int'),
+    ('entry_length', 'int'),
+    ('entries_per_block', 'int'),
+    ('file_count', 'int'),
+    ('bit_map_pointer', 'int'),
+    ('total_blocks', 'int'),
+    ('free_blocks', 'int'),
+    ('files', 'int'),
+    ('error', 'string'),
+)
+
+FILE_COLUMNS = (
+    ('path', 'string'),
+    ('format', 'string'),
+    ('name', 'string'),
+    ('type', 'string'),
+    ('file_type', 'int'),
+    ('locked', 'bool'),
+    ('deleted', 'bool'),
+    ('load_address', 'int'),
+    ('file_length', 'int'),
+    # DOS 3.3 / 3.2: length in sectors, first T/S list sector
+    ('sectors', 'int'),
+    ('track', 'int'),
+    ('sector', 'int'),
+    # ProDOS
+    ('storage_type', 'int'),
+    ('key_pointer', 'int'),
+    ('blocks_used', 'int'),
+    ('eof', 'int'),
+    ('aux_type', 'int'),
+    ('created', 'string'),
+    ('modified', 'string'),
+    ('directory', 'bool'),
+)
+
+TABLES = (('images', IMAGE_COLUMNS), ('files', FILE_COLUMNS))
+
+# Position of each column in a row of the images
+_IMAGE_INDEX = {name: index for index, (name, kind) in enumerate(IMAGE_COLUMNS)}
+
+
+def default_format():
+    return FORMAT_PARQUET if pyarrow is not None else FORMAT_CSV
+
+
+def _row(columns, values):
+    # A tuple in the order of the columns (None if not in values)
+    return tuple(values.get(name) for name, kind in columns)
+
+
+def _dos_rows(dsk, image, files):
+    vtoc = dsk._vtoc
+    image.update(volume=str(dsk._disk_volume), dos_release=vtoc['dos_release'],
+                 first_catalog_track=vtoc['first_catalog_track'], first_catalog_sector=vtoc['first_catalog_sector'],
+                 total_tracks=vtoc['total_tracks'], sector_per_track=vtoc['sector_per_track'],
+                 sector_size=vtoc['sector_size'], total_sectors=dsk._total_tracks * dsk._sector_per_track,
+                 free_sectors=dsk.free_sectors())
+    for entry in dsk.iter_catalog():
+        values = {'path': image['path'], 'format': dsk.system, 'name': entry.name, 'type': entry.type_letter,
+                  'file_type': entry.file_type, 'locked': entry.locked, 'deleted': entry.deleted,
+                  'sectors': entry.length, 'track': entry.track, 'sector': entry.sector, 'directory': False}
+        # The header of a deleted file can be anything, it's not read
+        if not entry.deleted and entry.file_type in (FILE_TYPE_BINARY, FILE_TYPE_INTEGER, FILE_TYPE_APPLESOFT):
+            try:
+                values['load_address'], values['file_length'] = dsk.read_file_header(entry)
+            except DiskfileError:
+                pass
+        files.append(_row(FILE_COLUMNS, values))
+
+
+def _prodos_rows(dsk, image, files):
+    header = dsk.read_volume_header()
+    image.update(volume=header['name'], created=header['created'], access=header['access'],
+                 entry_length=header['entry_length'], entries_per_block=header['entries_per_block'],
+                 file_count=header['file_count'], bit_map_pointer=header['bit_map_pointer'],
+                 total_blocks=header['total_blocks'], free_blocks=dsk.free_blocks())
+    for entry in dsk.iter_files():
+        values = {'path': image['path'], 'format': dsk.system, 'name': entry.path, 'type': entry.type_name,
+                  'file_type': entry.file_type, 'locked': entry.locked, 'deleted': False,
+                  'storage_type': entry.storage_type, 'key_pointer': entry.key_pointer,
+                  'blocks_used': entry.blocks_used, 'eof': entry.eof, 'aux_type': entry.aux_type,
+                  'created': entry.created, 'modified': entry.modified, 'directory': entry.is_directory}
+        if not entry.is_directory:
+            # The length of the data fork (the EOF of an extended file
+            # is the one of its key block)
+            try:
+                values['file_length'] = dsk.data_fork(entry)[2]
+            except DiskfileError:
+                pass
+            if entry.file_type == PRODOS_TYPE_BINARY:
+                values['load_address'] = entry.aux_type
+        files.append(_row(FILE_COLUMNS, values))
+
+
+def export_image(diskname, storage=STORAGE_MMAP):
+    # The rows of an image: (image row, [file rows]), an error is kept
+    # in the image row, with the files read before it
+    image = {'path': diskname}
+    files = []
+    try:
+        image['size'] = source_size(diskname)
+        source = load_source(diskname)
+        result = probe(source)
+        if result.system == SYSTEM_UNKNOWN:
+            raise DiskfileError(source_name(source), 'is not a DOS, ProDOS or Pascal disk')
+        with open_disk(source, storage, result) as dsk:
+            image.update(format=dsk.system, order=dsk.order, nibble=bool(dsk._nibble_track_size))
+            if dsk.system in (SYSTEM_DOS33, SYSTEM_DOS32):
+                _dos_rows(dsk, image, files)
+            elif dsk.system == SYSTEM_PRODOS:
+                _prodos_rows(dsk, image, files)
+            elif dsk.system == SYSTEM_PASCAL:
+                image['volume'] = pascal_volume_name(dsk)
+    except DiskfileError as error:
+        image['error'] = str(error)
+    except Exception as error:
+        # A damaged image can fail anywhere in the parsing
+        image['error'] = '{}: {}'.format(type(error).__name__, error)
+    image['files'] = len(files)
+    return _row(IMAGE_COLUMNS, image), files
+
+
+class _TableWriter(ABC):
+    # Rows of one table, written by groups of row_group_size rows
+    # Each format writes a group with _write
+    extension = None
+
+    def __init__(self, filename, columns, row_group_size):
+        self.filename = filename
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self._pending = []
+
+    def add(self, rows):
+        self._pending.extend(rows)
+        # Only full groups, the last one is written by close
+        while len(self._pending) >= self.row_group_size:
+            group = self._pending[:self.row_group_size]
+            del self._pending[:self.row_group_size]
+            self._write(group)
+            self.rows += len(group)
+
+    def close(self):
+        if self._pending:
+            self._write(self._pending)
+            self.rows += len(self._pending)
+            self._pending = []
+
+    @abstractmethod
+    def _write(self, rows):
+        pass
+
+
+class _CsvWriter(_TableWriter):
+    extension = '.csv'
+
+    def __init__(self, filename, columns, row_group_size):
+        _TableWriter.__init__(self, filename, columns, row_group_size)
+        self._file = open(filename, 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([name for name, kind in columns])
+
+    def _write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        _TableWriter.close(self)
+        self._file.close()
+
+
+class _NdjsonWriter(_TableWriter):
+    extension = '.ndjson'
+
+    def __init__(self, filename, columns, row_group_size):
+        _TableWriter.__init__(self, filename, columns, row_group_size)
+        self._file = open(filename, 'w', encoding='utf-8')
+        self._names = [name for name, kind in columns]
+
+    def _write(self, rows):
+        # The values not known are not written
+        self._file.write(''.join(json.dumps({name: value for name, value in zip(self._names, row)
+                                             if value is not None}) + '\n' for row in rows))
+
+    def close(self):
+        _TableWriter.close(self)
+        self._file.close()
+
+
+class _ParquetWriter(_TableWriter):
+    extension = '.parquet'
+
+    def __init__(self, filename, columns, row_group_size):
+        _TableWriter.__init__(self, filename, columns, row_group_size)
+        types = {'string': pyarrow.string(), 'int': pyarrow.int64(), 'bool': pyarrow.bool_()}
+        self._schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(filename, self._schema)
+
+    def _write(self, rows):
+        # One row group: the columns are built from the whole group
+        arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), self._schema)]
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema),
+                                 row_group_size=len(rows))
+
+    def close(self):
+        _TableWriter.close(self)
+        self._writer.close()
+
+
+_WRITERS = {FORMAT_PARQUET: _ParquetWriter, FORMAT_CSV: _CsvWriter, FORMAT_NDJSON: _NdjsonWriter}
+
+
+class Exporter:
+    def __init__(self, destination, export_format=None, row_group_size=ROW_GROUP_SIZE):
+        export_format = export_format or default_format()
+        if export_format not in FORMATS:
+            raise ValueError('unknown format {}, use one of {}'.format(export_format, ', '.join(FORMATS)))
+        if export_format == FORMAT_PARQUET and pyarrow is None:
+            raise ValueError('the parquet format needs pyarrow (pip install pyarrow)')
+        self.format = export_format
+        os.makedirs(destination, exist_ok=True)
+        writer = _WRITERS[export_format]
+        self.tables = {}
+        for name, columns in TABLES:
+            self.tables[name] = writer(os.path.join(destination, name + writer.extension), columns, row_group_size)
+
+    def add(self, image_row, file_rows):
+        self.tables['images'].add((image_row,))
+        self.tables['files'].add(file_rows)
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def export_images(exporter, images, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Export all the images and yield one summary per image (path,
+    # size, files and error)
+    for image_row, file_rows in run_batch(export_image, images, workers, chunksize):
+        exporter.add(image_row, file_rows)
+        summary = {'path': image_row[_IMAGE_INDEX['path']], 'size': image_row[_IMAGE_INDEX['size']] or 0,
+                   'files': len(file_rows)}
+        if image_row[_IMAGE_INDEX['error']] is not None:
+            summary['error'] = image_row[_IMAGE_INDEX['error']]
+        yield summary
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Integrity of a DOS 3.3 disk
+
+The whole disk is checked in one pass over the catalog: each T/S list
+(of the live and the deleted files) is followed once, and the owner
+of each sector is written in an ownership map, an array('H') indexed
+by track * sectors per track + sector:
+- OWNER_NONE: nobody uses the sector
+- OWNER_DOS: the DOS itself (tracks 0 to 2), the VTOC and the catalog
+- FIRST_FILE + n: the file n of the catalog (live or deleted)
+
+The live files are written first, then the deleted files take the
+sectors nobody uses. The map is then compared with the VTOC bitmap
+with operations on whole byte strings (one byte per sector), so there
+is no Python object for each sector of the disk:
+- orphaned: allocated in the bitmap but nobody uses them
+- free but used: used by the DOS or a live file but free in the bitmap
+- cross-linked: used by 2 files (or a file and the DOS)
+- deleted files: recoverable if none of their sectors has been used
+  again (allocated or used by another file)
+"""
+from array import array
+from itertools import compress
+
+from apple.batch import run_batch, DEFAULT_CHUNKSIZE
+from apple.disk import DiskfileError, STORAGE_MMAP
+from apple.dos import DiskDos33, CatalogEntry, CATALOG_ENTRY_SIZE, TS_LIST_FIRST_PAIR
+from apple.probe import open_disk
+from apple.source import source_size
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+OWNER_NONE = 0
+OWNER_DOS = 1
+FIRST_FILE = 2
+
+# The DOS is on the first 3 tracks (when they are allocated)
+DOS_TRACKS = 3
+
+
+class Ownership:
+    """Owner of each sector of a DOS disk
+
+    owners:         array('H') of the owner of each sector
+    used:           one byte for each sector, 1 if used by the DOS or
+                    a live file (the deleted files are not in it)
+    files:          CatalogEntry of each file (owner FIRST_FILE + index)
+    cross_links:    {sector: [owners]} for the sectors used twice
+    damaged:        {file index: error} for the T/S lists not complete
+    deleted_units:  {file index: sectors of the deleted file}
+    """
+
+    def __init__(self, sector_per_track, total_sectors):
+        self.sector_per_track = sector_per_track
+        self.owners = array('H', bytes(2 * total_sectors))
+        self.used = bytearray(total_sectors)
+        self.files = []
+        self.cross_links = {}
+        self.damaged = {}
+        self.deleted_units = {}
+
+    def owner_name(self, owner):
+        if owner == OWNER_NONE:
+            return None
+        if owner == OWNER_DOS:
+            return 'DOS'
+        return self.files[owner - FIRST_FILE].name
+
+    def owner_of(self, track, sector):
+        # Name of the file using a sector ('DOS', or None)
+        return self.owner_name(self.owners[track * self.sector_per_track + sector])
+
+    def claim(self, units, owner):
+        # Give the sectors to an owner, the sectors already used
+        # by someone else are cross-linked
+        owners = self.owners
+        used = self.used
+        for unit in units:
+            previous = owners[unit]
+            used[unit] = 1
+            if previous == OWNER_NONE:
+                owners[unit] = owner
+            elif previous != owner:
+                self.cross_links.setdefault(unit, [previous]).append(owner)
+
+
+def _ts_units(dsk, track, sector, tracks, sector_per_track):
+    # Follow the T/S lists from track/sector and return the sectors of
+    # the file (T/S lists and data, in an array) and an error (or None)
+    units = array('H')
+    visited = set()
+    while track != 0x00:
+        if track >= tracks or sector >= sector_per_track:
+            return units, 'T/S list out of the disk at T${:02X} S${:02X}'.format(track, sector)
+        unit = track * sector_per_track + sector
+        if unit in visited:
+            return units, 'loop in the T/S list at T${:02X} S${:02X}'.format(track, sector)
+        visited.add(unit)
+        units.append(unit)
+
+        ts_list = bytes(dsk.read_ts(track, sector))
+        pairs = ts_list[TS_LIST_FIRST_PAIR:]
+        data_tracks, data_sectors = pairs[0::2], pairs[1::2]
+        # Track $00: a sector never written, the others are checked
+        # and converted all at once
+        if max(data_tracks) >= tracks or max(compress(data_sectors, data_tracks), default=0) >= sector_per_track:
+            return units, 'sector out of the disk in the T/S list at T${:02X} S${:02X}'.format(track, sector)
+        units.extend(compress(map(int.__add__, map(sector_per_track.__mul__, data_tracks), data_sectors),
+                              data_tracks))
+        track, sector = ts_list[1], ts_list[2]
+    return units, None
+
+
+def _catalog(dsk, tracks, sector_per_track):
+    # Walk the catalog without stopping on a damaged one
+    # Return the entries, the sectors of the catalog and an error
+    entries = []
+    units = []
+    visited = set()
+    track, sector = dsk._first_catalog_track, dsk._first_catalog_sector
+    while sector != 0x00:
+        if track >= tracks or sector >= sector_per_track:
+            return entries, units, 'catalog sector out of the disk at T${:02X} S${:02X}'.format(track, sector)
+        unit = track * sector_per_track + sector
+        if unit in visited:
+            return entries, units, 'loop in the catalog at T${:02X} S${:02X}'.format(track, sector)
+        visited.add(unit)
+        units.append(unit)
+
+        catalog = dsk.read_ts(track, sector)
+        for index in range(0x0B, 0x0B + 7 * CATALOG_ENTRY_SIZE, CATALOG_ENTRY_SIZE):
+            if catalog[index] != 0x00:
+                entries.append(CatalogEntry.from_fde(catalog[index:index + CATALOG_ENTRY_SIZE], dsk.byte2ascii))
+        track, sector = catalog[1], catalog[2]
+    return entries, units, None
+
+
+def build_ownership(dsk):
+    # Ownership map of a DiskDos33 (see Ownership)
+    # Return the map and the error of the catalog (or None)
+    tracks, sector_per_track = dsk._total_tracks, dsk._sector_per_track
+    ownership = Ownership(sector_per_track, tracks * sector_per_track)
+    free = dsk.read_free_map()
+
+    # The DOS: its tracks (if they are allocated), the VTOC and the catalog
+    dos_units = [unit for unit in range(DOS_TRACKS * sector_per_track) if not free.is_set(unit)]
+    dos_units.append(dsk._vtoc_track * sector_per_track + dsk._vtoc_sector)
+    entries, catalog_units, catalog_error = _catalog(dsk, tracks, sector_per_track)
+    ownership.claim(dos_units + catalog_units, OWNER_DOS)
+    ownership.files = entries
+
+    # The live files first, so the deleted files only get the sectors left
+    for index, entry in sorted(enumerate(entries), key=lambda item: item[1].deleted):
+        track = entry.track
+        if entry.deleted and track >= tracks:
+            ownership.damaged[index] = 'original track unknown'
+            ownership.deleted_units[index] = array('H')
+            continue
+        units, error = _ts_units(dsk, track, entry.sector, tracks, sector_per_track)
+        if error:
+            ownership.damaged[index] = error
+        if entry.deleted:
+            ownership.deleted_units[index] = units
+            # Only the sectors nobody uses
+            owners = ownership.owners
+            for unit in units:
+                if owners[unit] == OWNER_NONE:
+                    owners[unit] = FIRST_FILE + index
+        else:
+            ownership.claim(units, FIRST_FILE + index)
+    return ownership, catalog_error
+
+
+def _flags(units):
+    # Yield the index of each byte 1 of a units string
+    position = units.find(1)
+    while position >= 0:
+        yield position
+        position = units.find(1, position + 1)
+
+
+def check_dos(dsk):
+    # Check a DiskDos33, return a report (a dictionnary for JSON)
+    ownership, catalog_error = build_ownership(dsk)
+    sector_per_track = dsk._sector_per_track
+    total = len(ownership.owners)
+    free = dsk.read_free_map().units()
+    used = bytes(ownership.used)
+
+    # Compare the maps as big integers (each byte is 0 or 1)
+    ones = int.from_bytes(b'\x01' * total, 'big')
+    free_value = int.from_bytes(free, 'big')
+    used_value = int.from_bytes(used, 'big')
+    orphaned = ((free_value | used_value) ^ ones).to_bytes(total, 'big')
+    free_but_used = (free_value & used_value).to_bytes(total, 'big')
+
+    def sectors(units):
+        return [list(divmod(unit, sector_per_track)) for unit in units]
+
+    deleted = []
+    for index, units in sorted(ownership.deleted_units.items()):
+        entry = ownership.files[index]
+        # A sector used again by the DOS, a live file or another deleted
+        # file (still allocated but used by nobody: it's only orphaned)
+        owner = FIRST_FILE + index
+        overwritten = sum(1 for unit in units if ownership.owners[unit] != owner)
+        deleted.append({
+            'name': entry.name,
+            'type': entry.type_letter,
+            'track': entry.track,
+            'sector': entry.sector,
+            'sectors': len(units),
+            'overwritten': overwritten,
+            'recoverable': bool(units) and not overwritten and index not in ownership.damaged,
+        })
+
+    report = {
+        'total_sectors': total,
+        'free_sectors': sum(free),
+        'used_sectors': sum(used),
+        'files': sum(1 for entry in ownership.files if not entry.deleted),
+        'deleted': deleted,
+        'orphaned': sectors(_flags(orphaned)),
+        'free_but_used': sectors(_flags(free_but_used)),
+        'cross_linked': [{'track': unit // sector_per_track, 'sector': unit % sector_per_track,
+                          'owners': [ownership.owner_name(owner) for owner in owners]}
+                         for unit, owners in sorted(ownership.cross_links.items())],
+        'damaged': [{'name': ownership.files[index].name, 'error': error}
+                    for index, error in sorted(ownership.damaged.items())],
+    }
+    if catalog_error:
+        report['catalog_error'] = catalog_error
+    return report
+
+
+def check_image(diskname):
+    # Check one image for a batch, any error is kept in the result
+    result = {'path': diskname}
+    try:
+        result['size'] = source_size(diskname)
+        with open_disk(diskname, STORAGE_MMAP) as dsk:
+            if not isinstance(dsk, DiskDos33):
+                raise DiskfileError(diskname, 'is not a DOS disk')
+            result.update(check_dos(dsk))
+    except DiskfileError as error:
+        result['error'] = str(error)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+def check_images(images, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Check all the images and yield one report per image
+    return run_batch(check_image, images, workers, chunksize)
@@ -1,21 +1,35 @@
 # -*- coding: utf-8 -*-
 """
 Some helpers
+
+The hexa dump is streamed: the data is converted by chunks with
+bytes.hex and bytes.translate, and each row is given to a writer
+(sys.stdout.write by default) as soon as it is formatted, so we can
+dump a whole disk without keeping it in memory.
 """
+from collections import OrderedDict
+import sys
+import threading
 
 __author__ = 'Nicolas Djurovic'
-__version__ = '0.2'
+__version__ = '0.7'
 
 BYTES_TO_DISPLAY = 16
 
+# How many bytes are converted at once by the dump
+DUMP_CHUNK_SIZE = 4096
+
+# Apple ASCII of each byte value:
+# - from $20 to $7E, the ascii code itself
+# - from $A0 to $FE, substract $80 to go back between $20 to $7E
+# - everything else is displayed as a '.'
+ASCII_TABLE = bytes(char if 32 <= char < 127 else
+                    char - 128 if 160 <= char < 255 else
+                    ord('.') for char in range(256))
+
 
 def int2ascii(char):
-    if char in range(32, 127):  # Check from ascii code $20 to $7E
-        return chr(char)
-    elif char in range(160, 255):  # if between $A0 to $FE
-        return chr(char - 128)  # Substract $80 to go back between $20 to $7E
-    else:
-        return '.'
+    return chr(ASCII_TABLE[char])
 
 
 def split_array(arraylist, size):
@@ -23,25 +37,13 @@ def split_array(arraylist, size):
 
 
 def generate(arraylist, size):
-    header = [' ' * 5]
-    for i in range(size):
-        header.append('{:02X} '.format(i))
-    header = ''.join(header)
-
-    hexa_list = []
-    for char in arraylist:
-        hexa_list.append("{:02X}".format(char))
-    hexa_list = ' '.join(hexa_list)
-
-    char_list = []
-    for char in arraylist:
-        char_list.append(int2ascii(char))
-    char_list = ''.join(char_list)
-
-    result_list = split_array(hexa_list, size * 2 + size)
-    result_char = split_array(char_list, size)
-
-    return header, result_list, result_char
+    # The whole dump at once: (header, hexa rows, ascii rows), see
+    # iter_dump_rows to stream it
+    header = ' ' * 5 + ''.join('{:02X} '.format(i) for i in range(size))
+    data = bytes(arraylist)
+    hexa_list = data.hex(' ').upper()
+    char_list = data.translate(ASCII_TABLE).decode('ascii')
+    return header, split_array(hexa_list, size * 2 + size), split_array(char_list, size)
 
 
 def generate_header(value):
@@ -50,6 +52,28 @@ def generate_header(value):
     return list_header, list_byte, list_text
 
 
+def dump_header(size=BYTES_TO_DISPLAY):
+    # '     00 01 02 ... 0F'
+    return ' ' * 5 + ' '.join('{:02X}'.format(i) for i in range(size))
+
+
+def iter_dump_rows(data, start=0, size=BYTES_TO_DISPLAY):
+    # Yield each row of the dump: offset, hexa values and ascii
+    # width: size * 2 + size - 1 to remove the last space
+    width = size * 3 - 1
+    view = memoryview(data)
+    # The chunks are a multiple of the row size
+    chunk_size = DUMP_CHUNK_SIZE - DUMP_CHUNK_SIZE % size
+    for chunk_start in range(0, len(view), chunk_size):
+        chunk = view[chunk_start:chunk_start + chunk_size].tobytes()
+        # 3 characters for each byte: 2 digits and a space
+        hexa = chunk.hex(' ').upper()
+        text = chunk.translate(ASCII_TABLE).decode('ascii')
+        for index in range(0, len(chunk), size):
+            yield '{:04X}:{:<{width}}  {}'.format(start + chunk_start + index, hexa[index * 3:index * 3 + width],
+                                                  text[index:index + size], width=width)
+
+
 def dump_display(list_byte, list_text):
     for index, (byte_row, text_row) in enumerate(zip(list_byte, list_text)):
         # width: __BYTES_TO_DISPLAY * 2 + __BYTES_TO_DISPLAY is the same value in function 'generate'
@@ -58,15 +82,103 @@ def dump_display(list_byte, list_text):
                                               width=(BYTES_TO_DISPLAY * 3) - 1))
 
 
-def dump_dos(value, track, sector):
-    list_header, list_byte, list_text = generate_header(value)
-    print('{}  T${:02X} S${:02X}'.format(list_header.rstrip(), track, sector))
-    print()
-    dump_display(list_byte, list_text)
-
-
-def dump_prodos(value, block):
-    list_header, list_byte, list_text = generate_header(value)
-    print('{}  BLOCK ${:02X}'.format(list_header.rstrip(), block))
-    print()
-    dump_display(list_byte, list_text)
+def dump_rows(data, writer=None):
+    # Write the rows of the dump as soon as they are formatted
+    if writer is None:
+        writer = sys.stdout.write
+    for row in iter_dump_rows(data):
+        writer(row + '\n')
+
+
+def dump_dos(value, track, sector, writer=None):
+    if writer is None:
+        writer = sys.stdout.write
+    writer('{}  T${:02X} S${:02X}\n\n'.format(dump_header(), track, sector))
+    dump_rows(value, writer)
+
+
+def dump_prodos(value, block, writer=None):
+    if writer is None:
+        writer = sys.stdout.write
+    writer('{}  BLOCK ${:02X}\n\n'.format(dump_header(), block))
+    dump_rows(value, writer)
+
+
+def dump_tracks(dsk, writer=None):
+    # Dump the whole disk, one track at a time
+    # so only one track is in memory
+    if writer is None:
+        writer = sys.stdout.write
+    for track in range(dsk._total_tracks):
+        if track:
+            writer('\n')
+        dump_dos(dsk.read_ts(track, None), track, 0, writer)
+
+
+class LRUCache:
+    # A bounded cache keeping the values most recently used
+    # maxsize is a number of values, or the total weight of the
+    # values when a sizeof function (weight of one value) is given
+    # It can be used by many threads (a lock protects the values)
+    def __init__(self, maxsize, sizeof=None):
+        self.maxsize = maxsize
+        self._sizeof = sizeof
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def _weight(self, value):
+        return self._sizeof(value) if self._sizeof else 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._values[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._values.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        # Add a value and return the list of (key, value) removed
+        # to stay under maxsize (the oldest ones first)
+        with self._lock:
+            if key in self._values:
+                self.size -= self._weight(self._values.pop(key))
+            self._values[key] = value
+            self.size += self._weight(value)
+
+            evicted = []
+            while self.size > self.maxsize and len(self._values) > 1:
+                old_key, old_value = self._values.popitem(last=False)
+                self.size -= self._weight(old_value)
+                evicted.append((old_key, old_value))
+            return evicted
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._values:
+                return default
+            value = self._values.pop(key)
+            self.size -= self._weight(value)
+            return value
+
+    def items(self):
+        # (key, value) from the oldest to the most recently used
+        with self._lock:
+            return list(self._values.items())
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.size = 0
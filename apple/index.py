@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite index of the images of a library, updated incrementally
+
+The base of the indexes of apple.dedup, apple.similar and apple.search:
+each one keeps a table of the images indexed (path, size and date of
+the file, the zip file for a member) with its own tables of what was
+read in them.
+
+The index is updated incrementally (update_images): an image already
+indexed is read again only if its file changed (size or modification
+time), and prune removes the images which are not there anymore. The
+images are read by a pool of processes (see apple.batch), only this
+process writes in the database.
+"""
+from abc import ABC, abstractmethod
+import os
+import sqlite3
+
+from apple.batch import run_batch, DEFAULT_CHUNKSIZE
+from apple.cache import cache_directory
+from apple.source import container_path
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+
+def image_stamp(diskname):
+    # Size and modification time of the file of an image
+    stat = os.stat(container_path(diskname))
+    return stat.st_size, stat.st_mtime_ns
+
+
+class ImageIndex(ABC):
+    # Each index gives:
+    #   filename:   name of its database in the cache directory
+    #   schema:     its tables, table (id, path, size, mtime, ...) for the images
+    #   table:      name of the table of the images
+    #   _remove:    remove an image (its id) and what was read in it
+    #   add:        add (or replace) an image from the result of a worker
+    filename = None
+    schema = None
+    table = 'images'
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_directory(), self.filename)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(self.schema)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stamps(self):
+        # {path: (size, mtime)} of all the images indexed
+        return {path: (size, mtime) for path, size, mtime in
+                self._connection.execute('SELECT path, size, mtime FROM {}'.format(self.table))}
+
+    def _image_id(self, path):
+        row = self._connection.execute('SELECT id FROM {} WHERE path = ?'.format(self.table), (path,)).fetchone()
+        return row[0] if row else None
+
+    @abstractmethod
+    def _remove(self, image):
+        pass
+
+    @abstractmethod
+    def add(self, result):
+        pass
+
+    def _remove_path(self, path):
+        # Remove an image (in a transaction) if it's indexed
+        image = self._image_id(path)
+        if image is not None:
+            self._remove(image)
+        return image is not None
+
+    def remove(self, path):
+        with self._connection:
+            return self._remove_path(path)
+
+    def prune(self):
+        # Remove the images which are not there anymore
+        removed = 0
+        for path in list(self.stamps()):
+            try:
+                os.stat(container_path(path))
+            except OSError:
+                removed += self.remove(path)
+        return removed
+
+
+def update_images(index, images, function, summarize, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Read the images not indexed yet (or changed) with function (in
+    # a worker) and add them to the index, yield one result per image:
+    # path, indexed and error, or what summarize(result) gives
+    stamps = index.stamps()
+    todo = []
+    for diskname in map(os.path.abspath, images):
+        try:
+            stamp = image_stamp(diskname)
+        except OSError:
+            stamp = None
+        if stamp is not None and stamps.get(diskname) == stamp:
+            yield {'path': diskname, 'indexed': False}
+        else:
+            todo.append(diskname)
+
+    for result in run_batch(function, todo, workers, chunksize):
+        summary = {'path': result['path'], 'indexed': 'error' not in result}
+        if 'error' in result:
+            summary['error'] = result['error']
+        else:
+            index.add(result)
+            summary.update(summarize(result))
+        yield summary
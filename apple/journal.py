@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Atomic writes of the dirty sectors of an image
+
+The sectors changed in a Disk (see Disk.write_ts) are written back to
+the file in 3 steps:
+1. all the changes are written in a journal next to the image
+   (<image>.adir-journal) and synced to the disk
+2. each run of contiguous sectors is written in place in the image
+   (os.pwrite), nothing else in the file is written
+3. the image is synced and the journal is removed
+
+If the process stops during step 2, the journal is still there and
+complete (its checksum is right), so it's applied again the next time
+the image is opened (replay_journal). A journal not complete means we
+stopped during step 1: the image was not changed, the journal is only
+removed.
+
+The image is locked (flock, not on Windows) during the 3 steps and
+while a journal is replayed: a process opening the image while another
+one writes it waits for the end of the write, it never takes the
+journal being written for one not complete.
+
+Journal format:
+    ADIRJNL1                            magic
+    position (8 bytes) length (4 bytes) for each run of sectors
+    data (length bytes)
+    END! + blake2b (16 bytes)           of everything before
+"""
+from contextlib import contextmanager
+from hashlib import blake2b
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the image is not locked
+    fcntl = None
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+JOURNAL_EXTENSION = '.adir-journal'
+JOURNAL_MAGIC = b'ADIRJNL1'
+JOURNAL_END = b'END!'
+RUN_HEADER = struct.Struct('<QI')
+DIGEST_SIZE = 16
+
+
+def journal_path(diskname):
+    return diskname + JOURNAL_EXTENSION
+
+
+def coalesce(changes):
+    # Join the (position, data) changes following each other in the
+    # file, so each run is written at once
+    runs = []
+    for position, data in sorted(changes, key=lambda change: change[0]):
+        if runs and runs[-1][0] + len(runs[-1][1]) == position:
+            runs[-1][1] += data
+        else:
+            runs.append([position, bytearray(data)])
+    return runs
+
+
+def _pwrite(fileobj, data, position):
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fileobj.fileno(), view, position)
+            view = view[written:]
+            position += written
+    else:
+        fileobj.seek(position)
+        fileobj.write(data)
+
+
+def _fsync_directory(path):
+    # Sync the directory, so the creation/removal of the journal is
+    # on the disk too (not available everywhere)
+    try:
+        descriptor = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+@contextmanager
+def _locked(diskname):
+    # The image opened for writing, locked until the end of the block
+    # (the lock is released when the file is closed)
+    with open(diskname, 'r+b') as diskfile:
+        if fcntl is not None:
+            fcntl.flock(diskfile.fileno(), fcntl.LOCK_EX)
+        yield diskfile
+
+
+def _apply(diskfile, runs):
+    for position, data in runs:
+        _pwrite(diskfile, data, position)
+    diskfile.flush()
+    os.fsync(diskfile.fileno())
+
+
+def write_changes(diskname, changes):
+    # Write the changes (position, data) in the image, atomically
+    # Return the number of bytes written in the image
+    runs = coalesce(changes)
+    if not runs:
+        return 0
+
+    digest = blake2b(digest_size=DIGEST_SIZE)
+    path = journal_path(diskname)
+    with _locked(diskname) as diskfile:
+        with open(path, 'wb') as journal:
+            def write(value):
+                digest.update(value)
+                journal.write(value)
+
+            write(JOURNAL_MAGIC)
+            for position, data in runs:
+                write(RUN_HEADER.pack(position, len(data)))
+                write(data)
+            journal.write(JOURNAL_END + digest.digest())
+            journal.flush()
+            os.fsync(journal.fileno())
+        _fsync_directory(path)
+
+        _apply(diskfile, runs)
+        os.remove(path)
+        _fsync_directory(path)
+    return sum(len(data) for position, data in runs)
+
+
+def read_journal(path):
+    # The runs of a complete journal, None if it's not complete
+    with open(path, 'rb') as journal:
+        content = journal.read()
+    body, trailer = content[:-(len(JOURNAL_END) + DIGEST_SIZE)], content[-(len(JOURNAL_END) + DIGEST_SIZE):]
+    if (not body.startswith(JOURNAL_MAGIC) or trailer[:len(JOURNAL_END)] != JOURNAL_END or
+            blake2b(body, digest_size=DIGEST_SIZE).digest() != trailer[len(JOURNAL_END):]):
+        return None
+
+    runs = []
+    offset = len(JOURNAL_MAGIC)
+    while offset < len(body):
+        position, length = RUN_HEADER.unpack_from(body, offset)
+        offset += RUN_HEADER.size
+        runs.append((position, body[offset:offset + length]))
+        offset += length
+    return runs
+
+
+def replay_journal(diskname):
+    # Finish (or forget) a write stopped before its end
+    # Return True if a journal has been applied to the image
+    path = journal_path(diskname)
+    if not os.path.exists(path):
+        return False
+    with _locked(diskname) as diskfile:
+        # Finished by the process writing it while we waited
+        if not os.path.exists(path):
+            return False
+        runs = read_journal(path)
+        if runs:
+            _apply(diskfile, runs)
+        os.remove(path)
+        _fsync_directory(path)
+    return bool(runs)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Nibble images (.nib)
+
+A .nib file keeps each track as it is read from the disk: 6656 bytes
+($1A00) per track (or 6384 bytes for some tools), with the sectors
+in any order and the track seen as a circle (a sector can start at
+the end of the track and finish at its beginning).
+
+Each sector is made of 2 fields:
+- Address field: D5 AA 96, volume, track, sector, checksum (each
+  value in 4&4 encoding: 2 bytes) and DE AA EB
+- Data field: D5 AA AD, 342 nibbles + 1 checksum nibble (6&2
+  encoding) and DE AA EB
+
+6&2 decoding (DOS 3.3 RWTS):
+- each nibble is translated to a 6 bits value
+- each value is XORed with the previous one (the running checksum)
+- the 86 first values hold the 2 low bits (swapped) of the 256 bytes:
+  bits 0-1 for bytes 0-85, bits 2-3 for bytes 86-171 and bits 4-5
+  for bytes 172-255
+- the 256 next values are the 6 high bits of the bytes
+
+The whole sector is decoded with translation tables and operations
+on big integers (one integer for the 342 values), so there is no
+Python loop on the bytes.
+
+The decoded tracks are kept in DOS order (like a .dsk), only when we
+read them for the first time. The address fields are checked (checksum
+and track number): a bad field raises DiskfileError.
+"""
+from apple.order import PHYSICAL_TO_DOS
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.3'
+
+# Size of a track in a .nib file
+NIB_TRACK_SIZE = 0x1A00
+NIB_TRACK_SIZE_6384 = 0x18F0
+
+SECTOR_SIZE = 256
+SECTORS_PER_TRACK = 16
+
+ADDRESS_PROLOGUE = b'\xD5\xAA\x96'
+DATA_PROLOGUE = b'\xD5\xAA\xAD'
+
+# The data field must start soon after its address field
+DATA_FIELD_SEARCH = 64
+
+# Number of nibbles in a data field (without the checksum)
+DATA_NIBBLES = 342
+AUX_NIBBLES = 86
+
+# 6 bits value -> disk byte
+WRITE_TABLE = bytes([
+    0x96, 0x97, 0x9A, 0x9B, 0x9D, 0x9E, 0x9F, 0xA6, 0xA7, 0xAB, 0xAC, 0xAD, 0xAE, 0xAF, 0xB2, 0xB3,
+    0xB4, 0xB5, 0xB6, 0xB7, 0xB9, 0xBA, 0xBB, 0xBC, 0xBD, 0xBE, 0xBF, 0xCB, 0xCD, 0xCE, 0xCF, 0xD3,
+    0xD6, 0xD7, 0xD9, 0xDA, 0xDB, 0xDC, 0xDD, 0xDE, 0xDF, 0xE5, 0xE6, 0xE7, 0xE9, 0xEA, 0xEB, 0xEC,
+    0xED, 0xEE, 0xEF, 0xF2, 0xF3, 0xF4, 0xF5, 0xF6, 0xF7, 0xF9, 0xFA, 0xFB, 0xFC, 0xFD, 0xFE, 0xFF,
+])
+
+# Disk byte -> 6 bits value, $80 for a byte which is not a valid nibble
+INVALID_NIBBLE = 0x80
+READ_TABLE = bytes(WRITE_TABLE.index(char) if char in WRITE_TABLE else INVALID_NIBBLE for char in range(256))
+
+# Auxiliary value -> 2 low bits (swapped back) for each third of the sector
+AUX_TABLES = [bytes((((value >> shift) & 1) << 1) | ((value >> (shift + 1)) & 1) for value in range(256))
+              for shift in (0, 2, 4)]
+
+_DATA_MASK = (1 << (DATA_NIBBLES * 8)) - 1
+
+
+def decode_44(first, second):
+    # 4&4 encoding: odd bits in the first byte, even bits in the second
+    return ((first << 1) | 1) & second
+
+
+def decode_62(nibbles):
+    # Decode the 343 nibbles of a data field to 256 bytes
+    # Return None if a nibble is not valid or the checksum is wrong
+    values = bytes(nibbles).translate(READ_TABLE)
+    if max(values) & INVALID_NIBBLE:
+        return None
+
+    # Running XOR of all the values (each byte with all the bytes
+    # before it), done on one integer: byte i is at bits 8*i
+    running = int.from_bytes(values[:DATA_NIBBLES], 'little')
+    shift = 8
+    while shift < DATA_NIBBLES * 8:
+        running ^= running << shift
+        shift <<= 1
+    decoded = (running & _DATA_MASK).to_bytes(DATA_NIBBLES, 'little')
+
+    # The checksum is the last value
+    if decoded[-1] != values[DATA_NIBBLES]:
+        return None
+
+    aux = decoded[:AUX_NIBBLES]
+    low_bits = aux.translate(AUX_TABLES[0]) + aux.translate(AUX_TABLES[1]) + \
+        aux[:SECTOR_SIZE - 2 * AUX_NIBBLES].translate(AUX_TABLES[2])
+
+    # The high bits are 6 bits values, shifting the whole integer
+    # by 2 stays inside each byte
+    high_bits = int.from_bytes(decoded[AUX_NIBBLES:], 'little') << 2
+    return (high_bits | int.from_bytes(low_bits, 'little')).to_bytes(SECTOR_SIZE, 'little')
+
+
+def decode_address(field, expected=None, diskname=None):
+    # Decode an address field (the 8 bytes after its prologue), return
+    # the physical sector. The checksum is volume ^ track ^ sector and
+    # the track must be the one we read (if expected is given)
+    # apple.disk imports this module, DiskfileError is imported here
+    from apple.disk import DiskfileError
+
+    volume, track, sector, checksum = (decode_44(field[index], field[index + 1]) for index in range(0, 8, 2))
+    if volume ^ track ^ sector != checksum:
+        raise DiskfileError(diskname, 'has a bad address field checksum (track {}, sector {})'.format(
+            track if expected is None else expected, sector))
+    if expected is not None and track != expected:
+        raise DiskfileError(diskname, 'has an address field of track {} in track {}'.format(track, expected))
+    return sector
+
+
+def decode_track(raw_track, expected=None, diskname=None):
+    # Decode all the sectors of one track, return the 4096 bytes of the
+    # track in DOS order and the list of the logical sectors not found
+    # expected is the number of the track (checked in its address fields)
+    raw_track = bytes(raw_track)
+    # The track is a circle, so a sector can continue at its beginning
+    circle = raw_track + raw_track[:DATA_FIELD_SEARCH + DATA_NIBBLES + 16]
+    track = bytearray(SECTOR_SIZE * SECTORS_PER_TRACK)
+    found = set()
+
+    position = circle.find(ADDRESS_PROLOGUE)
+    while 0 <= position < len(raw_track):
+        field = circle[position + 3:position + 11]
+        if len(field) == 8:
+            sector = decode_address(field, expected, diskname)
+            data = circle.find(DATA_PROLOGUE, position + 11, position + 11 + DATA_FIELD_SEARCH)
+            if data >= 0 and sector < SECTORS_PER_TRACK and sector not in found:
+                value = decode_62(circle[data + 3:data + 4 + DATA_NIBBLES])
+                if value is not None:
+                    logical = PHYSICAL_TO_DOS[sector] * SECTOR_SIZE
+                    track[logical:logical + SECTOR_SIZE] = value
+                    found.add(sector)
+        position = circle.find(ADDRESS_PROLOGUE, position + 3)
+
+    missing = [PHYSICAL_TO_DOS[sector] for sector in range(SECTORS_PER_TRACK) if sector not in found]
+    return bytes(track), missing
+
+
+def nibble_track_size(file_size):
+    # Size of a track if file_size is the size of a .nib file
+    # (35 or 40 tracks), else None
+    for track_size in (NIB_TRACK_SIZE, NIB_TRACK_SIZE_6384):
+        if file_size in (35 * track_size, 40 * track_size):
+            return track_size
+    return None
+
+
+class NibbleImage:
+    # A .nib seen as a sector image (DOS order): it can be sliced like
+    # the memdisk of a Disk, the tracks are decoded only when they are
+    # read for the first time and then kept
+    def __init__(self, raw, track_size=NIB_TRACK_SIZE, diskname=None):
+        self._raw = raw
+        self._diskname = diskname
+        self._track_size = track_size
+        self.total_tracks = len(raw) // track_size
+        self._tracks = {}
+        # Logical sectors not found (or bad) in each decoded track
+        self.bad_sectors = {}
+
+    def release(self):
+        # Release the raw image (a view on a mapped file)
+        if isinstance(self._raw, memoryview):
+            self._raw.release()
+
+    def __len__(self):
+        return self.total_tracks * SECTORS_PER_TRACK * SECTOR_SIZE
+
+    def track(self, track):
+        # The decoded track (bytes, 4096 bytes)
+        value = self._tracks.get(track)
+        if value is None:
+            position = track * self._track_size
+            value, missing = decode_track(self._raw[position:position + self._track_size], track,
+                                          self._diskname)
+            self._tracks[track] = value
+            if missing:
+                self.bad_sectors[track] = missing
+        return value
+
+    def __getitem__(self, index):
+        track_length = SECTORS_PER_TRACK * SECTOR_SIZE
+        if not isinstance(index, slice):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('NibbleImage index out of range')
+            return self.track(index // track_length)[index % track_length]
+
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError('NibbleImage slices must be contiguous')
+        if stop <= start:
+            return memoryview(b'')
+
+        # Inside one track, a view on the decoded track
+        first, last = start // track_length, (stop - 1) // track_length
+        if first == last:
+            return memoryview(self.track(first))[start % track_length:stop - first * track_length]
+        return memoryview(b''.join(memoryview(self.track(track))[
+                                   max(start - track * track_length, 0):stop - track * track_length]
+                                   for track in range(first, last + 1)))
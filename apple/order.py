@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Order of the sectors in a track
+
+The same 16 sectors of a track can be saved in 3 orders:
+- ORDER_DOS: DOS 3.3 logical order (.dsk, .do), the order used by
+  all the classes of this package
+- ORDER_PRODOS: ProDOS block order (.po), the 2 halves of each block
+  follow each other
+- ORDER_PHYSICAL: the order of the sectors on the disk (the sector
+  numbers of the address fields, like in a .nib)
+
+Each order has a table giving the position in a track of each DOS 3.3
+logical sector. The tables are computed once, so translating a sector
+is one list lookup, and nothing at all when the image is already in
+DOS order (sector_map returns None).
+
+A whole image is converted from one order to another in one pass:
+the permutation of all its sectors is computed first, then the
+sectors are joined in a new buffer (reorder_image).
+
+The order of an image without header is given by its extension
+(extension_order): .po and .hdv are in ProDOS order, all the others
+in DOS order.
+"""
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+ORDER_DOS = 'dos'
+ORDER_PRODOS = 'prodos'
+ORDER_PHYSICAL = 'physical'
+ORDERS = (ORDER_DOS, ORDER_PRODOS, ORDER_PHYSICAL)
+
+# Extensions of the images in ProDOS order
+PRODOS_ORDER_EXTENSIONS = ('.po', '.hdv')
+
+SECTOR_SIZE = 256
+SECTORS_PER_TRACK = 16
+
+# Position in a track of each DOS 3.3 logical sector, for each order
+# (ProDOS: the table is its own inverse, so it also gives the DOS 3.3
+# sector of each half block of a track)
+DOS_TO_DOS = list(range(SECTORS_PER_TRACK))
+DOS_TO_PRODOS = [0x0, 0xE, 0xD, 0xC, 0xB, 0xA, 0x9, 0x8, 0x7, 0x6, 0x5, 0x4, 0x3, 0x2, 0x1, 0xF]
+DOS_TO_PHYSICAL = [0x0, 0xD, 0xB, 0x9, 0x7, 0x5, 0x3, 0x1, 0xE, 0xC, 0xA, 0x8, 0x6, 0x4, 0x2, 0xF]
+PHYSICAL_TO_DOS = [DOS_TO_PHYSICAL.index(sector) for sector in range(SECTORS_PER_TRACK)]
+
+SECTOR_POSITIONS = {
+    ORDER_DOS: DOS_TO_DOS,
+    ORDER_PRODOS: DOS_TO_PRODOS,
+    ORDER_PHYSICAL: DOS_TO_PHYSICAL,
+}
+
+# DOS 3.3 sectors of the 2 halves of each block of a track
+# (Beneath Apple ProDOS, table 3.1)
+BLOCK_SECTORS = [(DOS_TO_PRODOS[half], DOS_TO_PRODOS[half + 1]) for half in range(0, SECTORS_PER_TRACK, 2)]
+
+
+def check_order(order):
+    if order not in ORDERS:
+        raise ValueError('Unknown sector order "{}"'.format(order))
+    return order
+
+
+def extension_order(extension):
+    # Order of an image from its extension (lower case, with the dot)
+    return ORDER_PRODOS if extension in PRODOS_ORDER_EXTENSIONS else ORDER_DOS
+
+
+def sector_map(order):
+    # Table of the positions of the DOS 3.3 sectors in a track of an
+    # image in this order, None for the DOS order (nothing to translate)
+    check_order(order)
+    if order == ORDER_DOS:
+        return None
+    return SECTOR_POSITIONS[order]
+
+
+def translation(source, destination):
+    # Position in a track of the source of each sector of a track in the
+    # destination order: destination sector n is source sector table[n]
+    source_positions = SECTOR_POSITIONS[check_order(source)]
+    destination_positions = SECTOR_POSITIONS[check_order(destination)]
+    table = [0] * SECTORS_PER_TRACK
+    for sector in range(SECTORS_PER_TRACK):
+        table[destination_positions[sector]] = source_positions[sector]
+    return table
+
+
+def image_permutation(total_sectors, source, destination):
+    # Index of the source sector of each sector of the image
+    # (a partial track at the end is kept as it is)
+    table = translation(source, destination)
+    whole = total_sectors - total_sectors % SECTORS_PER_TRACK
+    permutation = [track + sector for track in range(0, whole, SECTORS_PER_TRACK) for sector in table]
+    permutation.extend(range(whole, total_sectors))
+    return permutation
+
+
+def reorder_image(data, source, destination):
+    # Return the image data (16 sectors images) in another order,
+    # in a new bytes object. Only the sectors are moved, the bytes
+    # after the last complete sector are kept at the end
+    if source == destination:
+        check_order(source)
+        return bytes(data)
+    view = memoryview(data).cast('B')
+    total_sectors = len(view) // SECTOR_SIZE
+    sectors = [view[index:index + SECTOR_SIZE] for index in range(0, total_sectors * SECTOR_SIZE, SECTOR_SIZE)]
+    result = b''.join([sectors[index] for index in image_permutation(total_sectors, source, destination)] +
+                      [view[total_sectors * SECTOR_SIZE:]])
+    return result
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Paged images
+
+A big image (a ProDOS volume up to 32 MB) is not loaded at once: it's
+read by pages (64 KB) when a part of a page is needed, and only the
+pages used the most recently are kept (see LRUCache). Walking one
+directory of a volume only reads the pages of its blocks.
+
+A PagedImage can be sliced like the memdisk of a Disk. The pages
+written (see Disk.write_ts) are never removed from memory before the
+disk is flushed or closed.
+
+Many threads can read the same PagedImage: the pages are read with
+os.pread (or under a lock where it doesn't exist) and the cache of
+the pages has its own lock.
+"""
+import os
+import threading
+
+from apple.helpers import LRUCache
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+PAGE_SIZE = 64 * 1024
+
+# Maximum number of pages kept in memory (4 MB)
+MAX_PAGES = 64
+
+
+class PagedImage:
+    def __init__(self, diskname, offset, length, page_size=PAGE_SIZE, max_pages=MAX_PAGES):
+        self._diskname = diskname
+        self._offset = offset
+        self._length = length
+        self._page_size = page_size
+        self._pages = LRUCache(max_pages)
+        # Pages written, always kept
+        self._dirty_pages = {}
+        self._file = open(diskname, 'rb')
+        self._file_lock = threading.Lock()
+        self.reads = 0
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._pages.clear()
+        self._dirty_pages.clear()
+
+    def __len__(self):
+        return self._length
+
+    def _read(self, position, size):
+        self.reads += 1
+        if hasattr(os, 'pread'):
+            return os.pread(self._file.fileno(), size, position)
+        with self._file_lock:
+            self._file.seek(position)
+            return self._file.read(size)
+
+    def page(self, number):
+        value = self._dirty_pages.get(number)
+        if value is None:
+            value = self._pages.get(number)
+        if value is None:
+            start = number * self._page_size
+            value = bytearray(self._read(self._offset + start, min(self._page_size, self._length - start)))
+            self._pages.put(number, value)
+        return value
+
+    def _range(self, index):
+        start, stop, step = index.indices(self._length)
+        if step != 1:
+            raise ValueError('PagedImage slices must be contiguous')
+        return start, max(start, stop)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            if index < 0:
+                index += self._length
+            if not 0 <= index < self._length:
+                raise IndexError('PagedImage index out of range')
+            return self.page(index // self._page_size)[index % self._page_size]
+
+        start, stop = self._range(index)
+        first, last = start // self._page_size, (stop - 1) // self._page_size
+        if stop == start:
+            return memoryview(b'')
+        # Inside one page, a view on the page
+        if first == last:
+            offset = first * self._page_size
+            return memoryview(self.page(first)).toreadonly()[start - offset:stop - offset]
+        return memoryview(b''.join(memoryview(self.page(number))[max(start - number * self._page_size, 0):
+                                                                 stop - number * self._page_size]
+                                   for number in range(first, last + 1)))
+
+    def __setitem__(self, index, data):
+        start, stop = self._range(index)
+        data = memoryview(data).cast('B')
+        if stop - start != len(data):
+            raise ValueError('PagedImage cannot change its size')
+        position = start
+        while position < stop:
+            number, offset = divmod(position, self._page_size)
+            page = self.page(number)
+            self._dirty_pages[number] = page
+            self._pages.pop(number)
+            size = min(self._page_size - offset, stop - position)
+            page[offset:offset + size] = data[position - start:position - start + size]
+            position += size
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Find the operating system and the sector order of an image
+
+Only the few sectors needed to recognize a disk are read (with a
+mapped file, or the tracks 0 and $11 of a nibble image):
+- DOS 3.3 / 3.2: the VTOC (T$11 S$00) and the catalog sectors
+- ProDOS: the key block of the Volume Directory (block 2) and the
+  next one
+- Pascal: the directory (block 2)
+
+The VTOC is at the same place in both orders (sector 0 is not moved),
+so the order of a DOS disk is found by following the catalog: in the
+wrong order, the chain stops after one or two sectors. The blocks are
+read in both orders too. When both orders look right (a nearly empty
+catalog), the extension of the file decides (.po, .hdv: ProDOS order).
+The header of a 2IMG file (.2mg) gives the order, it's not searched.
+
+open_disk returns the right class for the disk (DiskDos33, DiskProdos
+or DiskBin) without parsing it twice (nor decompressing it twice, see
+apple.source).
+"""
+from apple.disk import DiskBin, load_source, STORAGE_ARRAY, STORAGE_MMAP, \
+    SYSTEM_UNKNOWN, SYSTEM_DOS33, SYSTEM_DOS32, SYSTEM_PRODOS, SYSTEM_PASCAL
+from apple.dos import DiskDos33, CATALOG_ENTRY_SIZE
+from apple.order import ORDER_DOS, ORDER_PRODOS, DOS_TO_PRODOS, BLOCK_SECTORS, extension_order
+from apple.prodos import DiskProdos, VOLUME_DIRECTORY_BLOCK
+from apple.source import source_name, image_extension
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.5'
+
+# Extensions of the images in ProDOS order
+# A DOS 3.3 catalog has 15 sectors, we never follow more than that
+MAX_CATALOG_SECTORS = 16
+
+# Characters not allowed in a Pascal volume name
+PASCAL_INVALID_CHARS = b'$=?/:[], '
+
+
+class ProbeResult:
+    __slots__ = ('system', 'order', 'sectors', 'tracks', 'nibble')
+
+    def __init__(self, system, order, sectors, tracks, nibble=False):
+        self.system = system
+        self.order = order
+        self.sectors = sectors
+        self.tracks = tracks
+        self.nibble = nibble
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return 'ProbeResult(system={!r}, order={!r}, sectors={}, tracks={}, nibble={})'.format(
+            self.system, self.order, self.sectors, self.tracks, self.nibble)
+
+
+def _read_sector(dsk, track, sector, order):
+    # Read a DOS 3.3 logical sector of an image in the given order
+    # (dsk is opened in DOS order, so we move the sector ourselves)
+    if order == ORDER_PRODOS:
+        sector = DOS_TO_PRODOS[sector]
+    return dsk.read_ts(track, sector)
+
+
+def _read_block(dsk, block, order):
+    # Read a ProDOS block (2 sectors) of a 16 sectors image
+    track, index = divmod(block, len(BLOCK_SECTORS))
+    first = _read_sector(dsk, track, BLOCK_SECTORS[index][0], order)
+    second = _read_sector(dsk, track, BLOCK_SECTORS[index][1], order)
+    if first is None or second is None:
+        return None
+    return bytes(first) + bytes(second)
+
+
+def _score_dos(dsk, order):
+    # Score of a DOS disk: 0 if the VTOC is not valid, else the
+    # number of catalog sectors and files found in the given order
+    vtoc = _read_sector(dsk, 0x11, 0x00, order)
+    if vtoc is None:
+        return 0
+    tracks, sectors = vtoc[0x34], vtoc[0x35]
+    sector_size = vtoc[0x36] + (vtoc[0x37] << 8)
+    # The same test as DiskDos33: the VTOC gives the size of the image
+    if sectors != dsk._sector_per_track or tracks * sectors * sector_size != dsk._disksize_raw:
+        return 0
+    if not 0 < vtoc[0x01] < tracks or vtoc[0x02] >= sectors:
+        return 0
+
+    # $27: number of pairs in a T/S list sector (122)
+    score = 1 + (vtoc[0x27] == 122)
+
+    next_track, next_sector = vtoc[0x01], vtoc[0x02]
+    visited = set()
+    while next_track and len(visited) < MAX_CATALOG_SECTORS:
+        if next_track >= tracks or next_sector >= sectors or (next_track, next_sector) in visited:
+            break
+        visited.add((next_track, next_sector))
+        catalog = _read_sector(dsk, next_track, next_sector, order)
+        if catalog is None:
+            break
+        score += 1
+        for index in range(0x0B, 0x0B + 7 * CATALOG_ENTRY_SIZE, CATALOG_ENTRY_SIZE):
+            # A file: a T/S list on the disk (or $FF: deleted) and a
+            # name in Apple ASCII (high bit set)
+            if catalog[index] and (catalog[index] == 0xFF or catalog[index] < tracks) and \
+                    catalog[index + 1] < sectors and min(catalog[index + 3:index + 0x21]) >= 0x80:
+                score += 1
+        next_track, next_sector = catalog[1], catalog[2]
+    return score
+
+
+def _score_prodos(dsk, order):
+    # Score of a ProDOS disk from the Volume Directory (the tests of
+    # DiskProdos.check_disk_format), with its link to the next block
+    block = _read_block(dsk, VOLUME_DIRECTORY_BLOCK, order)
+    if block is None:
+        return 0
+    entry_length, entries_per_block = block[0x23], block[0x24]
+    if (block[0x00] or block[0x01] or
+            (block[0x04] & 0xF0) != 0xF0 or not block[0x04] & 0x0F or
+            not 0 < entry_length * entries_per_block <= 512 or
+            not ord('A') <= block[0x05] <= ord('Z')):
+        return 0
+
+    score = 2
+    # The next directory block points back to this one
+    next_block = block[0x02] + (block[0x03] << 8)
+    if next_block:
+        following = _read_block(dsk, next_block, order)
+        if following is not None and following[0x00] + (following[0x01] << 8) == VOLUME_DIRECTORY_BLOCK:
+            score += 1
+    return score
+
+
+def _score_pascal(dsk, order):
+    # Score of an Apple Pascal disk from its directory (block 2):
+    # 00-01 first block (0), 02-03 block after the directory,
+    # 04-05 type (0), 06 length of the name (1 to 7), 07-0D name,
+    # 0E-0F number of blocks of the volume, 10-11 number of files
+    block = _read_block(dsk, VOLUME_DIRECTORY_BLOCK, order)
+    if block is None:
+        return 0
+    name_length = block[0x06]
+    name = block[0x07:0x07 + name_length]
+    total_blocks = block[0x0E] + (block[0x0F] << 8)
+    if (block[0x00] or block[0x01] or block[0x04] or block[0x05] or
+            not 3 <= block[0x02] + (block[0x03] << 8) < 100 or
+            not 1 <= name_length <= 7 or
+            not all(0x20 < char < 0x7F and char not in PASCAL_INVALID_CHARS for char in name) or
+            not 0 < total_blocks <= 0xFFFF or
+            block[0x10] + (block[0x11] << 8) > 77):
+        return 0
+    # The number of blocks is the size of the image
+    return 2 + (total_blocks * 512 == dsk._disksize_raw)
+
+
+def probe(diskname):
+    # Find the system and the order of the sectors of an image
+    # Raise a DiskfileError if the file doesn't exist
+    preferred = extension_order(image_extension(source_name(diskname)))
+
+    with DiskBin(diskname, STORAGE_MMAP) as dsk:
+        nibble = bool(dsk._nibble_track_size)
+        tracks = dsk._disksize_raw // (dsk._sector_per_track * dsk._sector_size)
+        result = ProbeResult(SYSTEM_UNKNOWN, preferred, dsk._sector_per_track, tracks, nibble)
+        # A nibble image is decoded in DOS order, a 13 sectors image
+        # has no ProDOS order (and only DOS 3.2)
+        # The order of a 2IMG file is already applied by dsk
+        if nibble or dsk._sector_per_track != 16 or dsk.image_header is not None:
+            result.order = ORDER_DOS
+            orders = (ORDER_DOS,)
+        else:
+            orders = (preferred, ORDER_DOS if preferred == ORDER_PRODOS else ORDER_PRODOS)
+
+        # The best score wins, for a tie: the first system and order
+        candidates = [(SYSTEM_DOS32 if dsk._sector_per_track == 13 else SYSTEM_DOS33, _score_dos)]
+        if dsk._sector_per_track == 16:
+            candidates += [(SYSTEM_PRODOS, _score_prodos), (SYSTEM_PASCAL, _score_pascal)]
+
+        best = 0
+        for system, score_function in candidates:
+            for order in orders:
+                score = score_function(dsk, order)
+                if score > best:
+                    best = score
+                    result.system = system
+                    result.order = order
+        if dsk.image_header is not None:
+            result.order = dsk.order
+    return result
+
+
+def open_disk(diskname, storage=STORAGE_ARRAY, result=None):
+    # Open an image with the class of its system (DiskDos33, DiskProdos
+    # or DiskBin for the other disks) and the right order
+    # A compressed image is decompressed once, for the probe and the disk
+    diskname = load_source(diskname)
+    if result is None:
+        result = probe(diskname)
+
+    if result.system in (SYSTEM_DOS33, SYSTEM_DOS32):
+        return DiskDos33(diskname, storage, result.order)
+    if result.system == SYSTEM_PRODOS:
+        # Already checked by the probe
+        return DiskProdos(diskname, storage, check_format=False, order=result.order)
+
+    dsk = DiskBin(diskname, storage, result.order)
+    dsk._set_system(result.system)
+    return dsk
+
+
+def pascal_volume_name(dsk):
+    # Name of the volume of a Pascal disk, dsk already reads the
+    # sectors in the order of the image
+    block = _read_block(dsk, VOLUME_DIRECTORY_BLOCK, ORDER_DOS)
+    return ''.join(dsk.byte2ascii(block[0x07:0x07 + block[0x06]]))
@@ -61,41 +61,200 @@ TRACK 22    110 111 112 113 114 115 116 117
 
 # For the import method:
 # https://www.python.org/dev/peps/pep-0008/#imports
-from apple.disk import Disk, DiskfileError
+from apple.bitmap import Bitmap
+from apple.disk import Disk, DiskfileError, Sector, STORAGE_ARRAY, SYSTEM_PRODOS
+from apple.order import ORDER_PRODOS, BLOCK_SECTORS, extension_order
+from apple.helpers import LRUCache
+from apple.source import image_extension, source_name
 
 __author__ = 'Nicolas Djurovic'
-__version__ = '0.8'
+__version__ = '0.20'
+
+# Key block of the Volume Directory
+VOLUME_DIRECTORY_BLOCK = 2
+
+# How many blocks (directories, index blocks) are kept in the cache
+BLOCK_CACHE_SIZE = 64
+
+# How many data blocks of a file are read at once
+FILE_READ_BLOCKS = 32
+
+# Storage types (high nibble of the first byte of an entry)
+STORAGE_DELETED = 0x0
+STORAGE_SEEDLING = 0x1
+STORAGE_SAPLING = 0x2
+STORAGE_TREE = 0x3
+STORAGE_PASCAL = 0x4
+STORAGE_EXTENDED = 0x5
+STORAGE_SUBDIRECTORY = 0xD
+STORAGE_SUBDIRECTORY_HEADER = 0xE
+STORAGE_VOLUME_HEADER = 0xF
+
+# Usual file types
+FILE_TYPES = {0x00: 'UNK', 0x01: 'BAD', 0x04: 'TXT', 0x06: 'BIN', 0x0F: 'DIR',
+              0x19: 'ADB', 0x1A: 'AWP', 0x1B: 'ASP', 0xB3: 'S16', 0xEF: 'PAS',
+              0xF0: 'CMD', 0xFA: 'INT', 0xFB: 'IVR', 0xFC: 'BAS', 0xFD: 'VAR',
+              0xFE: 'REL', 0xFF: 'SYS'}
+
+
+def decode_datetime(value):
+    # ProDOS date/time (4 bytes): yyyyyyym mmmddddd (LO/HI), minute, hour
+    date = value[0] + (value[1] << 8)
+    if not date:
+        return None
+    year = date >> 9
+    year += 2000 if year < 40 else 1900
+    return '{:04d}-{:02d}-{:02d} {:02d}:{:02d}'.format(year, (date >> 5) & 0x0F, date & 0x1F,
+                                                      value[3] & 0x1F, value[2] & 0x3F)
+
+
+class ProdosEntry:
+    """One file (or directory) entry of a ProDOS directory
+
+    * File Entry format (Beneath Apple ProDOS - 4.14)
+    00    - STORAGE_TYPE (high nibble) / NAME_LENGTH (low nibble)
+    01-0F - FILE_NAME
+    10    - FILE_TYPE
+    11-12 - KEY_POINTER
+    13-14 - BLOCKS_USED
+    15-17 - EOF
+    18-1B - CREATION (date/time)
+    1C    - VERSION
+    1D    - MIN_VERSION
+    1E    - ACCESS
+    1F-20 - AUX_TYPE (load address of a BIN file)
+    21-24 - LAST_MOD (date/time)
+    25-26 - HEADER_POINTER
+    """
+    __slots__ = ('path', 'name', 'storage_type', 'file_type', 'key_pointer', 'blocks_used',
+                 'eof', 'access', 'aux_type', 'created', 'modified')
+
+    def __init__(self, path, name, storage_type, file_type, key_pointer, blocks_used, eof,
+                 access=0, aux_type=0, created=None, modified=None):
+        self.path = path
+        self.name = name
+        self.storage_type = storage_type
+        self.file_type = file_type
+        self.key_pointer = key_pointer
+        self.blocks_used = blocks_used
+        self.eof = eof
+        self.access = access
+        self.aux_type = aux_type
+        self.created = created
+        self.modified = modified
+
+    @classmethod
+    def from_entry(cls, entry, directory):
+        name = bytes(entry[0x01:0x01 + (entry[0x00] & 0x0F)]).decode('ascii', 'replace')
+        return cls(directory + name, name, entry[0x00] >> 4, entry[0x10],
+                   entry[0x11] + (entry[0x12] << 8),
+                   entry[0x13] + (entry[0x14] << 8),
+                   entry[0x15] + (entry[0x16] << 8) + (entry[0x17] << 16),
+                   entry[0x1E], entry[0x1F] + (entry[0x20] << 8),
+                   decode_datetime(entry[0x18:0x1C]), decode_datetime(entry[0x21:0x25]))
+
+    @property
+    def is_directory(self):
+        return self.storage_type == STORAGE_SUBDIRECTORY
+
+    @property
+    def locked(self):
+        # Not writable (access bit 1) and not deletable (access bit 7)
+        return not self.access & 0x82
+
+    @property
+    def type_name(self):
+        return FILE_TYPES.get(self.file_type, '${:02X}'.format(self.file_type))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, values):
+        # From as_dict (the extra keys are ignored)
+        return cls(**{name: values[name] for name in cls.__slots__})
+
+    def __repr__(self):
+        return '<ProdosEntry {} {} {} blocks, EOF={}>'.format(self.path, self.type_name, self.blocks_used, self.eof)
+
+
+def print_catalog(header, entries, free_blocks):
+    # Display the files of a volume from its header and entries
+    # (read from the disk or from the cache)
+    # The paths are displayed from the volume directory
+    volume = '/{}/'.format(header['name'])
+    print(volume.rstrip('/'))
+    print('')
+    print(' {:<40} {:<4} {:>6} {:>8}  {}'.format('NAME', 'TYPE', 'BLOCKS', 'ENDFILE', 'SUBTYPE'))
+    print('')
+    for entry in entries:
+        path = entry.path[len(volume):] if entry.path.startswith(volume) else entry.path
+        print('{}{:<40} {:<4} {:>6} {:>8}  ${:04X}'.format('*' if entry.locked else ' ', path,
+                                                         entry.type_name, entry.blocks_used,
+                                                         entry.eof, entry.aux_type))
+
+    total_blocks = header['total_blocks']
+    print('')
+    print('BLOCKS FREE: {:>5}     BLOCKS USED: {:>5}     TOTAL BLOCKS: {:>5}'.format(
+        free_blocks, total_blocks - free_blocks, total_blocks))
+
+
+class BlockError(DiskfileError):
+    """A block out of the disk (or used twice where it cannot be)"""
+
+    def __init__(self, diskfile, block, maximum=None, message=None):
+        if message is None:
+            message = 'has no block {} (maximum={})'.format(block, maximum)
+        DiskfileError.__init__(self, diskfile, message)
+        self.block = block
 
 
 class DiskProdos(Disk):
     __BLOCK_PER_TRACK = 8
-    __MAX_TRACK = 280
+    # A ProDOS volume has at most 65535 blocks (32 MB)
+    __MAX_BLOCKS = 0xFFFF
     __SECTOR_SIZE = 256
     __BLOCK_SIZE = 512
 
-    __BLOCK_SECTOR = [
-        (0x00, 0x0E),
-        (0x0D, 0x0C),
-        (0x0B, 0x0A),
-        (0x09, 0x08),
-        (0x07, 0x06),
-        (0x05, 0x04),
-        (0x03, 0x02),
-        (0x01, 0x0F)
-    ]
-
-    def __init__(self, diskname):
+    # DOS 3.3 sectors of each block of a track:
+    # (0x00, 0x0E), (0x0D, 0x0C), (0x0B, 0x0A), (0x09, 0x08),
+    # (0x07, 0x06), (0x05, 0x04), (0x03, 0x02), (0x01, 0x0F)
+    # the image order is applied by Disk (see apple.order)
+    __BLOCK_SECTOR = BLOCK_SECTORS
+
+    def __init__(self, diskname, storage=STORAGE_ARRAY, check_format=True, order=None):
+        # Without an order, the order is given by the extension
+        # (like probe: .po and .hdv are in ProDOS order)
+        if order is None:
+            order = extension_order(image_extension(source_name(diskname)))
         # Init with the mother class
-        Disk.__init__(self, diskname)
+        Disk.__init__(self, diskname, storage, order)
+
+        # Directories and index blocks are read again and again
+        # when we walk the volume, so we keep the last ones
+        self._block_cache = LRUCache(BLOCK_CACHE_SIZE)
+
+        # Number of blocks available in the image
+        self._total_blocks = min(self._disksize_raw // self.__BLOCK_SIZE, self.__MAX_BLOCKS)
+
+        # Position in the image of the 2 sectors of each block, None
+        # for an image in ProDOS order (a block is at block * 512)
+        self._block_offsets = self._build_block_offsets()
+
+        # Bitmap of the free blocks, read when needed
+        self._free_map = None
+
         # And check if the current disk image is a valid ProDOS disk
-        if not self.check_disk_format():
+        # (not needed when we already know it, from the cache)
+        if check_format and not self.check_disk_format():
             raise DiskfileError(diskname, 'is not a valid ProDOS disk')
+        self._set_system(SYSTEM_PRODOS)
 
     def convert_block_to_ts(self, block):
         # Convert the block number to a track number and 2 sectors
 
-        # Block is from 0 to __MAX_TRACK?
-        if block in range(0, self.__MAX_TRACK):
+        # Block is in the image?
+        if 0 <= block < self._total_blocks:
             # Block OK, now find the track
             # 1 Track = 8 blocks
             track = block // self.__BLOCK_PER_TRACK
@@ -105,24 +264,127 @@ class DiskProdos(Disk):
 
             return track, self.__BLOCK_SECTOR[index][0], self.__BLOCK_SECTOR[index][1]
         else:
-            print('BlockError: Block', block, 'is not available (maximum=279)')
-            exit()
+            raise BlockError(self._diskname, block, self._total_blocks - 1)
 
-    def read_block(self, block):
-        # Read the block by using the convert block method
-        track, sector1, sector2 = self.convert_block_to_ts(block)
+    @property
+    def total_blocks(self):
+        return self._total_blocks
+
+    def _build_block_offsets(self):
+        # Compute once the position in the image of the 2 sectors
+        # of each block, so reading a block is only 2 slices.
+        # An image in ProDOS order (.po, .hdv, most .2mg) is addressed
+        # by block directly: nothing to compute
+        if self._order == ORDER_PRODOS:
+            return None
+        # A block not complete in the image file is not available
+        offsets = []
+        for block in range(self._total_blocks):
+            track, sector1, sector2 = self.convert_block_to_ts(block)
+            first = self._ts_position(track, sector1)
+            second = self._ts_position(track, sector2)
+            if max(first, second) + self.__SECTOR_SIZE > self._disksize_raw:
+                break
+            offsets.append((first, second))
+        self._total_blocks = len(offsets)
+        return offsets
 
-        # Now read 2 times with read_ts method from main class Disk
-        value_high = self.read_ts(track, sector1, self.__SECTOR_SIZE)
-        value_low = self.read_ts(track, sector2, self.__SECTOR_SIZE)
+    def _block_offset(self, block):
+        if not 0 <= block < self._total_blocks:
+            raise BlockError(self._diskname, block, self._total_blocks - 1)
+        if self._block_offsets is None:
+            first = block * self.__BLOCK_SIZE
+            return first, first + self.__SECTOR_SIZE
+        return self._block_offsets[block]
+
+    def read_block(self, block):
+        # Read the 2 sectors of the block from the offset table
+        first, second = self._block_offset(block)
+        # In a ProDOS ordered image the block is one slice (a view
+        # with the mmap storage)
+        if second == first + self.__SECTOR_SIZE:
+            return self.memdisk[first:first + self.__BLOCK_SIZE]
+        value_high = self.memdisk[first:first + self.__SECTOR_SIZE]
+        value_low = self.memdisk[second:second + self.__SECTOR_SIZE]
 
+        # The 2 sectors are not next to each other in the image, so with
+        # the mmap storage (or a nibble image) we join the 2 views in a
+        # new read-only buffer
+        if isinstance(value_high, memoryview):
+            return memoryview(b''.join((value_high, value_low)))
         return value_high + value_low
 
+    def read_block_sector(self, block):
+        # The same read as read_block, with the track and the first
+        # sector of the block and its position in the image
+        first, second = self._block_offset(block)
+        track, sector, _ = self.convert_block_to_ts(block)
+        return Sector(track, sector, first, self.read_block(block), block)
+
+    def write_block(self, block, data):
+        # Write the 2 sectors of a block (512 bytes), the file is
+        # changed only by flush (see Disk.write_ts)
+        data = memoryview(data).cast('B')
+        if len(data) != self.__BLOCK_SIZE:
+            raise ValueError('A block is {} bytes, not {}'.format(self.__BLOCK_SIZE, len(data)))
+        first, second = self._block_offset(block)
+        self._make_writable()
+        self._write_at(first, data[:self.__SECTOR_SIZE])
+        self._write_at(second, data[self.__SECTOR_SIZE:])
+        self._written()
+
+    def _written(self):
+        # Forget the blocks kept and the bitmap, they can have been changed
+        self._block_cache.clear()
+        self._free_map = None
+
+    def read_block_list(self, blocks, buffer=None, sparse=False):
+        # Read many blocks in one buffer (a new bytearray, or the
+        # buffer given, large enough for all the blocks)
+        # With sparse=True, a block 0 is a sparse block of a file
+        # and stays empty instead of reading the boot block
+        blocks = list(blocks)
+        if buffer is None:
+            buffer = bytearray(len(blocks) * self.__BLOCK_SIZE)
+        target = memoryview(buffer)
+        source = self._memview()
+        offsets = self._block_offsets
+        total = self._total_blocks
+
+        sector_size = self.__SECTOR_SIZE
+        position = 0
+        for block in blocks:
+            if not 0 <= block < total:
+                raise BlockError(self._diskname, block, total - 1)
+            if block or not sparse:
+                if offsets is None:
+                    first = block * self.__BLOCK_SIZE
+                    second = first + sector_size
+                else:
+                    first, second = offsets[block]
+                if second == first + sector_size:
+                    target[position:position + self.__BLOCK_SIZE] = source[first:first + self.__BLOCK_SIZE]
+                else:
+                    target[position:position + sector_size] = source[first:first + sector_size]
+                    target[position + sector_size:position + self.__BLOCK_SIZE] = source[second:second + sector_size]
+            else:
+                # Sparse block (the buffer can be reused, so clear it)
+                target[position:position + self.__BLOCK_SIZE] = bytes(self.__BLOCK_SIZE)
+            position += self.__BLOCK_SIZE
+        return buffer
+
+    def read_blocks(self, start, count, buffer=None):
+        # Read count blocks from the block start in one buffer
+        return self.read_block_list(range(start, start + count), buffer)
+
     def check_disk_format(self):
         # Check if the loaded disk image is ProDOS
 
         # We need to read the block #2
-        block_buffer = self.read_block(2)
+        try:
+            block_buffer = self.read_block(2)
+        except BlockError:
+            return False
 
         # $23 ENTRY_LENGTH: Length of each entry in the Volume Directory
         # in bytes (usually $27).
@@ -144,3 +406,157 @@ class DiskProdos(Disk):
             return False
         else:
             return True
+
+    def read_block_cached(self, block):
+        # Read a block through the cache, used for the directory
+        # and index blocks (we keep an immutable copy of the block)
+        value = self._block_cache.get(block)
+        if value is None:
+            value = bytes(self.read_block(block))
+            self._block_cache.put(block, value)
+        return value
+
+    def read_volume_header(self):
+        # Volume Directory Header (first entry of block 2)
+        block = self.read_block_cached(VOLUME_DIRECTORY_BLOCK)
+        return {
+            'name': bytes(block[0x05:0x05 + (block[0x04] & 0x0F)]).decode('ascii', 'replace'),
+            'created': decode_datetime(block[0x1C:0x20]),
+            'access': block[0x22],
+            'entry_length': block[0x23],
+            'entries_per_block': block[0x24],
+            'file_count': block[0x25] + (block[0x26] << 8),
+            'bit_map_pointer': block[0x27] + (block[0x28] << 8),
+            'total_blocks': block[0x29] + (block[0x2A] << 8),
+        }
+
+    def read_free_map(self):
+        # Volume bitmap: one bit per block (set = free), 4096 blocks
+        # in each bitmap block, from the block BIT_MAP_POINTER
+        if self._free_map is None:
+            header = self.read_volume_header()
+            total_blocks = header['total_blocks']
+            count = -(-total_blocks // (self.__BLOCK_SIZE * 8))
+            bits = self.read_blocks(header['bit_map_pointer'], count)
+            self._free_map = Bitmap(bits, total_blocks)
+        return self._free_map
+
+    def free_blocks(self):
+        # Number of free blocks, without walking the directories
+        return self.read_free_map().count()
+
+    def is_block_free(self, block):
+        return self.read_free_map().is_set(block)
+
+    def free_extents(self):
+        # List of (first block, number of blocks) for each run of free blocks
+        return list(self.read_free_map().iter_runs())
+
+    def iter_directory(self, key_block, directory='/'):
+        # Yield the active entries of one directory, following the
+        # blocks of the directory from its key block (not recursive)
+        block_number = key_block
+        header = self.read_block_cached(key_block)
+        entry_length = header[0x23]
+        entries_per_block = header[0x24]
+        if not entry_length or not entries_per_block:
+            raise DiskfileError(self._diskname, 'has a bad directory header in block {}'.format(key_block))
+
+        visited = set()
+        first = 1  # Skip the header in the key block
+        while block_number:
+            if block_number in visited:
+                raise DiskfileError(self._diskname, 'has a loop in the directory at block {}'.format(block_number))
+            visited.add(block_number)
+
+            block = self.read_block_cached(block_number)
+            for index in range(first, entries_per_block):
+                position = 0x04 + index * entry_length
+                if position + entry_length > self.__BLOCK_SIZE:
+                    break
+                # Storage type 0 is a deleted (or never used) entry
+                if block[position] >> 4 != STORAGE_DELETED:
+                    yield ProdosEntry.from_entry(block[position:position + entry_length], directory)
+            first = 0
+
+            # Next block of the directory
+            block_number = block[0x02] + (block[0x03] << 8)
+
+    def iter_files(self, key_block=VOLUME_DIRECTORY_BLOCK, directory=None, visited=None):
+        # Walk the whole volume and yield every entry with its full
+        # path, a directory is given before its own entries
+        # visited: the key blocks of the directories already walked, a
+        # damaged volume can have directories pointing at each other
+        if directory is None:
+            directory = '/{}/'.format(self.read_volume_header()['name'])
+        if visited is None:
+            visited = set()
+        if key_block in visited:
+            raise BlockError(self._diskname, key_block,
+                             message='has a loop in its directories at block {}'.format(key_block))
+        visited.add(key_block)
+        for entry in self.iter_directory(key_block, directory):
+            yield entry
+            if entry.is_directory:
+                yield from self.iter_files(entry.key_pointer, entry.path + '/', visited)
+
+    def _index_pointers(self, block_number):
+        # The 256 block pointers of an index block (LO bytes in the
+        # first half of the block, HI bytes in the second half)
+        block = self.read_block_cached(block_number)
+        return [low + (high << 8) for low, high in zip(block[0:256], block[256:512])]
+
+    def data_fork(self, entry):
+        # (storage type, key pointer, EOF) of the data of a file
+        # An extended file (with a resource fork) has the EOF of its key
+        # block in its entry, the data fork is described by the
+        # mini-entry in the first half of the key block:
+        # 00 - STORAGE_TYPE, 01-02 - KEY_BLOCK, 03-04 - BLOCKS_USED, 05-07 - EOF
+        if entry.storage_type != STORAGE_EXTENDED:
+            return entry.storage_type, entry.key_pointer, entry.eof
+        block = self.read_block_cached(entry.key_pointer)
+        return (block[0x00] & 0x0F, block[0x01] + (block[0x02] << 8),
+                block[0x05] + (block[0x06] << 8) + (block[0x07] << 16))
+
+    def iter_file_blocks(self, entry):
+        # Yield the data blocks of a file (0 for a sparse block),
+        # only the blocks needed for its EOF
+        storage_type, key_pointer, eof = self.data_fork(entry)
+        count = -(-eof // self.__BLOCK_SIZE)
+        if not count:
+            return
+
+        if storage_type == STORAGE_SEEDLING:
+            yield key_pointer
+        elif storage_type == STORAGE_SAPLING:
+            yield from self._index_pointers(key_pointer)[:count]
+        elif storage_type == STORAGE_TREE:
+            for index_block in self._index_pointers(key_pointer):
+                if index_block:
+                    pointers = self._index_pointers(index_block)[:count]
+                else:
+                    pointers = [0] * min(count, 256)
+                yield from pointers
+                count -= len(pointers)
+                if count <= 0:
+                    break
+        else:
+            raise DiskfileError(self._diskname, 'cannot read {}, storage type ${:X}'.format(entry.path, storage_type))
+
+    def iter_file(self, entry):
+        # Yield the content of a file by chunks, the data blocks are
+        # read FILE_READ_BLOCKS at a time in one buffer
+        remaining = self.data_fork(entry)[2]
+        blocks = list(self.iter_file_blocks(entry))
+        for start in range(0, len(blocks), FILE_READ_BLOCKS):
+            buffer = memoryview(self.read_block_list(blocks[start:start + FILE_READ_BLOCKS], sparse=True))
+            chunk = buffer[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+
+    def read_file(self, entry):
+        return b''.join(self.iter_file(entry))
+
+    def catalog(self):
+        # Display all the files of the volume
+        print_catalog(self.read_volume_header(), self.iter_files(), self.free_blocks())
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+One image read by many threads
+
+A SharedReader opens an image once and loads (or maps) it before the
+first read, then any number of threads read it at the same time,
+directly or through its pool of threads (concurrent.futures), and the
+asyncio tasks through the same pool (run_in_executor). There is only
+one copy of the image in memory, whatever the number of readers.
+
+Each read returns a Sector (apple.disk): the data with its track,
+sector (or block) and position in the image, nothing is kept in the
+Disk between 2 reads (see "Threads" in apple.disk for what is safe).
+With the mmap storage the data is a view of the image: it can be read
+until the reader is closed, bytes(sector) keeps a copy.
+
+The reader only reads: the writes need a Disk of their own.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from apple.disk import DiskfileError, STORAGE_MMAP
+from apple.probe import open_disk
+from apple.prodos import DiskProdos
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+
+class SharedReader:
+    def __init__(self, diskname, storage=STORAGE_MMAP, workers=None):
+        self.disk = open_disk(diskname, storage)
+        # Loaded now, not by the first thread reading it
+        self.disk.memdisk
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='adir-reader')
+
+    def close(self):
+        # Wait for the reads not finished, then release the image
+        self._executor.shutdown(wait=True)
+        self.disk.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read_sector(self, track, sector=0, size=None):
+        # In the thread of the caller
+        return self.disk.read_sector(track, sector, size)
+
+    def read_block(self, block):
+        if not isinstance(self.disk, DiskProdos):
+            raise DiskfileError(self.disk._diskname, 'is not a ProDOS disk')
+        return self.disk.read_block_sector(block)
+
+    def submit_sector(self, track, sector=0, size=None):
+        # A Future of the Sector, read by the pool
+        return self._executor.submit(self.read_sector, track, sector, size)
+
+    def submit_block(self, block):
+        return self._executor.submit(self.read_block, block)
+
+    def map_sectors(self, positions):
+        # Read the (track, sector) by the pool, the Sectors are given
+        # in the same order
+        return self._executor.map(lambda position: self.read_sector(*position), positions)
+
+    def map_blocks(self, blocks):
+        return self._executor.map(self.read_block, blocks)
+
+    async def aread_sector(self, track, sector=0, size=None):
+        # For asyncio: the read runs in the pool, not in the event loop
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.read_sector, track, sector,
+                                                                size)
+
+    async def aread_block(self, block):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.read_block, block)
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+Search of strings and bytes in the images of a library
+
+All the patterns of a search are compiled in one regular expression
+(re, on bytes), run directly on the memory of each image (a view of
+the mmap, nothing copied): every pattern is found in one pass.
+- a text is searched in plain ASCII and in Apple ASCII (the high bit
+  set, like the text of the screen or of a DOS catalog), with or
+  without the case
+- a hexa pattern is a list of bytes, '??' matches any byte:
+  "A9 00 8D ?? C0"
+Only the hits not overlapping each other are found (the first one).
+
+Each hit is given with where it is: its position in the image, the
+logical track/sector (DOS 3.3 order, whatever the order of the image)
+and the offset in the sector, the block of a ProDOS volume and the file
+using it (see apple.diff.dos_owners and prodos_owners, read only if
+there is a hit). The image is searched as it is stored, so a text
+cut over 2 sectors is found only if they follow each other in the
+image.
+
+The images are searched by a pool of processes (see apple.batch).
+
+For the searches done again and again, an index of the 3 bytes
+sequences (trigrams) of each image is kept in a SQLite database, like
+apple.dedup (updated incrementally). The bytes are indexed without
+their high bit and without their case, so the same index works for all
+the variants of a pattern. A query only searches the images having all
+the trigrams of one of the patterns (all the images for a pattern with
+less than 3 bytes known), and the images changed since they were
+indexed (their trigrams in the index are not the right ones).
+"""
+from array import array
+from functools import partial
+import re
+import sys
+
+from apple.batch import run_batch, DEFAULT_CHUNKSIZE
+from apple.diff import dos_owners, prodos_owners
+from apple.disk import DiskfileError, STORAGE_MMAP
+from apple.dos import DiskDos33
+from apple.index import ImageIndex, image_stamp, update_images
+from apple.order import DOS_TO_PRODOS
+from apple.probe import open_disk
+from apple.prodos import DiskProdos
+from apple.source import source_size
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.3'
+
+ENCODING_ASCII = 'ascii'
+ENCODING_APPLE = 'apple'
+ENCODING_HEX = 'hex'
+
+# Hits kept for one image (the others are only counted)
+DEFAULT_MAX_HITS = 100
+
+GRAM_SIZE = 3
+
+# The trigrams of an image are read by parts of this size
+GRAM_PART_SIZE = 4096
+
+SEARCH_FILENAME = 'search.sqlite'
+
+# Each byte without its high bit and in upper case (for the trigrams)
+_FOLD = bytes((value & 0x7F) - 0x20 if 0x61 <= value & 0x7F <= 0x7A else value & 0x7F for value in range(256))
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    grams INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS grams (
+    gram INTEGER NOT NULL,
+    image INTEGER NOT NULL,
+    PRIMARY KEY (gram, image)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS grams_image ON grams (image);
+'''
+
+
+def parse_hex(text):
+    # Bytes of a hexa pattern, None for '??' (any byte)
+    text = ''.join(text.split())
+    if not text or len(text) % 2:
+        raise ValueError('the hexa pattern "{}" must have 2 digits for each byte'.format(text))
+    values = []
+    for index in range(0, len(text), 2):
+        digits = text[index:index + 2]
+        values.append(None if digits == '??' else int(digits, 16))
+    return values
+
+
+def _is_letter(value):
+    return 0x41 <= value & 0x5F <= 0x5A
+
+
+def _byte_values(value, ignore_case):
+    # The bytes matching one byte of a pattern
+    if ignore_case and _is_letter(value):
+        return [value & 0xDF, value | 0x20]
+    return [value]
+
+
+def _byte_class(values):
+    values = sorted(set(values))
+    if len(values) == 1:
+        return re.escape(bytes(values))
+    return b'[' + b''.join(re.escape(bytes([value])) for value in values) + b']'
+
+
+def _byte_pattern(values, ignore_case):
+    # Regular expression of a list of bytes (None: any byte)
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(b'.')
+        else:
+            parts.append(_byte_class(_byte_values(value, ignore_case)))
+    return b''.join(parts)
+
+
+def fold_grams(values):
+    # Trigrams (as numbers) of the bytes known of a pattern, folded
+    # like the index
+    grams = set()
+    for start in range(len(values) - GRAM_SIZE + 1):
+        gram = values[start:start + GRAM_SIZE]
+        if None not in gram:
+            grams.add(int.from_bytes(bytes(gram).translate(_FOLD), 'little'))
+    return grams
+
+
+class Search:
+    """The patterns of a search, compiled once
+
+    patterns:   (label, encoding, bytes) of each variant searched, the
+                bytes are a list of values (None: any byte)
+    regex:      all the variants at once
+    """
+
+    def __init__(self, texts=(), hexes=(), ignore_case=False):
+        self.patterns = []
+        for text in texts:
+            try:
+                values = list(text.encode('ascii'))
+            except UnicodeEncodeError:
+                raise ValueError('the text "{}" is not ASCII'.format(text))
+            self.patterns.append((text, ENCODING_ASCII, values))
+            self.patterns.append((text, ENCODING_APPLE, [value | 0x80 for value in values]))
+        for text in hexes:
+            self.patterns.append((text, ENCODING_HEX, parse_hex(text)))
+        if not self.patterns or not all(values for label, encoding, values in self.patterns):
+            raise ValueError('nothing to search')
+
+        cases = [ignore_case and encoding != ENCODING_HEX for label, encoding, values in self.patterns]
+        # Each variant alone, to know which one was found
+        self._variants = [re.compile(_byte_pattern(values, case), re.DOTALL)
+                          for (label, encoding, values), case in zip(self.patterns, cases)]
+        if any(values[0] is None for label, encoding, values in self.patterns):
+            self.regex = re.compile(b'|'.join(b'(?:' + variant.pattern + b')' for variant in self._variants),
+                                    re.DOTALL)
+            return
+        # The first byte of all the variants in one class, so re only
+        # stops on these bytes (a class first in each variant, or a
+        # group for each one, makes re try every variant at every byte)
+        firsts = []
+        branches = []
+        for (label, encoding, values), case in zip(self.patterns, cases):
+            first = _byte_values(values[0], case)
+            firsts.extend(first)
+            branches.append(b'(?<=' + _byte_class(first) + b')' + _byte_pattern(values[1:], case))
+        self.regex = re.compile(_byte_class(firsts) + b'(?:' + b'|'.join(branches) + b')', re.DOTALL)
+
+    def pattern_of(self, data):
+        # (label, encoding, bytes) of the variant found (the first one
+        # matching, like the regex)
+        for pattern, variant in zip(self.patterns, self._variants):
+            if variant.fullmatch(data):
+                return pattern
+
+    def grams(self):
+        # The trigrams of each pattern (both variants of a text have
+        # the same ones), an empty set: the pattern can be anywhere
+        grams = {}
+        for label, encoding, values in self.patterns:
+            grams.setdefault((label, encoding == ENCODING_HEX), fold_grams(values))
+        return list(grams.values())
+
+
+def _image_view(dsk):
+    # The image as it is stored (a view of the mmap)
+    return dsk._memview()[0:dsk._disksize_raw]
+
+
+class _Locator:
+    # Track/sector, block and owner of a position of an image
+    def __init__(self, dsk):
+        self.dsk = dsk
+        self.sector_size = dsk._sector_size
+        self.sector_per_track = dsk._sector_per_track
+        # DOS 3.3 sector at each position of a track
+        self.logical = list(range(self.sector_per_track))
+        if dsk._sector_position is not None:
+            for sector, position in enumerate(dsk._sector_position):
+                self.logical[position] = sector
+        self.block = isinstance(dsk, DiskProdos) and self.sector_per_track == len(DOS_TO_PRODOS)
+        self._owners = None
+
+    def owners(self):
+        if self._owners is None:
+            try:
+                if isinstance(self.dsk, DiskDos33):
+                    self._owners = dos_owners(self.dsk)
+                elif isinstance(self.dsk, DiskProdos):
+                    self._owners = prodos_owners(self.dsk)
+                else:
+                    self._owners = {}
+            except DiskfileError:
+                # A damaged catalog: the hits are given without owners
+                self._owners = {}
+        return self._owners
+
+    def locate(self, position):
+        index, offset = divmod(position, self.sector_size)
+        track, physical = divmod(index, self.sector_per_track)
+        sector = self.logical[physical]
+        where = {'offset': position, 'track': track, 'sector': sector, 'sector_offset': offset}
+        if self.block:
+            half = DOS_TO_PRODOS[sector]
+            where['block'] = track * (self.sector_per_track // 2) + half // 2
+            where['block_offset'] = (half % 2) * self.sector_size + offset
+            where['file'] = self.owners().get(where['block'])
+        else:
+            where['file'] = self.owners().get(track * self.sector_per_track + sector)
+        return where
+
+
+def search_disk(dsk, search, max_hits=DEFAULT_MAX_HITS):
+    # Search an opened disk, return (hits, number of hits)
+    locator = _Locator(dsk)
+    hits = []
+    count = 0
+    for match in search.regex.finditer(_image_view(dsk)):
+        count += 1
+        if len(hits) >= max_hits:
+            continue
+        data = match.group()
+        label, encoding, values = search.pattern_of(data)
+        hit = {'pattern': label, 'encoding': encoding}
+        hit.update(locator.locate(match.start()))
+        hit['data'] = data.hex().upper()
+        hits.append(hit)
+    return hits, count
+
+
+def search_image(diskname, search, max_hits=DEFAULT_MAX_HITS):
+    # Search an image (in a worker), any error is kept in the result
+    result = {'path': diskname}
+    try:
+        result['size'] = source_size(diskname)
+        with open_disk(diskname, STORAGE_MMAP) as dsk:
+            result['hits'], result['count'] = search_disk(dsk, search, max_hits)
+    except DiskfileError as error:
+        result['error'] = str(error)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+def search_images(search, images, max_hits=DEFAULT_MAX_HITS, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Search all the images and yield one result per image
+    return run_batch(partial(search_image, search=search, max_hits=max_hits), images, workers, chunksize)
+
+
+def image_grams(data):
+    # The different trigrams (folded) of a buffer, as numbers
+    # The buffer is cut in parts (with the 2 bytes of the next one),
+    # a part already seen (empty blocks...) is skipped. The 3 bytes
+    # of each position are spread in a 4 bytes word (the 4th one is 0),
+    # so the array gives all the trigrams of a part at once
+    folded = bytes(data).translate(_FOLD)
+    grams = set()
+    parts = set()
+    for start in range(0, max(len(folded) - GRAM_SIZE + 1, 0), GRAM_PART_SIZE):
+        part = folded[start:start + GRAM_PART_SIZE + GRAM_SIZE - 1]
+        if part in parts:
+            continue
+        parts.add(part)
+        count = len(part) - GRAM_SIZE + 1
+        words = bytearray(count * 4)
+        for index in range(GRAM_SIZE):
+            words[index::4] = part[index:index + count]
+        values = array('I')
+        values.frombytes(words)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        grams.update(values)
+    return array('I', sorted(grams))
+
+
+def gram_image(diskname):
+    # The trigrams of an image (in a worker)
+    result = {'path': diskname}
+    try:
+        result['stamp'] = image_stamp(diskname)
+        result['size'] = source_size(diskname)
+        with open_disk(diskname, STORAGE_MMAP) as dsk:
+            result['grams'] = image_grams(_image_view(dsk))
+    except DiskfileError as error:
+        result['error'] = str(error)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+class SearchIndex(ImageIndex):
+    filename = SEARCH_FILENAME
+    schema = _SCHEMA
+
+    def __init__(self, path=None):
+        ImageIndex.__init__(self, path)
+        # Images changed (or removed) since they were indexed, found by
+        # the last candidates
+        self.stale = []
+
+    def _remove(self, image):
+        self._connection.execute('DELETE FROM grams WHERE image = ?', (image,))
+        self._connection.execute('DELETE FROM images WHERE id = ?', (image,))
+
+    def add(self, result):
+        # Add (or replace) an image from the result of gram_image
+        grams = result['grams']
+        with self._connection:
+            self._remove_path(result['path'])
+            image = self._connection.execute(
+                'INSERT INTO images (path, size, mtime, grams) VALUES (?, ?, ?, ?)',
+                (result['path'], result['stamp'][0], result['stamp'][1], len(grams))).lastrowid
+            self._connection.executemany('INSERT INTO grams VALUES (?, ?)', [(gram, image) for gram in grams])
+
+    def _matching(self, search):
+        # The paths of the images whose trigrams can match the search
+        execute = self._connection.execute
+        images = set()
+        for grams in search.grams():
+            if not grams:
+                return {path for path, in execute('SELECT path FROM images')}
+            images.update(image for image, in execute(
+                'SELECT image FROM grams WHERE gram IN ({}) GROUP BY image HAVING COUNT(*) = ?'.format(
+                    ', '.join('?' * len(grams))), list(grams) + [len(grams)]))
+        paths = set()
+        for image in images:
+            paths.update(path for path, in execute('SELECT path FROM images WHERE id = ?', (image,)))
+        return paths
+
+    def candidates(self, search):
+        # The paths of the images which can contain one of the patterns
+        # of a search (sorted)
+        # The trigrams of an image changed since it was indexed are not
+        # the right ones: it's always a candidate, and one not there
+        # anymore is not. Both are kept in self.stale
+        paths = self._matching(search)
+        self.stale = []
+        for path, stamp in self.stamps().items():
+            try:
+                current = image_stamp(path)
+            except OSError:
+                current = None
+            if current == stamp:
+                continue
+            self.stale.append(path)
+            if current is None:
+                paths.discard(path)
+            else:
+                paths.add(path)
+        self.stale.sort()
+        return sorted(paths)
+
+    def stats(self):
+        execute = self._connection.execute
+        images, grams = execute('SELECT COUNT(*), COALESCE(SUM(grams), 0) FROM images').fetchone()
+        return {
+            'images': images,
+            'grams': grams,
+            'different_grams': execute('SELECT COUNT(DISTINCT gram) FROM grams').fetchone()[0],
+        }
+
+
+def update_search_index(index, images, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Read the trigrams of the images not indexed yet (or changed) and
+    # add them to the index, yield one result per image (without them)
+    return update_images(index, images, gram_image,
+                         lambda result: {'size': result['size'], 'grams': len(result['grams'])}, workers, chunksize)
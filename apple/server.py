@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+Server of disk images
+
+A long running process answers the requests of a frontend (HTTP/JSON,
+on a TCP port or a Unix socket), so an image is not opened and parsed
+again for each request: the disks opened are kept in an LRU (DiskPool)
+bounded by the memory they use. A disk is opened again only when its
+file changed (size or modification time).
+
+Requests (GET, the parameters in the query string):
+    /catalog?path=IMAGE                         metadata and files of the
+                                                disk (like scan.py)
+    /ts?path=IMAGE&track=17&sector=0&size=256   sectors (sector and size
+                                                are optional, no sector:
+                                                the whole track)
+    /block?path=IMAGE&block=2&count=1           blocks of a ProDOS disk
+    /file?path=IMAGE&name=HELLO&raw=1           content of a file (the DOS
+                                                name, or the ProDOS path)
+    /stats                                      disks opened, memory used
+/ts and /block answer in JSON with the data in hexa, or the bytes
+themselves with format=raw. /file always answers with the bytes.
+An error is answered in JSON ({"error": ...}): 400 for a bad request,
+404 for an image, a sector or a file not found.
+
+The connections are handled by asyncio (keep-alive is supported), and
+each request is answered by a pool of threads (run_in_executor): a
+disk opened (and probed) for the first time, the catalog of a big
+volume or a big file never stops the other connections. The catalog of
+each disk is read once and kept with it.
+
+The threads share the disks of the pool (the reads are safe, see
+"Threads" in apple.disk). A request borrows its disk from the pool, and
+a disk removed from the pool (LRU, or its file changed) is closed only
+when the last request using it gives it back.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+import os
+import signal
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+from apple.cache import describe_disk
+from apple.disk import DiskfileError, STORAGE_MMAP, STORAGE_PAGED
+from apple.dos import CatalogEntry
+from apple.helpers import LRUCache
+from apple.paged import PAGE_SIZE, MAX_PAGES
+from apple.probe import open_disk
+from apple.prodos import DiskProdos, ProdosEntry
+from apple.source import container_path
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.3'
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8642
+
+# Memory used by all the disks kept opened
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+
+# Most blocks read by one request (a 32 MB volume has 65535 blocks)
+MAX_BLOCKS_PER_REQUEST = 256
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+JSON_TYPE = 'application/json'
+BINARY_TYPE = 'application/octet-stream'
+
+
+class RequestError(Exception):
+    """A request we cannot answer, with its HTTP status"""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class PoolEntry:
+    __slots__ = ('disk', 'stamp', 'size', 'metadata', 'users', 'retired', 'lock')
+
+    def __init__(self, disk, stamp, size):
+        self.disk = disk
+        self.stamp = stamp
+        self.size = size
+        # Catalog of the disk, read the first time it's needed
+        self.metadata = None
+        # Requests using the disk, and True once it's out of the pool
+        # (closed by the last of them)
+        self.users = 0
+        self.retired = False
+        self.lock = threading.Lock()
+
+
+def disk_memory(dsk):
+    # Memory used by an opened disk (an estimate for the budget): the
+    # whole image, or the most pages kept for a paged image
+    if dsk.storage == STORAGE_PAGED:
+        return min(dsk._image_size, PAGE_SIZE * MAX_PAGES)
+    return dsk._image_size
+
+
+class DiskPool:
+    # The disks opened, the ones used the least recently are
+    # closed when the memory used is more than max_memory
+    # Used by many threads: the entries are changed under a lock
+    def __init__(self, max_memory=DEFAULT_MAX_MEMORY, storage=STORAGE_MMAP):
+        self.max_memory = max_memory
+        self._storage = storage
+        self._entries = LRUCache(max_memory, sizeof=lambda entry: entry.size)
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reloaded = 0
+
+    def _retire(self, entry):
+        # A disk out of the pool (with the lock): closed now, or by
+        # the last request using it
+        entry.retired = True
+        if not entry.users:
+            entry.disk.close()
+
+    def acquire(self, diskname):
+        # The entry of an image, the image is opened (and probed) only
+        # if it's not in the pool or if its file changed
+        # It must be given back with release (see borrow)
+        path = os.path.abspath(diskname)
+        try:
+            stat = os.stat(container_path(path))
+        except OSError:
+            raise DiskfileError(diskname, 'not found')
+        stamp = (stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                if entry.stamp == stamp:
+                    entry.users += 1
+                    return entry
+                self._entries.pop(path)
+                self._retire(entry)
+                self.reloaded += 1
+
+        # Opened without the lock, the other requests don't wait for it
+        dsk = open_disk(path, self._storage)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.stamp == stamp:
+                # Opened by another request at the same time
+                dsk.close()
+                entry.users += 1
+                return entry
+            if entry is not None:
+                self._entries.pop(path)
+                self._retire(entry)
+            entry = PoolEntry(dsk, stamp, disk_memory(dsk))
+            entry.users = 1
+            for old_path, old_entry in self._entries.put(path, entry):
+                self._retire(old_entry)
+            self.opened += 1
+            return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            if entry.retired and not entry.users:
+                entry.disk.close()
+
+    @contextmanager
+    def borrow(self, diskname):
+        # with pool.borrow(path) as entry: the disk is not closed
+        # until the end of the block
+        entry = self.acquire(diskname)
+        try:
+            yield entry
+        finally:
+            self.release(entry)
+
+    def metadata(self, entry):
+        with entry.lock:
+            if entry.metadata is None:
+                entry.metadata = describe_disk(entry.disk)
+        return entry.metadata
+
+    def close(self):
+        with self._lock:
+            for path, entry in self._entries.items():
+                self._retire(entry)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'disks': len(self._entries),
+                'memory': self._entries.size,
+                'max_memory': self.max_memory,
+                'hits': self._entries.hits,
+                'misses': self._entries.misses,
+                'opened': self.opened,
+                'reloaded': self.reloaded,
+            }
+
+
+# Default of a parameter which must be given
+_REQUIRED = object()
+
+
+def _param(params, name, convert=str, default=_REQUIRED):
+    # A parameter of the query string, converted (default if it's not
+    # given, None is a default too)
+    values = params.get(name)
+    if not values:
+        if default is _REQUIRED:
+            raise RequestError(400, 'missing parameter "{}"'.format(name))
+        return default
+    try:
+        return convert(values[0])
+    except ValueError:
+        raise RequestError(400, 'bad value for "{}": {}'.format(name, values[0]))
+
+
+def _number(value):
+    # A number (never negative) in decimal, or in hexa with $ or 0x
+    number = int(value[1:], 16) if value.startswith('$') else int(value, 0)
+    if number < 0:
+        raise ValueError(value)
+    return number
+
+
+def _data_response(params, description, data):
+    if params.get('format') == ['raw']:
+        return 200, BINARY_TYPE, bytes(data)
+    description['data'] = bytes(data).hex().upper()
+    return 200, JSON_TYPE, description
+
+
+def handle_catalog(pool, params):
+    with pool.borrow(_param(params, 'path')) as entry:
+        return 200, JSON_TYPE, dict(pool.metadata(entry), path=params['path'][0])
+
+
+def handle_ts(pool, params):
+    with pool.borrow(_param(params, 'path')) as entry:
+        track = _param(params, 'track', _number)
+        sector = _param(params, 'sector', _number, None)
+        size = _param(params, 'size', _number, None)
+        dsk = entry.disk
+        if not 0 <= track < dsk._total_tracks or not 0 <= (sector or 0) < dsk._sector_per_track:
+            raise RequestError(404, 'no track ${:02X} sector ${:02X}'.format(track, sector or 0))
+        # No sector: the whole track (copied before the disk is given back)
+        data = dsk.read_ts(track, sector, size)
+        return _data_response(params, {'path': params['path'][0], 'track': track, 'sector': sector or 0}, data)
+
+
+def handle_block(pool, params):
+    with pool.borrow(_param(params, 'path')) as entry:
+        block = _param(params, 'block', _number)
+        count = _param(params, 'count', _number, 1)
+        if not 0 < count <= MAX_BLOCKS_PER_REQUEST:
+            raise RequestError(400, 'count must be from 1 to {}'.format(MAX_BLOCKS_PER_REQUEST))
+        if not isinstance(entry.disk, DiskProdos):
+            raise RequestError(400, 'not a ProDOS disk')
+        data = entry.disk.read_blocks(block, count)
+        return _data_response(params, {'path': params['path'][0], 'block': block, 'count': count}, data)
+
+
+def handle_file(pool, params):
+    with pool.borrow(_param(params, 'path')) as entry:
+        name = _param(params, 'name')
+        raw = params.get('raw') == ['1']
+        metadata = pool.metadata(entry)
+        for values in metadata.get('files', ()):
+            if metadata['format'] == 'prodos':
+                # The full path, or the path in the volume
+                relative = values['path'].split('/', 2)[-1]
+                if name in (values['path'], relative) and values['type'] != 'DIR':
+                    return 200, BINARY_TYPE, entry.disk.read_file(ProdosEntry.from_dict(values))
+            elif values['name'] == name and not values['deleted']:
+                return 200, BINARY_TYPE, entry.disk.read_file(CatalogEntry.from_dict(values), raw)
+        raise RequestError(404, 'no file "{}"'.format(name))
+
+
+def handle_stats(pool, params):
+    return 200, JSON_TYPE, pool.stats()
+
+
+ROUTES = {
+    '/catalog': handle_catalog,
+    '/ts': handle_ts,
+    '/block': handle_block,
+    '/file': handle_file,
+    '/stats': handle_stats,
+}
+
+
+def dispatch(pool, method, target):
+    # Answer one request: (status, content type, body)
+    if method not in ('GET', 'HEAD'):
+        return 405, JSON_TYPE, {'error': 'only GET is allowed'}
+    url = urlsplit(target)
+    handler = ROUTES.get(url.path)
+    if handler is None:
+        return 404, JSON_TYPE, {'error': 'unknown request {}'.format(url.path)}
+    try:
+        return handler(pool, parse_qs(url.query))
+    except RequestError as error:
+        return error.status, JSON_TYPE, {'error': str(error)}
+    except DiskfileError as error:
+        return 404, JSON_TYPE, {'error': str(error)}
+    except Exception as error:
+        return 500, JSON_TYPE, {'error': '{}: {}'.format(type(error).__name__, error)}
+
+
+def _response(status, content_type, body, keep_alive, head=False):
+    if content_type == JSON_TYPE:
+        body = json.dumps(body).encode()
+    header = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+        status, HTTP_REASONS.get(status, ''), content_type, len(body), 'keep-alive' if keep_alive else 'close')
+    return header.encode('latin-1') + (b'' if head else body)
+
+
+class ImageServer:
+    def __init__(self, pool=None, workers=None):
+        self.pool = pool if pool is not None else DiskPool()
+        self.requests = 0
+        # The requests are answered by these threads, not by the loop
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='adir-server')
+
+    async def handle_connection(self, reader, writer):
+        # Answer the requests of one client until it closes the connection
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    writer.write(_response(400, JSON_TYPE, {'error': 'bad request line'}, False))
+                    break
+
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip().lower()
+                # Only GET, a body is read and ignored
+                length = headers.get('content-length', '0')
+                if length.isdigit() and int(length):
+                    await reader.readexactly(int(length))
+
+                connection = headers.get('connection', '')
+                keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+                self.requests += 1
+                status, content_type, body = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, dispatch, self.pool, method, target)
+                writer.write(_response(status, content_type, body, keep_alive, method == 'HEAD'))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+        # Listen on a Unix socket, or on host:port
+        if unix_socket:
+            return await asyncio.start_unix_server(self.handle_connection, unix_socket)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+        server = await self.start(host, port, unix_socket)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown(wait=True)
+            self.pool.close()
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_server(host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None, max_memory=DEFAULT_MAX_MEMORY, workers=None):
+    # Serve until the process is stopped (Ctrl-C, or killed)
+    server = ImageServer(DiskPool(max_memory), workers)
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        asyncio.run(server.serve(host, port, unix_socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Images similar to each other (MinHash and LSH)
+
+An image is seen as the set of its sectors (blocks for a ProDOS
+volume), each sector as a 64 bits hash of its content, the empty
+sectors (only zeros) are not in the set. Two variants of the same disk
+(a patched title sector, a saved game) have nearly the same set, the
+similarity of 2 images is the Jaccard index of their sets.
+
+MinHash: the signature of an image is the minimum of NUM_HASHES hash
+functions (a * x + b) mod MERSENNE_PRIME over its set, the fraction of
+the values which are the same in 2 signatures is an estimate of their
+similarity. Each hash function is computed over the whole set with map
+(no Python loop over the sectors).
+
+LSH: the signature is cut in BANDS bands of ROWS values, and each band
+is hashed to a bucket. 2 images having at least one bucket in common
+are candidates, so a query only compares the signature of an image with
+the few images in its buckets, never with the whole library. With 32
+bands of 4 values, 2 images similar at 70% are found 99.9% of the time,
+at 30% only 22% of the time.
+
+An image with no sector in its set (a blank disk) has no signature
+to compare: it's kept in the index, but in no bucket, so it's never a
+candidate nor in a cluster.
+
+The signatures and the buckets are kept in a SQLite database, updated
+incrementally (see apple.index: only the new or changed images are
+read, by a pool of processes).
+"""
+from array import array
+from hashlib import blake2b
+import random
+
+from apple.batch import DEFAULT_CHUNKSIZE
+from apple.diff import logical_image
+from apple.disk import DiskfileError, STORAGE_MMAP
+from apple.index import ImageIndex, image_stamp, update_images
+from apple.probe import open_disk
+from apple.source import source_size
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+SIMILAR_FILENAME = 'similar.sqlite'
+
+NUM_HASHES = 128
+BANDS = 32
+ROWS = NUM_HASHES // BANDS
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 64) - 1
+
+# The hash functions are the same for everybody (and every run)
+HASH_SEED = 0xAD1B
+_random = random.Random(HASH_SEED)
+HASH_FUNCTIONS = [(_random.randrange(1, MERSENNE_PRIME), _random.randrange(0, MERSENNE_PRIME))
+                  for index in range(NUM_HASHES)]
+
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_COUNT = 10
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS signatures (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    elements INTEGER NOT NULL,
+    signature BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    image INTEGER NOT NULL,
+    PRIMARY KEY (band, bucket, image)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS buckets_image ON buckets (image);
+'''
+
+
+def unit_set(data, unit_size):
+    # The 64 bits hashes of the different units (not empty) of an image
+    empty = bytes(unit_size)
+    return {int.from_bytes(blake2b(data[start:start + unit_size], digest_size=8).digest(), 'little')
+            for start in range(0, len(data), unit_size) if data[start:start + unit_size] != empty}
+
+
+def minhash(elements):
+    # Signature (array of NUM_HASHES values) of a set of integers
+    if not elements:
+        return array('Q', [MAX_HASH] * NUM_HASHES)
+    values = list(elements)
+    modulo = MERSENNE_PRIME.__rmod__
+    return array('Q', [min(map(modulo, map(b.__add__, map(a.__mul__, values)))) for a, b in HASH_FUNCTIONS])
+
+
+def is_empty(signature):
+    # Signature of an image with no sector (see minhash)
+    return signature.count(MAX_HASH) == NUM_HASHES
+
+
+def band_buckets(signature):
+    # Bucket (a 63 bits integer, for SQLite) of each band of a signature
+    raw = signature.tobytes()
+    size = ROWS * signature.itemsize
+    return [int.from_bytes(blake2b(raw[index * size:(index + 1) * size], digest_size=8).digest(), 'little') >> 1
+            for index in range(BANDS)]
+
+
+def similarity(first, second):
+    # Estimated Jaccard index of 2 signatures
+    return sum(map(int.__eq__, first, second)) / NUM_HASHES
+
+
+def signature_image(diskname):
+    # Signature of an image (in a worker)
+    result = {'path': diskname}
+    try:
+        result['stamp'] = image_stamp(diskname)
+        result['size'] = source_size(diskname)
+        with open_disk(diskname, STORAGE_MMAP) as dsk:
+            elements = unit_set(*logical_image(dsk))
+        result['elements'] = len(elements)
+        result['signature'] = minhash(elements).tobytes()
+    except DiskfileError as error:
+        result['error'] = str(error)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+def unpack_signature(raw):
+    signature = array('Q')
+    signature.frombytes(raw)
+    return signature
+
+
+class SimilarIndex(ImageIndex):
+    filename = SIMILAR_FILENAME
+    schema = _SCHEMA
+    table = 'signatures'
+
+    def _remove(self, image):
+        self._connection.execute('DELETE FROM buckets WHERE image = ?', (image,))
+        self._connection.execute('DELETE FROM signatures WHERE id = ?', (image,))
+
+    def add(self, result):
+        # Add (or replace) an image from the result of signature_image
+        signature = unpack_signature(result['signature'])
+        with self._connection:
+            self._remove_path(result['path'])
+            image = self._connection.execute(
+                'INSERT INTO signatures (path, size, mtime, elements, signature) VALUES (?, ?, ?, ?, ?)',
+                (result['path'], result['stamp'][0], result['stamp'][1], result['elements'],
+                 result['signature'])).lastrowid
+            if not result['elements']:
+                # Blank disk: in no bucket
+                return
+            self._connection.executemany('INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)',
+                                         [(band, bucket, image)
+                                          for band, bucket in enumerate(band_buckets(signature))])
+
+    def signature_of(self, path):
+        row = self._connection.execute('SELECT signature FROM signatures WHERE path = ?', (path,)).fetchone()
+        return unpack_signature(row[0]) if row else None
+
+    def _candidates(self, signature):
+        # The images having a bucket in common with the signature
+        candidates = set()
+        for band, bucket in enumerate(band_buckets(signature)):
+            candidates.update(image for image, in self._connection.execute(
+                'SELECT image FROM buckets WHERE band = ? AND bucket = ?', (band, bucket)))
+        return candidates
+
+    def query(self, signature, threshold=DEFAULT_THRESHOLD, count=DEFAULT_COUNT, exclude=None):
+        # The images most similar to a signature: [{path, similarity}],
+        # only the candidates of the buckets are compared
+        # A blank disk is similar to nothing
+        if is_empty(signature):
+            return []
+        results = []
+        for image in self._candidates(signature):
+            path, raw = self._connection.execute('SELECT path, signature FROM signatures WHERE id = ?',
+                                                 (image,)).fetchone()
+            if path == exclude:
+                continue
+            value = similarity(signature, unpack_signature(raw))
+            if value >= threshold:
+                results.append({'path': path, 'similarity': value})
+        results.sort(key=lambda result: (-result['similarity'], result['path']))
+        return results[:count]
+
+    def clusters(self, threshold=DEFAULT_THRESHOLD):
+        # Groups of similar images (2 images or more): the images of each
+        # bucket are compared with the first one of the bucket, and the
+        # similar ones are joined (union-find)
+        parent = {}
+
+        def find(image):
+            root = image
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while image != root:
+                parent[image], image = root, parent.get(image, image)
+            return root
+
+        signatures = {}
+
+        def signature(image):
+            if image not in signatures:
+                signatures[image] = unpack_signature(self._connection.execute(
+                    'SELECT signature FROM signatures WHERE id = ?', (image,)).fetchone()[0])
+            return signatures[image]
+
+        buckets = self._connection.execute(
+            'SELECT group_concat(image) FROM buckets GROUP BY band, bucket HAVING COUNT(*) > 1')
+        for images, in buckets:
+            images = [int(image) for image in images.split(',')]
+            first = images[0]
+            for image in images[1:]:
+                if find(image) != find(first) and similarity(signature(first), signature(image)) >= threshold:
+                    parent[find(image)] = find(first)
+
+        groups = {}
+        for image in parent:
+            groups.setdefault(find(image), set()).update((image, find(image)))
+        paths = dict(self._connection.execute('SELECT id, path FROM signatures'))
+        return sorted((sorted(paths[image] for image in group) for group in groups.values()),
+                      key=lambda group: (-len(group), group))
+
+    def stats(self):
+        execute = self._connection.execute
+        return {
+            'images': execute('SELECT COUNT(*) FROM signatures').fetchone()[0],
+            'buckets': execute('SELECT COUNT(*) FROM (SELECT 1 FROM buckets GROUP BY band, bucket)').fetchone()[0],
+        }
+
+
+def update_similar(index, images, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    # Compute the signatures of the images not indexed yet (or changed)
+    # and yield one result per image (without the signature)
+    return update_images(index, images, signature_image,
+                         lambda result: {'size': result['size'], 'elements': result['elements']}, workers, chunksize)
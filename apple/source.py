@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Where an image is read from
+
+A Disk can be opened from:
+- a plain image file, read (or mapped) by Disk itself
+- a compressed image file: game.dsk.gz, game.po.bz2, game.2mg.xz
+- a member of a zip file: collection.zip!games/game.dsk (the member
+  can be compressed too: collection.zip!game.dsk.gz)
+- bytes, a bytearray or any buffer already in memory (or a MemoryImage,
+  which gives it a name)
+
+The compressed images and the zip members are decompressed as a
+stream, straight into the buffer of the image (no temporary file),
+then the Disk reads its sectors from this buffer. Only the plain files
+can be written back (see Disk.flush).
+
+The zip files opened last are kept open in each process (their
+directory is only read once), so a batch can read all the members of
+a big zip quickly.
+"""
+import bz2
+import gzip
+import lzma
+import os
+import zipfile
+
+from apple.helpers import LRUCache
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+# How to open each compressed file, from its extension
+COMPRESSED_EXTENSIONS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+}
+ARCHIVE_EXTENSIONS = ('.zip',)
+
+# Between the name of a zip file and the name of its member
+MEMBER_SEPARATOR = '!'
+
+# Name of an image given as bytes
+MEMORY_NAME = '<memory>'
+
+# Never decompress more than that (the biggest image is a 32 MB
+# ProDOS volume), a damaged (or malicious) file could be endless
+MAX_IMAGE_SIZE = 64 * 1024 * 1024
+
+# Size of each read from a decompressed stream
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Number of zip files kept open by each process
+OPEN_ARCHIVES = 4
+
+# The errors of the decompression, DiskfileError for the Disk
+SOURCE_ERRORS = (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile, lzma.LZMAError)
+
+
+class MemoryImage:
+    """An image already in memory, with a name for the messages"""
+    __slots__ = ('name', 'data')
+
+    def __init__(self, data, name=MEMORY_NAME):
+        self.name = name
+        self.data = memoryview(data).cast('B')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return 'MemoryImage({!r}, {} bytes)'.format(self.name, len(self.data))
+
+
+def split_member(diskname):
+    # Return (zip filename, member name), or (diskname, None) for a file
+    if MEMBER_SEPARATOR in diskname and not os.path.exists(diskname):
+        lower = diskname.lower()
+        for extension in ARCHIVE_EXTENSIONS:
+            index = lower.find(extension + MEMBER_SEPARATOR)
+            if index >= 0:
+                end = index + len(extension)
+                return diskname[:end], diskname[end + len(MEMBER_SEPARATOR):]
+    return diskname, None
+
+
+def container_path(diskname):
+    # The file holding the image (the zip file for a member)
+    return split_member(diskname)[0]
+
+
+def _compression(name):
+    # Extension of the compression of a filename (or None)
+    extension = os.path.splitext(name)[1].lower()
+    return extension if extension in COMPRESSED_EXTENSIONS else None
+
+
+def image_name(diskname):
+    # Name of the image itself: without the zip file and the
+    # extension of the compression (collection.zip!game.dsk.gz -> game.dsk)
+    name = os.path.basename(split_member(diskname)[1] or diskname)
+    if _compression(name):
+        name = os.path.splitext(name)[0]
+    return name
+
+
+def image_extension(diskname):
+    # Extension of the image, whatever its compression (.dsk for game.dsk.gz)
+    return os.path.splitext(image_name(diskname))[1].lower()
+
+
+def source_name(source):
+    # Name of an image given as a path or a MemoryImage
+    if isinstance(source, MemoryImage):
+        return source.name
+    if isinstance(source, str):
+        return source
+    return MEMORY_NAME
+
+
+def is_stream_source(diskname):
+    # True if the image must be decompressed (or read from a zip file)
+    return split_member(diskname)[1] is not None or _compression(diskname) is not None
+
+
+def source_size(diskname):
+    # Size of what is stored for an image: the file (compressed or
+    # not), or the member of a zip file (compressed)
+    # apple.disk imports this module, DiskfileError is imported here
+    from apple.disk import DiskfileError
+
+    archive, member = split_member(diskname)
+    try:
+        if member is None:
+            return os.stat(diskname).st_size
+        return _open_archive(archive).getinfo(member).compress_size
+    except (FileNotFoundError, KeyError):
+        raise DiskfileError(diskname, 'not found')
+    except (OSError, zipfile.BadZipFile) as error:
+        raise DiskfileError(diskname, 'cannot be read ({})'.format(error))
+
+
+# The last zip files opened by this process
+_archives = LRUCache(OPEN_ARCHIVES)
+
+
+def _open_archive(path):
+    # A zip file is opened again only if it changed
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    archive = _archives.get(key)
+    if archive is None:
+        archive = zipfile.ZipFile(path)
+        for old_key, old_archive in _archives.put(key, archive):
+            old_archive.close()
+    return archive
+
+
+def close_archives():
+    # Close the zip files kept open
+    for key, archive in _archives.items():
+        archive.close()
+    _archives.clear()
+
+
+def iter_archive(path, extensions):
+    # Yield the name (zip!member) of each image of a zip file, the
+    # compressed images too
+    archive = _open_archive(path)
+    for info in archive.infolist():
+        if not info.is_dir() and image_extension(info.filename) in extensions:
+            yield '{}{}{}'.format(path, MEMBER_SEPARATOR, info.filename)
+
+
+def read_stream(stream, size=None):
+    # Read a whole stream in a new bytearray, by chunks written
+    # directly in the buffer (no copy of each chunk)
+    if size is not None:
+        if size > MAX_IMAGE_SIZE:
+            raise ValueError('image of {} bytes, more than {}'.format(size, MAX_IMAGE_SIZE))
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        position = 0
+        while position < size:
+            count = stream.readinto(view[position:position + STREAM_CHUNK_SIZE])
+            if not count:
+                raise EOFError('image shorter than {} bytes'.format(size))
+            position += count
+        return buffer
+
+    buffer = bytearray()
+    chunk = bytearray(STREAM_CHUNK_SIZE)
+    view = memoryview(chunk)
+    while True:
+        count = stream.readinto(chunk)
+        if not count:
+            return buffer
+        buffer += view[:count]
+        if len(buffer) > MAX_IMAGE_SIZE:
+            raise ValueError('image bigger than {} bytes'.format(MAX_IMAGE_SIZE))
+
+
+def load_image(diskname):
+    # Decompress an image (a compressed file or a zip member)
+    # in memory and return it as a MemoryImage
+    archive, member = split_member(diskname)
+    if member is None:
+        with COMPRESSED_EXTENSIONS[_compression(diskname)](diskname, 'rb') as stream:
+            return MemoryImage(read_stream(stream), diskname)
+
+    with _open_archive(archive).open(member) as stream:
+        compression = _compression(member)
+        if compression is None:
+            return MemoryImage(read_stream(stream, _open_archive(archive).getinfo(member).file_size), diskname)
+        # A compressed member: decompressed twice, as a stream
+        with COMPRESSED_EXTENSIONS[compression](stream, 'rb') as inner:
+            return MemoryImage(read_stream(inner), diskname)
+
+
+def open_source(source):
+    # What Disk reads: a MemoryImage for everything in memory or
+    # decompressed, else the filename of the plain file
+    if isinstance(source, MemoryImage):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return MemoryImage(source)
+    if isinstance(source, os.PathLike):
+        source = os.fspath(source)
+    if isinstance(source, str) and is_stream_source(source):
+        return load_image(source)
+    return source
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and timers of the reads (instrumentation)
+
+Off by default, and then nothing is measured and nothing is slower:
+enable() wraps the methods to measure (Disk.read_ts,
+DiskProdos.read_block...) in the classes themselves, and the functions
+(probe, load_source) in the modules using them. disable() puts the
+original ones back.
+
+Counters, for each image and in total:
+- sector_reads, track_reads (read_ts of a whole track), block_reads
+- bytes_viewed: bytes returned as a view of the image (mmap, page of
+  a paged image), nothing copied
+- bytes_copied: bytes returned in a new buffer (array storage, a
+  block joined from 2 sectors, read_block_list...)
+- block_cache_hits/misses: directory and index blocks of ProDOS
+- page_hits/misses: pages of a big image (see apple.paged)
+- catalog_cache_hits/misses: metadata from the cache (see apple.cache)
+
+Stages, the number of calls and the time spent (<stage>_seconds for
+each image), a stage can be inside another one (the probe loads the
+image):
+- load: image read, decompressed or mapped
+- probe: system and order found
+- vtoc: VTOC and bitmap of the free sectors (or blocks)
+- catalog: catalog sectors or directory blocks walked
+- extract: content of the files read
+
+The workers of a batch (apple.batch.run_batch) measure their own reads
+and send them back with each result, so the totals are for the whole
+batch.
+
+Environment (read by run_cli, used by all the scripts):
+    ADIR_STATS:     1 to print the counters in JSON on stderr at the
+                    end, or a filename to save them
+    ADIR_PROFILE:   Filename of a cProfile report of the whole run
+                    (python -m pstats FILENAME)
+"""
+from collections import Counter
+import cProfile
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import sys
+import time
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.3'
+
+STAGES = ('load', 'probe', 'vtoc', 'catalog', 'extract')
+
+# Counters of each image (the stages: <stage>_seconds)
+_images = {}
+# Stage: [calls, seconds]
+_stages = {}
+# (owner, name, original) of everything wrapped by enable()
+_patched = []
+
+
+def is_enabled():
+    return bool(_patched)
+
+
+def reset():
+    _images.clear()
+    _stages.clear()
+
+
+def _image_counter(image):
+    # image: a path, a MemoryImage or a Disk
+    name = getattr(image, '_diskname', image)
+    if not isinstance(name, str):
+        name = getattr(name, 'name', '<memory>')
+    counter = _images.get(name)
+    if counter is None:
+        counter = _images[name] = Counter()
+    return counter
+
+
+def count(image, name, value=1):
+    # Add to a counter of an image
+    _image_counter(image)[name] += value
+
+
+def add_stage(stage, image, seconds):
+    calls = _stages.setdefault(stage, [0, 0.0])
+    calls[0] += 1
+    calls[1] += seconds
+    _image_counter(image)[stage + '_seconds'] += seconds
+
+
+@contextmanager
+def stage(name, image='<none>'):
+    # Time a stage (only when enabled), a block of code or a call
+    # (see _timed)
+    if not _patched:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage(name, image, time.perf_counter() - start)
+
+
+def snapshot():
+    # Everything measured, a dictionnary for JSON
+    totals = Counter()
+    for counter in _images.values():
+        totals.update(counter)
+    return {
+        'totals': dict(totals),
+        'stages': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in _stages.items()},
+        'images': {name: dict(counter) for name, counter in _images.items()},
+    }
+
+
+def merge(values):
+    # Add a snapshot (of a worker) to our counters
+    for name, counter in values['images'].items():
+        _image_counter(name).update(counter)
+    for name, value in values['stages'].items():
+        calls = _stages.setdefault(name, [0, 0.0])
+        calls[0] += value['calls']
+        calls[1] += value['seconds']
+
+
+def _count_buffer(counter, value):
+    # A view of the image (not of a new bytes object) copied nothing
+    if isinstance(value, memoryview):
+        counter['bytes_copied' if isinstance(value.obj, bytes) else 'bytes_viewed'] += value.nbytes
+    elif value is not None:
+        counter['bytes_copied'] += len(value)
+
+
+def _read_ts(method):
+    @wraps(method)
+    def read_ts(self, track=0, sector=0, byte_to_read=None):
+        value = method(self, track, sector, byte_to_read)
+        counter = _image_counter(self)
+        counter['track_reads' if sector is None else 'sector_reads'] += 1
+        _count_buffer(counter, value)
+        return value
+    return read_ts
+
+
+def _read_block(method):
+    @wraps(method)
+    def read_block(self, block):
+        value = method(self, block)
+        counter = _image_counter(self)
+        counter['block_reads'] += 1
+        _count_buffer(counter, value)
+        return value
+    return read_block
+
+
+def _read_block_list(method):
+    @wraps(method)
+    def read_block_list(self, blocks, buffer=None, sparse=False):
+        blocks = list(blocks)
+        value = method(self, blocks, buffer, sparse)
+        counter = _image_counter(self)
+        counter['block_reads'] += len(blocks)
+        counter['bytes_copied'] += len(blocks) * 512
+        return value
+    return read_block_list
+
+
+def _cached(method, prefix, cache_name):
+    # Hits and misses of a cache (an LRUCache attribute) indexed by
+    # the first argument of the method
+    @wraps(method)
+    def cached(self, key, *args, **kwargs):
+        counter = _image_counter(self)
+        counter[prefix + ('_hits' if key in getattr(self, cache_name) else '_misses')] += 1
+        return method(self, key, *args, **kwargs)
+    return cached
+
+
+def _page(method):
+    @wraps(method)
+    def page(self, number):
+        hit = number in self._pages or number in self._dirty_pages
+        _image_counter(self)['page_hits' if hit else 'page_misses'] += 1
+        return method(self, number)
+    return page
+
+
+def _catalog_cache_lookup(method):
+    @wraps(method)
+    def lookup(self, diskname):
+        value = method(self, diskname)
+        if self.enabled:
+            count(diskname, 'catalog_cache_misses' if value[0] is None else 'catalog_cache_hits')
+        return value
+    return lookup
+
+
+def _timed(stage_name):
+    # Time a method, or a function of an image (its first argument)
+    def wrap(function):
+        @wraps(function)
+        def timed(image, *args, **kwargs):
+            with stage(stage_name, image):
+                return function(image, *args, **kwargs)
+        return timed
+    return wrap
+
+
+def _timed_generator(stage_name):
+    # Time the work of a generator, only while it's running (not while
+    # the caller uses the values), until it ends or is closed
+    def wrap(method):
+        @wraps(method)
+        def timed(self, *args, **kwargs):
+            iterator = method(self, *args, **kwargs)
+            elapsed = 0.0
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        value = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    yield value
+            finally:
+                iterator.close()
+                add_stage(stage_name, self, elapsed)
+        return timed
+    return wrap
+
+
+def _patch(owner, name, wrapper):
+    original = owner.__dict__[name]
+    _patched.append((owner, name, original))
+    setattr(owner, name, wrapper(original))
+
+
+def _patch_function(module, name, wrapper):
+    # Replace a function in its module and in every module which
+    # imported it (from module import name)
+    original = getattr(module, name)
+    replacement = wrapper(original)
+    for other in list(sys.modules.values()):
+        if getattr(other, name, None) is original:
+            _patched.append((other, name, original))
+            setattr(other, name, replacement)
+
+
+def enable():
+    # Start measuring (the counters are kept, see reset)
+    if _patched:
+        return
+    from apple import cache, disk, dos, paged, probe, prodos
+
+    _patch(disk.Disk, 'read_ts', _read_ts)
+    _patch(disk.Disk, '_load', _timed('load'))
+    _patch(disk.Disk, '_load_memory', _timed('load'))
+    _patch(prodos.DiskProdos, 'read_block', _read_block)
+    _patch(prodos.DiskProdos, 'read_block_list', _read_block_list)
+    _patch(prodos.DiskProdos, 'read_block_cached', lambda method: _cached(method, 'block_cache', '_block_cache'))
+    _patch(prodos.DiskProdos, 'read_free_map', _timed('vtoc'))
+    _patch(prodos.DiskProdos, 'iter_directory', _timed_generator('catalog'))
+    _patch(prodos.DiskProdos, 'iter_file', _timed_generator('extract'))
+    _patch(dos.DiskDos33, '_read_vtoc', _timed('vtoc'))
+    _patch(dos.DiskDos33, 'read_free_map', _timed('vtoc'))
+    _patch(dos.DiskDos33, 'iter_catalog', _timed_generator('catalog'))
+    _patch(dos.DiskDos33, 'iter_file', _timed_generator('extract'))
+    _patch(paged.PagedImage, 'page', _page)
+    _patch(cache.CatalogCache, 'lookup', _catalog_cache_lookup)
+    _patch_function(disk, 'load_source', _timed('load'))
+    _patch_function(probe, 'probe', _timed('probe'))
+
+
+def disable():
+    # Put back the original methods and functions
+    while _patched:
+        owner, name, original = _patched.pop()
+        setattr(owner, name, original)
+
+
+def init_worker(initializer=None, initargs=()):
+    # Initializer of the processes of a batch: measure from zero, what
+    # the initializer measures is sent with the first result
+    reset()
+    enable()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def call_with_stats(function, item):
+    # Call function in a worker, return its result and what was
+    # measured since the last result sent (then counted from zero
+    # again, so nothing is sent twice and nothing is lost)
+    result = function(item)
+    values = snapshot()
+    reset()
+    return result, values
+
+
+def _report(values):
+    # Save (or print) the counters as asked by ADIR_STATS
+    target = os.environ.get('ADIR_STATS', '')
+    text = json.dumps(values, indent=2)
+    if target.lower() in ('1', 'true', 'yes'):
+        print(text, file=sys.stderr)
+    else:
+        with open(target, 'w') as report:
+            report.write(text + '\n')
+
+
+def run_cli(main, *args):
+    # Run the main function of a script, measured (ADIR_STATS) and/or
+    # profiled (ADIR_PROFILE), the reports are written even when the
+    # script stops with exit()
+    measured = os.environ.get('ADIR_STATS', '') not in ('', '0')
+    profile_path = os.environ.get('ADIR_PROFILE', '')
+    if not measured and not profile_path:
+        return main(*args)
+
+    if measured:
+        enable()
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        return main(*args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if measured:
+            _report(snapshot())
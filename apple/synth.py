@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic disk images
+
+Images built from scratch for the benchmarks (see apple.bench), so we
+can measure the package on disks bigger or stranger than the 2 sample
+images:
+- dos_image: a DOS 3.3 disk with any number of files, its catalog can
+  be longer than the 15 sectors of track $11 (the next catalog sectors
+  are taken anywhere on the disk)
+- prodos_image: a ProDOS volume from 280 blocks (a floppy) to 65535
+  blocks (32 MB), with nested directories and seedling, sapling or
+  tree files
+- corrupt_image: random bytes changed in a part of an image
+
+Everything is built in a bytearray in the order of the format (DOS
+order for DOS 3.3, ProDOS order for ProDOS, see apple.order to write
+a ProDOS floppy as a .dsk). The content of the files comes from a
+random generator with a seed, so the same arguments always give the
+same image.
+"""
+import random
+import struct
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+SECTOR_SIZE = 256
+BLOCK_SIZE = 512
+
+# DOS 3.3
+DOS_TRACKS = 35
+DOS_SECTORS = 16
+VTOC_TRACK = 0x11
+TS_PAIRS = 122
+CATALOG_ENTRIES = 7
+CATALOG_ENTRY_SIZE = 0x23
+DOS_NAME_SIZE = 30
+DOS_FILE_TYPE_BINARY = 0x04
+
+# ProDOS
+FLOPPY_BLOCKS = 280
+MAX_BLOCKS = 0xFFFF
+VOLUME_DIRECTORY_BLOCK = 2
+VOLUME_DIRECTORY_BLOCKS = 4
+ENTRY_LENGTH = 0x27
+ENTRIES_PER_BLOCK = 0x0D
+BITMAP_BLOCK_BITS = BLOCK_SIZE * 8
+PRODOS_FILE_TYPE_BIN = 0x06
+PRODOS_FILE_TYPE_DIR = 0x0F
+ACCESS_ALL = 0xE3
+
+
+def _dos_name(name):
+    # Name of a catalog entry: Apple ASCII (high bit set), padded with spaces
+    return bytes(char | 0x80 for char in name.upper().encode('ascii')[:DOS_NAME_SIZE]).ljust(DOS_NAME_SIZE, b'\xA0')
+
+
+def dos_image(files=105, sectors_per_file=1, catalog_sectors=15, volume=254, deleted=0, seed=0):
+    """A DOS 3.3 disk (35 tracks, 16 sectors, DOS order)
+
+    files:              number of BINARY files in the catalog
+    sectors_per_file:   data sectors of each file (more than 122 uses
+                        several T/S lists)
+    catalog_sectors:    length of the catalog chain (at least enough
+                        for the files, 7 entries per sector)
+    deleted:            how many of the files are deleted
+    """
+    catalog_sectors = max(catalog_sectors, -(-files // CATALOG_ENTRIES), 1)
+    generator = random.Random(seed)
+    image = bytearray(DOS_TRACKS * DOS_SECTORS * SECTOR_SIZE)
+    used = bytearray(DOS_TRACKS * DOS_SECTORS)
+
+    def position(unit):
+        return unit * SECTOR_SIZE
+
+    # The DOS on tracks 0 to 2, the VTOC and the catalog on track $11
+    for unit in range(3 * DOS_SECTORS):
+        used[unit] = 1
+    used[VTOC_TRACK * DOS_SECTORS] = 1
+    # The free sectors from track $12 up, then from track $10 down
+    pool = [track * DOS_SECTORS + sector
+            for track in list(range(VTOC_TRACK + 1, DOS_TRACKS)) + list(range(VTOC_TRACK - 1, 2, -1))
+            for sector in range(DOS_SECTORS - 1, -1, -1)]
+    pool.reverse()
+
+    def allocate():
+        if not pool:
+            raise ValueError('The files don\'t fit on the disk')
+        unit = pool.pop()
+        used[unit] = 1
+        return unit
+
+    # Catalog chain: sectors $0F to $01 of track $11, then anywhere
+    catalog = [VTOC_TRACK * DOS_SECTORS + sector for sector in range(DOS_SECTORS - 1, 0, -1)][:catalog_sectors]
+    for unit in catalog:
+        used[unit] = 1
+    while len(catalog) < catalog_sectors:
+        catalog.append(allocate())
+    for unit, following in zip(catalog, catalog[1:] + [None]):
+        if following is not None:
+            image[position(unit) + 1:position(unit) + 3] = bytes(divmod(following, DOS_SECTORS))
+
+    for index in range(files):
+        # T/S lists and data sectors
+        sectors = [allocate() for _ in range(sectors_per_file)]
+        ts_lists = [allocate() for _ in range(max(1, -(-sectors_per_file // TS_PAIRS)))]
+        for number, ts_unit in enumerate(ts_lists):
+            start = position(ts_unit)
+            if number + 1 < len(ts_lists):
+                image[start + 1:start + 3] = bytes(divmod(ts_lists[number + 1], DOS_SECTORS))
+            image[start + 5:start + 7] = struct.pack('<H', number * TS_PAIRS)
+            for pair, unit in enumerate(sectors[number * TS_PAIRS:(number + 1) * TS_PAIRS]):
+                image[start + 0x0C + 2 * pair:start + 0x0E + 2 * pair] = bytes(divmod(unit, DOS_SECTORS))
+        data = bytearray(generator.getrandbits(8 * SECTOR_SIZE * sectors_per_file).to_bytes(
+            SECTOR_SIZE * sectors_per_file, 'little'))
+        # BINARY header: address and length
+        data[0:4] = struct.pack('<HH', 0x0800, len(data) - 4)
+        for number, unit in enumerate(sectors):
+            image[position(unit):position(unit) + SECTOR_SIZE] = data[number * SECTOR_SIZE:(number + 1) * SECTOR_SIZE]
+
+        # File Descriptive Entry
+        name = _dos_name('FILE{:04d}'.format(index))
+        track, sector = divmod(ts_lists[0], DOS_SECTORS)
+        if index >= files - deleted:
+            # The original track is kept in the last byte of the name,
+            # the sectors of the file are free again
+            name = name[:-1] + bytes([track])
+            track = 0xFF
+            for unit in sectors + ts_lists:
+                used[unit] = 0
+        entry = bytes([track, sector, DOS_FILE_TYPE_BINARY]) + name + \
+            struct.pack('<H', len(ts_lists) + sectors_per_file)
+        start = position(catalog[index // CATALOG_ENTRIES]) + 0x0B + (index % CATALOG_ENTRIES) * CATALOG_ENTRY_SIZE
+        image[start:start + CATALOG_ENTRY_SIZE] = entry
+
+    # VTOC
+    vtoc = position(VTOC_TRACK * DOS_SECTORS)
+    first_track, first_sector = divmod(catalog[0], DOS_SECTORS)
+    image[vtoc + 0x01] = first_track
+    image[vtoc + 0x02] = first_sector
+    image[vtoc + 0x03] = 3
+    image[vtoc + 0x06] = volume
+    image[vtoc + 0x27] = TS_PAIRS
+    image[vtoc + 0x30] = VTOC_TRACK + 1
+    image[vtoc + 0x31] = 1
+    image[vtoc + 0x34] = DOS_TRACKS
+    image[vtoc + 0x35] = DOS_SECTORS
+    image[vtoc + 0x36:vtoc + 0x38] = struct.pack('<H', SECTOR_SIZE)
+    for track in range(DOS_TRACKS):
+        # 1 = free, sectors F..8 in the first byte, 7..0 in the second one
+        bits = sum(1 << sector for sector in range(DOS_SECTORS) if not used[track * DOS_SECTORS + sector])
+        image[vtoc + 0x38 + 4 * track:vtoc + 0x3A + 4 * track] = bits.to_bytes(2, 'big')
+    return image
+
+
+class _Volume:
+    # A ProDOS volume being built: the image and a block allocator
+    def __init__(self, blocks, name, seed):
+        self.image = bytearray(blocks * BLOCK_SIZE)
+        self.blocks = blocks
+        self.name = name
+        self.random = random.Random(seed)
+        bitmap_blocks = -(-blocks // BITMAP_BLOCK_BITS)
+        self.bitmap = VOLUME_DIRECTORY_BLOCK + VOLUME_DIRECTORY_BLOCKS
+        self.next_block = self.bitmap + bitmap_blocks
+
+    def allocate(self, count=1):
+        first = self.next_block
+        if first + count > self.blocks:
+            raise ValueError('The files don\'t fit in {} blocks'.format(self.blocks))
+        self.next_block += count
+        return list(range(first, first + count))
+
+    def block(self, number):
+        return memoryview(self.image)[number * BLOCK_SIZE:(number + 1) * BLOCK_SIZE]
+
+    def write_index(self, index_block, pointers):
+        # LO bytes in the first half of an index block, HI bytes in the second one
+        block = self.block(index_block)
+        for number, pointer in enumerate(pointers):
+            block[number] = pointer & 0xFF
+            block[256 + number] = pointer >> 8
+
+    def add_file(self, size):
+        # Write a file of size bytes, return (storage type, key block, blocks used)
+        count = max(1, -(-size // BLOCK_SIZE))
+        data = self.random.getrandbits(8 * size).to_bytes(size, 'little') if size else b''
+        blocks = self.allocate(count)
+        for number, block in enumerate(blocks):
+            chunk = data[number * BLOCK_SIZE:(number + 1) * BLOCK_SIZE]
+            self.block(block)[:len(chunk)] = chunk
+        if count == 1:
+            return 0x1, blocks[0], 1
+        if count <= 256:
+            index = self.allocate()[0]
+            self.write_index(index, blocks)
+            return 0x2, index, count + 1
+        master = self.allocate()[0]
+        indexes = self.allocate(-(-count // 256))
+        for number, index in enumerate(indexes):
+            self.write_index(index, blocks[number * 256:(number + 1) * 256])
+        self.write_index(master, indexes)
+        return 0x3, master, count + 1 + len(indexes)
+
+
+def _entry(storage_type, name, file_type, key, blocks_used, eof, header_pointer):
+    entry = bytearray(ENTRY_LENGTH)
+    name = name.encode('ascii')
+    entry[0x00] = (storage_type << 4) | len(name)
+    entry[0x01:0x01 + len(name)] = name
+    entry[0x10] = file_type
+    entry[0x11:0x15] = struct.pack('<HH', key, blocks_used)
+    entry[0x15:0x18] = struct.pack('<I', eof)[:3]
+    entry[0x1E] = ACCESS_ALL
+    entry[0x1F:0x21] = struct.pack('<H', 0x2000)
+    entry[0x25:0x27] = struct.pack('<H', header_pointer)
+    return entry
+
+
+def _write_directory(volume, blocks, header, entries):
+    # Link the blocks of a directory and write its header and entries
+    for number, block in enumerate(blocks):
+        previous = blocks[number - 1] if number else 0
+        following = blocks[number + 1] if number + 1 < len(blocks) else 0
+        volume.block(block)[0:4] = struct.pack('<HH', previous, following)
+    for number, entry in enumerate([header] + entries):
+        block, index = divmod(number, ENTRIES_PER_BLOCK)
+        start = 0x04 + index * ENTRY_LENGTH
+        volume.block(blocks[block])[start:start + ENTRY_LENGTH] = entry
+
+
+def _directory_header(storage_type, name, file_count, pointer, extra):
+    header = bytearray(ENTRY_LENGTH)
+    name = name.encode('ascii')
+    header[0x00] = (storage_type << 4) | len(name)
+    header[0x01:0x01 + len(name)] = name
+    header[0x1E] = ACCESS_ALL
+    header[0x1F] = ENTRY_LENGTH
+    header[0x20] = ENTRIES_PER_BLOCK
+    header[0x21:0x25] = struct.pack('<HH', file_count, pointer)
+    header[0x25:0x27] = extra
+    return header
+
+
+def _fill_directory(volume, key_blocks, depth, files, file_size, subdirectories):
+    # Files of a directory (and its subdirectories, depth levels
+    # below it), return the entries of the directory
+    entries = []
+    for index in range(files):
+        size = file_size(index) if callable(file_size) else file_size
+        storage_type, key, used = volume.add_file(size)
+        entries.append(_entry(storage_type, 'FILE{:04d}'.format(index), PRODOS_FILE_TYPE_BIN, key, used, size,
+                              key_blocks[0]))
+    if depth > 0:
+        for index in range(subdirectories):
+            count = -(-(files + subdirectories + 1) // ENTRIES_PER_BLOCK)
+            blocks = volume.allocate(count)
+            name = 'DIR{:02d}'.format(index)
+            # Entry number in the parent directory (the header is
+            # the entry 1 of the key block)
+            parent_entry = len(entries) + 1
+            children = _fill_directory(volume, blocks, depth - 1, files, file_size, subdirectories)
+            # Parent pointer, parent entry number and length
+            header = _directory_header(0xE, name, len(children), key_blocks[(parent_entry // ENTRIES_PER_BLOCK)],
+                                       bytes([parent_entry % ENTRIES_PER_BLOCK + 1, ENTRY_LENGTH]))
+            header[0x10] = 0x75
+            _write_directory(volume, blocks, header, children)
+            entries.append(_entry(0xD, name, PRODOS_FILE_TYPE_DIR, blocks[0], count, count * BLOCK_SIZE,
+                                  key_blocks[0]))
+    return entries
+
+
+def prodos_image(blocks=FLOPPY_BLOCKS, files=10, file_size=1024, depth=0, subdirectories=1, name='SYNTH', seed=0):
+    """A ProDOS volume (ProDOS order)
+
+    files:          number of files in each directory
+    file_size:      size of each file in bytes, or a function giving the
+                    size of the file n of a directory (a seedling up to
+                    512 bytes, a sapling up to 128 KB, else a tree)
+    depth:          levels of subdirectories below the volume directory
+    subdirectories: subdirectories in each directory (not at the last level)
+    """
+    blocks = min(blocks, MAX_BLOCKS)
+    volume = _Volume(blocks, name, seed)
+    # The volume directory is 4 blocks, more if needed
+    count = max(VOLUME_DIRECTORY_BLOCKS, -(-(files + subdirectories + 1) // ENTRIES_PER_BLOCK))
+    key_blocks = list(range(VOLUME_DIRECTORY_BLOCK, VOLUME_DIRECTORY_BLOCK + VOLUME_DIRECTORY_BLOCKS))
+    if count > VOLUME_DIRECTORY_BLOCKS:
+        key_blocks += volume.allocate(count - VOLUME_DIRECTORY_BLOCKS)
+    entries = _fill_directory(volume, key_blocks, depth, files, file_size, subdirectories)
+    header = _directory_header(0xF, name, len(entries), volume.bitmap, struct.pack('<H', blocks))
+    _write_directory(volume, key_blocks, header, entries)
+
+    # Volume bitmap: 1 = free, the blocks are allocated from 0
+    bits = (1 << (blocks - volume.next_block)) - 1
+    bitmap_size = -(-blocks // BITMAP_BLOCK_BITS) * BLOCK_SIZE
+    bitmap = (bits << (bitmap_size * 8 - blocks)).to_bytes(bitmap_size, 'big')
+    start = volume.bitmap * BLOCK_SIZE
+    volume.image[start:start + bitmap_size] = bitmap
+    return volume.image
+
+
+def corrupt_image(image, count=16, start=0, end=None, seed=0):
+    # Change count random bytes of the image between start and end
+    # (in place), return the image
+    generator = random.Random(seed)
+    end = len(image) if end is None else end
+    for _ in range(count):
+        position = generator.randrange(start, end)
+        image[position] ^= generator.randrange(1, 256)
+    return image
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+2IMG images (.2mg, .2img)
+
+A 2IMG file is a disk image after a header (64 bytes, little endian):
+00-03   '2IMG'
+04-07   Creator
+08-09   Size of the header
+0A-0B   Version
+0C-0F   Format of the image: 0 = DOS order, 1 = ProDOS order, 2 = nibbles
+10-13   Flags (bit 31: locked, bit 8: the volume number is in bits 0-7)
+14-17   Number of blocks (ProDOS order)
+18-1B   Offset of the image in the file
+1C-1F   Length of the image
+20-3F   Offsets and lengths of the comment and the creator data
+
+Only the header is read, the image itself is read like any other image
+from its offset in the file.
+"""
+import struct
+
+from apple.order import ORDER_DOS, ORDER_PRODOS
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+TWOIMG_EXTENSIONS = ('.2mg', '.2img')
+TWOIMG_MAGIC = b'2IMG'
+TWOIMG_HEADER = struct.Struct('<4s4sHHIIIII')
+
+TWOIMG_FORMAT_DOS = 0
+TWOIMG_FORMAT_PRODOS = 1
+TWOIMG_FORMAT_NIBBLE = 2
+
+
+def read_2img_header(diskname):
+    # Return the header of a 2IMG file as a dictionnary,
+    # None if the file is not a 2IMG file
+    with open(diskname, 'rb') as diskfile:
+        header = diskfile.read(TWOIMG_HEADER.size)
+        diskfile.seek(0, 2)
+        return parse_2img_header(header, diskfile.tell())
+
+
+def parse_2img_header(header, file_size):
+    # The header from the first bytes of a 2IMG file (or None)
+    header = bytes(header[:TWOIMG_HEADER.size])
+    if len(header) < TWOIMG_HEADER.size or not header.startswith(TWOIMG_MAGIC):
+        return None
+
+    magic, creator, header_size, version, image_format, flags, blocks, data_offset, data_length = \
+        TWOIMG_HEADER.unpack(header)
+    # Some tools write 0 for the length of a ProDOS image
+    if data_length == 0 and image_format == TWOIMG_FORMAT_PRODOS:
+        data_length = blocks * 512
+    if image_format not in (TWOIMG_FORMAT_DOS, TWOIMG_FORMAT_PRODOS, TWOIMG_FORMAT_NIBBLE) or \
+            data_offset < header_size or data_offset + data_length > file_size:
+        return None
+    return {
+        'creator': creator.decode('latin-1'),
+        'version': version,
+        'format': image_format,
+        'order': ORDER_PRODOS if image_format == TWOIMG_FORMAT_PRODOS else ORDER_DOS,
+        'locked': bool(flags & 0x80000000),
+        'volume': flags & 0xFF if flags & 0x100 else None,
+        'blocks': blocks,
+        'data_offset': data_offset,
+        'data_length': data_length,
+    }
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python bench.py run [-o RESULTS] [-r REPEAT] [-k NAME] [-d DIRECTORY] [-b BASELINE] [-t TOLERANCE]
+       python bench.py compare [-t TOLERANCE] OLD NEW
+       python bench.py images DIRECTORY
+       python bench.py list
+
+Benchmarks of the package on synthetic images (full and long DOS 3.3
+catalogs, a corrupted disk, deep directories and a 32 MB ProDOS volume).
+    run:     build the images, time each benchmark and save the results
+             in JSON (one line per benchmark on stderr)
+    compare: the ratio of the times of 2 runs for each benchmark, the
+             exit code is 1 if one of them is slower
+    images:  only build the images, in DIRECTORY
+    list:    names of the benchmarks
+
+Options:
+    -o RESULTS:     Results filename (default = bench-DATE.json)   [optional]
+    -r REPEAT:      How many times each loop is timed (default = 5)  [optional]
+    -k NAME:        Only this benchmark (can be repeated)           [optional]
+    -d DIRECTORY:   Where the images are built (default = a temporary
+                    directory)                                      [optional]
+    -b BASELINE:    Results of a previous run to compare with       [optional]
+    -t TOLERANCE:   Slower or faster above this ratio (default = 0.10)  [optional]
+
+Examples:
+  python bench.py run -o before.json
+  python bench.py run -b before.json -o after.json
+  python bench.py run -k catalog_dos_long -k dump_disk
+  python bench.py compare before.json after.json
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import sys
+import tempfile
+import time
+
+from apple.bench import BENCHMARKS, write_images, run_benchmarks, new_results, compare_results, format_time, \
+    DEFAULT_REPEAT, DEFAULT_TOLERANCE
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+
+def _show_comparison(rows):
+    # Print the comparison, return True if a benchmark is slower
+    for row in rows:
+        ratio = '{:.2f}x'.format(row['ratio']) if 'ratio' in row else ''
+        print('{:<26} {:>10} {:>10} {:>7}  {}'.format(row['name'], format_time(row['old']), format_time(row['new']),
+                                                      ratio, row['status']))
+    return any(row['status'] == 'slower' for row in rows)
+
+
+def _run(args):
+    results = new_results()
+    with tempfile.TemporaryDirectory(prefix='adir-bench-') as directory:
+        paths = write_images(args.directory or directory)
+        for name, result in run_benchmarks(paths, args.names, args.repeat):
+            results['benchmarks'][name] = result
+            print('{:<26} {:>10} {:>10}  ({} loops)'.format(name, format_time(result['best']),
+                                                            format_time(result['median']), result['loops']),
+                  file=sys.stderr)
+
+    output = args.output or 'bench-{}.json'.format(time.strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print('Results saved in {}'.format(output), file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if args.names:
+            # Only the benchmarks of this run
+            baseline['benchmarks'] = {name: result for name, result in baseline['benchmarks'].items()
+                                      if name in args.names}
+        if _show_comparison(compare_results(baseline, results, args.tolerance)):
+            exit(1)
+
+
+def bench(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('command', nargs='?', choices=('run', 'compare', 'images', 'list'))
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-o', dest='output', default=None)
+    parser.add_argument('-r', dest='repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('-k', dest='names', action='append', choices=list(BENCHMARKS), default=None)
+    parser.add_argument('-d', dest='directory', default=None)
+    parser.add_argument('-b', dest='baseline', default=None)
+    parser.add_argument('-t', dest='tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_intermixed_args(params)
+
+    if (not args.command or (args.command == 'compare' and len(args.paths) != 2) or
+            (args.command == 'images' and len(args.paths) != 1)):
+        print(__doc__)
+        exit()
+
+    if args.command == 'run':
+        _run(args)
+    elif args.command == 'compare':
+        results = []
+        for path in args.paths:
+            with open(path) as results_file:
+                results.append(json.load(results_file))
+        if _show_comparison(compare_results(results[0], results[1], args.tolerance)):
+            exit(1)
+    elif args.command == 'images':
+        for name, path in write_images(args.paths[0]).items():
+            print(path)
+    else:
+        for name in BENCHMARKS:
+            print(name)
+
+
+if __name__ == "__main__":
+    run_cli(bench, sys.argv[1:])
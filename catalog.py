@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 
 from sys import argv, exit
+from apple.cache import default_cache
 from apple.dos import *
+from apple.prodos import ProdosEntry, print_catalog as print_prodos_catalog
+from apple.stats import run_cli
 
 __author__ = 'Nicolas Djurovic'
-__version__ = '0.7'
+__version__ = '0.11'
 
 
 def show_catalog(diskfile):
@@ -13,13 +16,23 @@ def show_catalog(diskfile):
         print('Cannot execute without a disk filename !!!')
         exit()
 
-    # Load our diskfile
-    dsk = DiskDos33(diskfile)
-    # Display our Dos33 catalog
-    dsk.catalog()
+    # Read the catalog of our diskfile (DOS, ProDOS or Pascal, in
+    # DOS or ProDOS order), or get it from the cache if the disk didn't change
+    metadata = default_cache().load(diskfile)
+
+    # Display our catalog
+    if metadata['format'] in ('dos33', 'dos32'):
+        print_catalog(metadata['volume'], [CatalogEntry.from_dict(entry) for entry in metadata['files']],
+                      metadata['free_sectors'])
+    elif metadata['format'] == 'prodos':
+        print_prodos_catalog(metadata['header'], [ProdosEntry.from_dict(entry) for entry in metadata['files']],
+                             metadata['free_blocks'])
+    else:
+        print('PASCAL VOLUME {}:'.format(metadata['volume']))
+        print('The catalog of a Pascal disk is not supported yet')
 
 if __name__ == "__main__":
     # 'join' our arguments to avoid:
     # TypeError: expected str, bytes or os.PathLike object, not list
     file = "".join(argv[1:])
-    show_catalog(file)
+    run_cli(show_catalog, file)
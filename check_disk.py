@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python check_disk.py [-j WORKERS] [-c CHUNKSIZE] PATH [PATH ...]
+
+Check the integrity of many DOS 3.3 disk images at once and write one
+JSON line per image: deleted files (and if they can be recovered),
+orphaned sectors, cross-linked sectors, sectors used but free in the
+VTOC bitmap and damaged T/S lists. A summary is displayed at the end.
+
+Options:
+    PATH:           Disk filename, directory or glob pattern
+    -j WORKERS:     How many processes (default = number of CPUs)  [optional]
+    -c CHUNKSIZE:   How many images sent to a process at once      [optional]
+                    (default = 64)
+
+Examples:
+  python check_disk.py adir_catalog.dsk
+  python check_disk.py -j 8 /archive/apple2 > check.ndjson
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import sys
+
+from apple.batch import find_images, Throughput, DEFAULT_CHUNKSIZE
+from apple.forensics import check_images
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+
+def check_disk(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-j', dest='workers', type=int, default=None)
+    parser.add_argument('-c', dest='chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    args = parser.parse_args(params)
+
+    if not args.paths:
+        print(__doc__)
+        exit()
+
+    images = find_images(args.paths)
+    throughput = Throughput()
+    # Images with something to look at
+    problems = 0
+
+    for result in check_images(images, args.workers, args.chunksize):
+        throughput.add(result)
+        if any(result.get(key) for key in ('deleted', 'orphaned', 'cross_linked', 'free_but_used', 'damaged',
+                                           'catalog_error')):
+            problems += 1
+        sys.stdout.write(json.dumps(result) + '\n')
+
+    print('{} ({} images to check)'.format(throughput.summary(), problems), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run_cli(check_disk, sys.argv[1:])
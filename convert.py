@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python convert.py [-o ORDER] SOURCE DESTINATION
+
+Write a disk image in another sector order (.do <-> .po). The order of
+the source is found from its content, the order of the destination from
+its extension (.po: ProDOS order, else DOS order) or from -o.
+A nibble image (.nib) is written as a sector image.
+
+Options:
+    SOURCE:         Disk filename
+    DESTINATION:    New disk filename
+    -o ORDER:       Order of the destination: dos, prodos     [optional]
+                    or physical
+
+Examples:
+  python convert.py ProDOS_2_0_3.dsk ProDOS_2_0_3.po
+  python convert.py -o dos game.po game.dsk
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import os
+import sys
+
+from apple.disk import STORAGE_MMAP
+from apple.order import reorder_image, extension_order, ORDERS
+from apple.probe import open_disk
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.3'
+
+
+def convert(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('source', nargs='?')
+    parser.add_argument('destination', nargs='?')
+    parser.add_argument('-o', dest='order', choices=ORDERS, default=None)
+    args = parser.parse_args(params)
+
+    if not args.destination:
+        print(__doc__)
+        exit()
+
+    order = args.order
+    if order is None:
+        order = extension_order(os.path.splitext(args.destination)[1].lower())
+
+    with open_disk(args.source, STORAGE_MMAP) as dsk:
+        if dsk._sector_per_track != 16 and order != dsk.order:
+            print('Only the 16 sectors images can be written in another order', file=sys.stderr)
+            exit(1)
+        # The whole image (decoded for a nibble image), moved in one pass
+        data = reorder_image(dsk._memview()[0:dsk._disksize_raw], dsk.order, order)
+
+    with open(args.destination, 'wb') as diskfile:
+        diskfile.write(data)
+    print('{}: {} order -> {}: {} order'.format(args.source, dsk.order, args.destination, order), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run_cli(convert, sys.argv[1:])
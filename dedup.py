@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python dedup.py [-d INDEX] [-j WORKERS] [-c CHUNKSIZE] [-p] index PATH [PATH ...]
+       python dedup.py [-d INDEX] which HASH
+       python dedup.py [-d INDEX] which IMAGE (-t TRACK -s SECTOR | -b BLOCK | -f FILENAME)
+       python dedup.py [-d INDEX] unique IMAGE [IMAGE ...]
+       python dedup.py [-d INDEX] stats
+
+Index the sectors (blocks of ProDOS volumes) and the files of many disk
+images by their hash, then find the images sharing them.
+    index:  add the images to the index (only the new or changed ones),
+            one JSON line per image
+    which:  the images containing a sector, a block or a file (given
+            by its hash, or read from an image)
+    unique: the bytes and the files of an image found in no other image
+    stats:  number of images and of different sectors and files
+
+Options:
+    PATH:           Disk filename, directory or glob pattern
+    -d INDEX:       Index filename (default = ~/.cache/adir/dedup.sqlite)  [optional]
+    -j WORKERS:     How many processes (default = number of CPUs)  [optional]
+    -c CHUNKSIZE:   How many images sent to a process at once      [optional]
+                    (default = 64)
+    -p:             Remove the images not there anymore            [optional]
+    -t, -s, -b:     Track and sector, or block, read from IMAGE
+    -f FILENAME:    File read from IMAGE (DOS name or ProDOS path)
+
+Examples:
+  python dedup.py index -j 8 /archive/apple2
+  python dedup.py which adir_catalog.dsk -t 0 -s 0
+  python dedup.py which ProDOS_2_0_3.dsk -f PRODOS
+  python dedup.py unique adir_catalog.dsk
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import os
+import sys
+
+from apple.batch import find_images, Throughput, DEFAULT_CHUNKSIZE
+from apple.dedup import DedupIndex, update_index, hash_data, HASH_SIZE
+from apple.disk import DiskfileError, STORAGE_MMAP
+from apple.probe import open_disk
+from apple.prodos import DiskProdos
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+
+def _find_file(dsk, name):
+    # Content of a file from its DOS name or ProDOS path (full, or in the volume)
+    if isinstance(dsk, DiskProdos):
+        for entry in dsk.iter_files():
+            if name in (entry.path, entry.path.split('/', 2)[-1]) and not entry.is_directory:
+                return dsk.read_file(entry)
+    elif hasattr(dsk, 'find_file'):
+        entry = dsk.find_file(name)
+        if entry is not None:
+            return dsk.read_file(entry)
+    raise DiskfileError(dsk._diskname, 'has no file "{}"'.format(name))
+
+
+def _digest(args):
+    # Hash given, or read from an image
+    if len(args.paths) == 1 and args.track is None and args.block is None and args.filename is None:
+        digest = bytes.fromhex(args.paths[0])
+        if len(digest) != HASH_SIZE:
+            raise ValueError('a hash is {} hexa digits'.format(HASH_SIZE * 2))
+        return digest
+    with open_disk(args.paths[0], STORAGE_MMAP) as dsk:
+        if args.filename is not None:
+            return hash_data(_find_file(dsk, args.filename))
+        if args.block is not None:
+            if not isinstance(dsk, DiskProdos):
+                raise DiskfileError(args.paths[0], 'is not a ProDOS disk')
+            return hash_data(dsk.read_block(args.block))
+        return hash_data(dsk.read_ts(args.track, args.sector or 0))
+
+
+def dedup(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('command', nargs='?', choices=('index', 'which', 'unique', 'stats'))
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-d', dest='index', default=None)
+    parser.add_argument('-j', dest='workers', type=int, default=None)
+    parser.add_argument('-c', dest='chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('-p', dest='prune', action='store_true')
+    parser.add_argument('-t', dest='track', type=int, default=None)
+    parser.add_argument('-s', dest='sector', type=int, default=None)
+    parser.add_argument('-b', dest='block', type=int, default=None)
+    parser.add_argument('-f', dest='filename', default=None)
+    args = parser.parse_intermixed_args(params)
+
+    if not args.command or (args.command != 'stats' and not args.paths):
+        print(__doc__)
+        exit()
+
+    with DedupIndex(args.index) as index:
+        if args.command == 'index':
+            throughput = Throughput()
+            for result in update_index(index, find_images(args.paths), args.workers, args.chunksize):
+                throughput.add(result)
+                sys.stdout.write(json.dumps(result) + '\n')
+            if args.prune:
+                print('{} images removed'.format(index.prune()), file=sys.stderr)
+            print(throughput.summary(), file=sys.stderr)
+        elif args.command == 'which':
+            digest = _digest(args)
+            print(json.dumps(dict(index.images_with(digest), hash=digest.hex())))
+        elif args.command == 'unique':
+            for path in args.paths:
+                result = index.unique(os.path.abspath(path))
+                print(json.dumps(result if result is not None else {'path': path, 'error': 'not indexed'}))
+        else:
+            print(json.dumps(index.stats()))
+
+
+if __name__ == "__main__":
+    run_cli(dedup, sys.argv[1:])
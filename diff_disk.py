@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python diff_disk.py [-j WORKERS] [-c CHUNKSIZE] REFERENCE PATH [PATH ...]
+
+Compare disk images with a reference image (read only once) and write
+one JSON line per image: the ranges of sectors (or blocks of ProDOS
+volumes) changed, how many bytes changed in each of them and the files
+using them. The images are compared in the same order, whatever the
+order of their files (.dsk, .po, .nib). A summary is displayed at the end.
+
+Options:
+    REFERENCE:      Disk filename of the reference
+    PATH:           Disk filename, directory or glob pattern
+    -j WORKERS:     How many processes (default = number of CPUs)  [optional]
+    -c CHUNKSIZE:   How many images sent to a process at once      [optional]
+                    (default = 64)
+
+Examples:
+  python diff_disk.py game.dsk game_cracked.dsk
+  python diff_disk.py -j 8 game.dsk /archive/apple2/game_versions > diff.ndjson
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import sys
+
+from apple.batch import find_images, Throughput, DEFAULT_CHUNKSIZE
+from apple.diff import diff_many
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+
+def diff_disk(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('reference', nargs='?')
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-j', dest='workers', type=int, default=None)
+    parser.add_argument('-c', dest='chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    args = parser.parse_args(params)
+
+    if not args.paths:
+        print(__doc__)
+        exit()
+
+    images = find_images(args.paths)
+    throughput = Throughput()
+    # Images not the same as the reference
+    different = 0
+
+    for result in diff_many(args.reference, images, args.workers, args.chunksize):
+        throughput.add(result)
+        if 'error' not in result and not result['identical']:
+            different += 1
+        sys.stdout.write(json.dumps(result) + '\n')
+
+    print('{} ({} images different)'.format(throughput.summary(), different), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run_cli(diff_disk, sys.argv[1:])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python export.py [-f FORMAT] [-j WORKERS] [-c CHUNKSIZE] [-r ROWS] DESTINATION PATH [PATH ...]
+
+Export the catalogs of many disk images in 2 tables for analytics:
+DESTINATION/images (format, VTOC or volume header, free space) and
+DESTINATION/files (catalog entries, load address and length of each
+file). One JSON line per image is written, a summary at the end.
+
+Options:
+    DESTINATION:    Directory of the tables
+    PATH:           Disk filename, directory or glob pattern
+    -f FORMAT:      parquet, csv or ndjson (default = parquet if pyarrow
+                    is installed, else csv)                         [optional]
+    -j WORKERS:     How many processes (default = number of CPUs)  [optional]
+    -c CHUNKSIZE:   How many images sent to a process at once      [optional]
+                    (default = 64)
+    -r ROWS:        How many rows written at once (default = 131072)  [optional]
+
+Examples:
+  python export.py tables adir_catalog.dsk ProDOS_2_0_3.dsk
+  python export.py -f parquet -j 8 tables /archive/apple2
+  python export.py -f ndjson tables "/archive/**/*.dsk" > export.ndjson
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import sys
+
+from apple.batch import find_images, Throughput, DEFAULT_CHUNKSIZE
+from apple.export import Exporter, export_images, FORMATS, ROW_GROUP_SIZE
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+
+def export(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('destination', nargs='?')
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-f', dest='format', choices=FORMATS, default=None)
+    parser.add_argument('-j', dest='workers', type=int, default=None)
+    parser.add_argument('-c', dest='chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('-r', dest='rows', type=int, default=ROW_GROUP_SIZE)
+    args = parser.parse_args(params)
+
+    if not args.paths:
+        print(__doc__)
+        exit()
+
+    try:
+        exporter = Exporter(args.destination, args.format, args.rows)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        exit(1)
+
+    images = find_images(args.paths)
+    throughput = Throughput()
+    with exporter:
+        for result in export_images(exporter, images, args.workers, args.chunksize):
+            throughput.add(result)
+            sys.stdout.write(json.dumps(result) + '\n')
+
+    for name, table in exporter.tables.items():
+        print('{}: {} rows'.format(table.filename, table.rows), file=sys.stderr)
+    print(throughput.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run_cli(export, sys.argv[1:])
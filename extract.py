@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python extract.py [-j WORKERS] [-c CHUNKSIZE] [-r] DESTINATION PATH [PATH ...]
+
+Extract all the files of many DOS 3.3 disk images at once, each image
+in its own directory: DESTINATION/<image name>/<filename>.<type>
+One JSON line is written per image and a summary is displayed at the end.
+
+Options:
+    DESTINATION:    Directory where the files are written
+    PATH:           Disk filename, directory or glob pattern
+    -j WORKERS:     How many processes (default = number of CPUs)  [optional]
+    -c CHUNKSIZE:   How many images sent to a process at once      [optional]
+                    (default = 64)
+    -r:             Raw files, all the sectors without removing    [optional]
+                    the header (length, address) of the files
+
+Examples:
+  python extract.py files adir_catalog.dsk
+  python extract.py -j 8 files /archive/apple2
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import sys
+
+from apple.batch import find_images, extract_images, Throughput, DEFAULT_CHUNKSIZE
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+
+def extract(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('destination', nargs='?')
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-j', dest='workers', type=int, default=None)
+    parser.add_argument('-c', dest='chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('-r', dest='raw', action='store_true')
+    args = parser.parse_args(params)
+
+    if not args.paths:
+        print(__doc__)
+        exit()
+
+    images = find_images(args.paths)
+    throughput = Throughput()
+
+    for result in extract_images(images, args.destination, args.raw, args.workers, args.chunksize):
+        throughput.add(result)
+        sys.stdout.write(json.dumps(result) + '\n')
+
+    print(throughput.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run_cli(extract, sys.argv[1:])
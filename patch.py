@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python patch.py [-j WORKERS] [-c CHUNKSIZE] [-n] PATCH PATH [PATH ...]
+
+Apply the same patch to many disk images at once. Only the sectors
+changed are written back (atomically) to each image.
+One JSON line is written per image and a summary is displayed at the end.
+
+PATCH is a JSON file with a list of changes:
+    [{"track": 17, "sector": 0, "offset": 6, "data": "FE", "expect": "01"},
+     {"block": 2, "offset": 4, "data": "F4"}]
+"data" and "expect" are in hexa, an image is changed only if the bytes
+"expect" (optional) are found for all its changes.
+
+Options:
+    PATCH:          JSON file of the changes
+    PATH:           Disk filename, directory or glob pattern
+    -j WORKERS:     How many processes (default = number of CPUs)  [optional]
+    -c CHUNKSIZE:   How many images sent to a process at once      [optional]
+                    (default = 64)
+    -n:             Dry run, check the images without writing      [optional]
+
+Examples:
+  python patch.py volume.json adir_catalog.dsk
+  python patch.py -n -j 8 volume.json /archive/apple2
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import sys
+
+from apple.batch import find_images, patch_images, Throughput, DEFAULT_CHUNKSIZE
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+
+def patch(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('patch', nargs='?')
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-j', dest='workers', type=int, default=None)
+    parser.add_argument('-c', dest='chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('-n', dest='dry_run', action='store_true')
+    args = parser.parse_args(params)
+
+    if not args.paths:
+        print(__doc__)
+        exit()
+
+    with open(args.patch) as patchfile:
+        changes = json.load(patchfile)
+
+    images = find_images(args.paths)
+    throughput = Throughput()
+
+    for result in patch_images(images, changes, args.dry_run, args.workers, args.chunksize):
+        throughput.add(result)
+        sys.stdout.write(json.dumps(result) + '\n')
+
+    print(throughput.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run_cli(patch, sys.argv[1:])
@@ -11,11 +11,14 @@ Examples:
   python read_block.py adir_prodos.dsk 2
 """
 from sys import argv
+from apple.cache import default_cache
+from apple.probe import probe
 from apple.prodos import *
 from apple.helpers import dump_prodos
+from apple.stats import run_cli
 
 __author__ = 'Nicolas Djurovic'
-__version__ = '0.7'
+__version__ = '0.12'
 
 
 def dump_at_block(params):
@@ -26,15 +29,31 @@ def dump_at_block(params):
         print(__doc__)
         exit()
 
-    # Open our disk image
-    dsk_prodos = DiskProdos(diskfile)
+    # Open our disk image, no need to check it again
+    # if the cache (or the probe) already knows it's a ProDOS disk,
+    # and we get the order of its sectors (.dsk or .po) at the same time
+    # The catalog is saved in the cache the first time (load)
+    try:
+        metadata = default_cache().load(diskfile)
+    except DiskfileError:
+        metadata = None
+    if metadata is not None and metadata['format'] == 'prodos':
+        known, order = True, metadata['order']
+    else:
+        result = probe(diskfile)
+        known, order = result.system == 'prodos', result.order
+    dsk_prodos = DiskProdos(diskfile, check_format=not known, order=order)
 
     # Need to convert to an integer
     # before reading
     block = int(block)
 
     # Read our block to dump
-    value = dsk_prodos.read_block(block)
+    try:
+        value = dsk_prodos.read_block(block)
+    except BlockError as error:
+        print('BlockError:', error)
+        exit()
 
     # Use the function from the module dump_format
     dump_prodos(value, block)
@@ -44,4 +63,4 @@ def dump_at_block(params):
 # The code within the 'if' block will be executed only when the code runs directly.
 # Here 'directly' means 'not imported'
 if __name__ == "__main__":
-    dump_at_block(argv[1:])
+    run_cli(dump_at_block, argv[1:])
@@ -5,6 +5,7 @@
 Options:
     FILENAME:   Disk filename
     TRACK:      Which track (default = 17 - $11)        [optional]
+                or 'all' to dump the whole disk
     SECTOR:     Which sector (default = 0 - $00)        [optional]
     SIZE:       How many bytes to dump (default = 256)  [optional]
 
@@ -13,13 +14,17 @@ Examples:
   python read_ts.py adir_catalog.dsk 17
   python read_ts.py adir_catalog.dsk 17 14
   python read_ts.py adir_catalog.dsk 17 14 512
+  python read_ts.py adir_catalog.dsk all
 """
 from sys import argv
+from apple.disk import STORAGE_MMAP
 from apple.dos import *
-from apple.helpers import dump_dos
+from apple.probe import open_disk
+from apple.helpers import dump_dos, dump_tracks
+from apple.stats import run_cli
 
 __author__ = 'Nicolas Djurovic'
-__version__ = '0.7'
+__version__ = '0.12'
 
 
 def dump_at_ts(params):
@@ -35,21 +40,26 @@ def dump_at_ts(params):
         print(__doc__)
         exit()
 
-    # Open our disk image
-    dsk = DiskDos33(diskfile)
+    # Open our disk image (any system, in DOS or ProDOS order),
+    # mapped in memory so we dump the sectors without copying them
+    dsk = open_disk(diskfile, STORAGE_MMAP)
 
-    # read at the selected track/sector
-    value = dsk.read_ts(track, sector, byte_to_read)
-    # Get the track and sector given by method 'read_ts'
-    # to be able to print the result
-    track = int(dsk.track)
-    sector = int(dsk.sector)
+    # Dump the whole disk, track by track
+    if track == 'all':
+        dump_tracks(dsk)
+        return
 
-    dump_dos(value, track, sector)
+    # read at the selected track/sector, the Sector read gives
+    # the track and sector (as numbers) to print the result
+    sector_read = dsk.read_sector(track, sector, byte_to_read)
+    if sector_read is None:
+        return
+
+    dump_dos(sector_read.data, sector_read.track, sector_read.sector)
 
 
 # If the code here is not imported then run
 # The code within the 'if' block will be executed only when the code runs directly.
 # Here 'directly' means 'not imported'
 if __name__ == "__main__":
-    dump_at_ts(argv[1:])
+    run_cli(dump_at_ts, argv[1:])
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python scan.py [-j WORKERS] [-c CHUNKSIZE] PATH [PATH ...]
+
+Scan many disk images at once and write one JSON line per image
+(format, volume, catalog or error). A summary is displayed at the end.
+
+Options:
+    PATH:           Disk filename, directory or glob pattern
+    -j WORKERS:     How many processes (default = number of CPUs)  [optional]
+    -c CHUNKSIZE:   How many images sent to a process at once      [optional]
+                    (default = 64)
+
+Examples:
+  python scan.py adir_catalog.dsk ProDOS_2_0_3.dsk
+  python scan.py -j 8 /archive/apple2
+  python scan.py "/archive/**/*.dsk" > catalog.ndjson
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import sys
+
+from apple.batch import find_images, scan_images, Throughput, DEFAULT_CHUNKSIZE
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+
+def scan(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-j', dest='workers', type=int, default=None)
+    parser.add_argument('-c', dest='chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    args = parser.parse_args(params)
+
+    if not args.paths:
+        print(__doc__)
+        exit()
+
+    images = find_images(args.paths)
+    throughput = Throughput()
+
+    # Write each result as soon as we get it
+    for result in scan_images(images, args.workers, args.chunksize):
+        throughput.add(result)
+        sys.stdout.write(json.dumps(result) + '\n')
+
+    # The summary goes on stderr, so stdout only contains the JSON lines
+    print(throughput.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run_cli(scan, sys.argv[1:])
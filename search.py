@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python search.py (-e TEXT | -x HEX) [-i] [-n HITS] [-j WORKERS] [-c CHUNKSIZE] find PATH [PATH ...]
+       python search.py [-d INDEX] (-e TEXT | -x HEX) [-i] [-n HITS] [-j WORKERS] [-c CHUNKSIZE] query
+       python search.py [-d INDEX] [-j WORKERS] [-c CHUNKSIZE] [-p] index PATH [PATH ...]
+       python search.py [-d INDEX] stats
+
+Search texts and bytes in many disk images at once, each hit is given
+with its track/sector, its block (ProDOS) and the file using it.
+    find:   search the images, one JSON line per image found (or error)
+    query:  the same, only in the indexed images which can contain
+            the patterns
+    index:  add the trigrams of the images to the index (only the new
+            or changed ones), one JSON line per image
+    stats:  number of images and of trigrams
+
+A text is searched in ASCII and in Apple ASCII (high bit set).
+
+Options:
+    PATH:           Disk filename, directory or glob pattern
+    -e TEXT:        Text to search (can be repeated)
+    -x HEX:         Bytes to search in hexa, ?? for any byte (can be repeated)
+    -i:             Ignore the case of the texts                   [optional]
+    -n HITS:        Hits given for an image (default = 100)        [optional]
+    -d INDEX:       Index filename (default = ~/.cache/adir/search.sqlite)  [optional]
+    -j WORKERS:     How many processes (default = number of CPUs)  [optional]
+    -c CHUNKSIZE:   How many images sent to a process at once      [optional]
+                    (default = 64)
+    -p:             Remove the images not there anymore            [optional]
+
+Examples:
+  python search.py -e "COPYRIGHT" -i find /archive/apple2
+  python search.py -x "A9 00 8D ?? C0" find adir_catalog.dsk
+  python search.py index -j 8 /archive/apple2
+  python search.py -e "BRODERBUND" query
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import sys
+
+from apple.batch import find_images, Throughput, DEFAULT_CHUNKSIZE
+from apple.search import Search, SearchIndex, search_images, update_search_index, DEFAULT_MAX_HITS
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+
+def _show_results(results):
+    # Only the images with a hit (or an error) are written
+    throughput = Throughput()
+    found = 0
+    for result in results:
+        throughput.add(result)
+        if result.get('count') or 'error' in result:
+            found += bool(result.get('count'))
+            sys.stdout.write(json.dumps(result) + '\n')
+    print('{} images found'.format(found), file=sys.stderr)
+    print(throughput.summary(), file=sys.stderr)
+
+
+def search(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('command', nargs='?', choices=('find', 'query', 'index', 'stats'))
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-e', dest='texts', action='append', default=[])
+    parser.add_argument('-x', dest='hexes', action='append', default=[])
+    parser.add_argument('-i', dest='ignore_case', action='store_true')
+    parser.add_argument('-n', dest='max_hits', type=int, default=DEFAULT_MAX_HITS)
+    parser.add_argument('-d', dest='index', default=None)
+    parser.add_argument('-j', dest='workers', type=int, default=None)
+    parser.add_argument('-c', dest='chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('-p', dest='prune', action='store_true')
+    args = parser.parse_intermixed_args(params)
+
+    if (not args.command or (args.command in ('find', 'index') and not args.paths) or
+            (args.command in ('find', 'query') and not args.texts and not args.hexes)):
+        print(__doc__)
+        exit()
+
+    if args.command == 'find':
+        try:
+            patterns = Search(args.texts, args.hexes, args.ignore_case)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            exit(1)
+        _show_results(search_images(patterns, find_images(args.paths), args.max_hits, args.workers,
+                                    args.chunksize))
+        return
+
+    with SearchIndex(args.index) as index:
+        if args.command == 'query':
+            try:
+                patterns = Search(args.texts, args.hexes, args.ignore_case)
+            except ValueError as error:
+                print(error, file=sys.stderr)
+                exit(1)
+            candidates = index.candidates(patterns)
+            if index.stale:
+                # Still searched (if there), but the index must be updated
+                print('{} images changed or removed since they were indexed '
+                      '(python search.py index -p PATH to update)'.format(len(index.stale)), file=sys.stderr)
+            _show_results(search_images(patterns, candidates, args.max_hits, args.workers, args.chunksize))
+        elif args.command == 'index':
+            throughput = Throughput()
+            for result in update_search_index(index, find_images(args.paths), args.workers, args.chunksize):
+                throughput.add(result)
+                sys.stdout.write(json.dumps(result) + '\n')
+            if args.prune:
+                print('{} images removed'.format(index.prune()), file=sys.stderr)
+            print(throughput.summary(), file=sys.stderr)
+        else:
+            print(json.dumps(index.stats()))
+
+
+if __name__ == "__main__":
+    run_cli(search, sys.argv[1:])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python serve.py [-H HOST] [-p PORT] [-u SOCKET] [-m MEMORY] [-w WORKERS]
+
+Serve the catalogs, sectors, blocks and files of the disk images over
+HTTP (JSON), without opening the images again for each request: the
+disks opened are kept in memory, up to MEMORY megabytes.
+
+Options:
+    -H HOST:        Address to listen to (default = 127.0.0.1)  [optional]
+    -p PORT:        Port to listen to (default = 8642)          [optional]
+    -u SOCKET:      Listen to a Unix socket instead of a port   [optional]
+    -m MEMORY:      Memory for the disks, in MB (default = 256) [optional]
+    -w WORKERS:     Threads answering the requests              [optional]
+                    (default = the one of concurrent.futures)
+
+Requests:
+    /catalog?path=IMAGE
+    /ts?path=IMAGE&track=17&sector=0[&size=256][&format=raw]
+    /block?path=IMAGE&block=2[&count=1][&format=raw]
+    /file?path=IMAGE&name=HELLO[&raw=1]
+    /stats
+
+Examples:
+  python serve.py
+  python serve.py -u /tmp/adir.sock -m 1024
+  curl "http://127.0.0.1:8642/catalog?path=adir_catalog.dsk"
+  curl --unix-socket /tmp/adir.sock "http://localhost/block?path=ProDOS_2_0_3.dsk&block=2"
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import sys
+
+from apple.server import run_server, DEFAULT_HOST, DEFAULT_PORT, DEFAULT_MAX_MEMORY
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.3'
+
+
+def serve(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('-H', dest='host', default=DEFAULT_HOST)
+    parser.add_argument('-p', dest='port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('-u', dest='unix_socket', default=None)
+    parser.add_argument('-m', dest='memory', type=int, default=DEFAULT_MAX_MEMORY // (1024 * 1024))
+    parser.add_argument('-w', dest='workers', type=int, default=None)
+    parser.add_argument('-h', '--help', dest='help', action='store_true')
+    args = parser.parse_args(params)
+
+    if args.help:
+        print(__doc__)
+        exit()
+
+    where = args.unix_socket or '{}:{}'.format(args.host, args.port)
+    print('Serving the disk images on {} (Ctrl-C to stop)'.format(where), file=sys.stderr)
+    run_server(args.host, args.port, args.unix_socket, args.memory * 1024 * 1024, args.workers)
+
+
+if __name__ == "__main__":
+    run_cli(serve, sys.argv[1:])
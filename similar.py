@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Usage: python similar.py [-d INDEX] [-j WORKERS] [-c CHUNKSIZE] [-p] index PATH [PATH ...]
+       python similar.py [-d INDEX] [-t THRESHOLD] [-n COUNT] query IMAGE [IMAGE ...]
+       python similar.py [-d INDEX] [-t THRESHOLD] clusters
+       python similar.py [-d INDEX] stats
+
+Find the disk images similar to each other (variants of the same disk:
+a patched title, a saved game, a cracked copy...), from a signature of
+their sectors (blocks of ProDOS volumes), without comparing every image
+with every other one.
+    index:    add the images to the index (only the new or changed
+              ones), one JSON line per image
+    query:    the indexed images most similar to an image (indexed or
+              not), one JSON line per image
+    clusters: the groups of similar images, one JSON line per group
+    stats:    number of images and of buckets
+
+The similarity (0 to 1) is an estimate of the sectors in common
+compared to all the different sectors of both images.
+
+Options:
+    PATH:           Disk filename, directory or glob pattern
+    -d INDEX:       Index filename (default = ~/.cache/adir/similar.sqlite)  [optional]
+    -j WORKERS:     How many processes (default = number of CPUs)  [optional]
+    -c CHUNKSIZE:   How many images sent to a process at once      [optional]
+                    (default = 64)
+    -p:             Remove the images not there anymore            [optional]
+    -t THRESHOLD:   Minimum similarity (default = 0.5)             [optional]
+    -n COUNT:       How many images for a query (default = 10)     [optional]
+
+Examples:
+  python similar.py index -j 8 /archive/apple2
+  python similar.py query -t 0.8 adir_catalog.dsk
+  python similar.py clusters -t 0.9
+"""
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import json
+import os
+import sys
+
+from apple.batch import find_images, Throughput, DEFAULT_CHUNKSIZE
+from apple.similar import SimilarIndex, update_similar, signature_image, unpack_signature, \
+    DEFAULT_THRESHOLD, DEFAULT_COUNT
+from apple.stats import run_cli
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+
+def _query(index, path, threshold, count):
+    # Images similar to an image, its signature is read from the index
+    # or computed
+    path = os.path.abspath(path)
+    signature = index.signature_of(path)
+    if signature is None:
+        result = signature_image(path)
+        if 'error' in result:
+            return {'path': path, 'error': result['error']}
+        signature = unpack_signature(result['signature'])
+    return {'path': path, 'similar': index.query(signature, threshold, count, exclude=path)}
+
+
+def similar(params):
+    parser = ArgumentParser(usage=__doc__, formatter_class=RawDescriptionHelpFormatter, add_help=False)
+    parser.add_argument('command', nargs='?', choices=('index', 'query', 'clusters', 'stats'))
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('-d', dest='index', default=None)
+    parser.add_argument('-j', dest='workers', type=int, default=None)
+    parser.add_argument('-c', dest='chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('-p', dest='prune', action='store_true')
+    parser.add_argument('-t', dest='threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('-n', dest='count', type=int, default=DEFAULT_COUNT)
+    args = parser.parse_intermixed_args(params)
+
+    if not args.command or (args.command not in ('clusters', 'stats') and not args.paths):
+        print(__doc__)
+        exit()
+
+    with SimilarIndex(args.index) as index:
+        if args.command == 'index':
+            throughput = Throughput()
+            for result in update_similar(index, find_images(args.paths), args.workers, args.chunksize):
+                throughput.add(result)
+                sys.stdout.write(json.dumps(result) + '\n')
+            if args.prune:
+                print('{} images removed'.format(index.prune()), file=sys.stderr)
+            print(throughput.summary(), file=sys.stderr)
+        elif args.command == 'query':
+            for path in args.paths:
+                print(json.dumps(_query(index, path, args.threshold, args.count)))
+        elif args.command == 'clusters':
+            for group in index.clusters(args.threshold):
+                sys.stdout.write(json.dumps(group) + '\n')
+        else:
+            print(json.dumps(index.stats()))
+
+
+if __name__ == "__main__":
+    run_cli(similar, sys.argv[1:])
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the allocation bitmaps (apple.bitmap) against a bit by bit count
+"""
+import random
+import unittest
+
+from apple.bitmap import Bitmap
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+
+def bits_of(data, size):
+    return [(data[unit >> 3] >> (7 - (unit & 7))) & 1 for unit in range(size)]
+
+
+def runs_of(bits, start, stop):
+    runs = []
+    for unit in range(start, stop):
+        if bits[unit]:
+            if runs and runs[-1][0] + runs[-1][1] == unit:
+                runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+            else:
+                runs.append((unit, 1))
+    return runs
+
+
+class TestBitmap(unittest.TestCase):
+    def test_against_bits(self):
+        generator = random.Random(1)
+        for size in (1, 7, 8, 9, 280, 1601):
+            # Random bytes, with runs of $00 and $FF
+            data = bytes(generator.choice((0x00, 0xFF, generator.getrandbits(8))) for _ in range((size + 7) // 8))
+            bitmap = Bitmap(data + b'\xFF', size)
+            bits = bits_of(data, size)
+            with self.subTest(size=size):
+                self.assertEqual(len(bitmap), size)
+                self.assertEqual(bitmap.units(), bytes(bits))
+                self.assertEqual([bitmap.is_set(unit) for unit in range(size)], [bool(bit) for bit in bits])
+                self.assertEqual(bitmap.count(), sum(bits))
+                self.assertEqual(list(bitmap.iter_runs()), runs_of(bits, 0, size))
+                for _ in range(20):
+                    start = generator.randrange(size)
+                    stop = generator.randrange(start, size + 1)
+                    self.assertEqual(bitmap.count(start, stop), sum(bits[start:stop]))
+                    self.assertEqual(list(bitmap.iter_runs(start, stop)), runs_of(bits, start, stop))
+
+    def test_out_of_bitmap(self):
+        bitmap = Bitmap(b'\xFF', 5)
+        self.assertEqual(bitmap.count(), 5)
+        with self.assertRaises(IndexError):
+            bitmap.is_set(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
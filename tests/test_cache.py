@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the catalog cache (apple.cache)
+
+Each test has its own cache directory and works on images written in a
+temporary directory.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from apple import cache
+from apple.cache import CatalogCache, read_metadata, COPY_MAX_SIZE
+from apple.synth import prodos_image
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOS_IMAGE = os.path.join(ROOT, 'adir_catalog.dsk')
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='adir-test-')
+        # The cache is used even if the tests are run with ADIR_NO_CACHE
+        patcher = mock.patch.dict(os.environ, {'ADIR_NO_CACHE': ''})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = CatalogCache(os.path.join(self.directory, 'cache'))
+        self.assertTrue(self.cache.enabled)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def copy_image(self, name='disk.dsk', source=DOS_IMAGE):
+        path = os.path.join(self.directory, name)
+        shutil.copyfile(source, path)
+        return path
+
+    def test_load_then_get(self):
+        path = self.copy_image()
+        self.assertIsNone(self.cache.get(path))
+        metadata = self.cache.load(path)
+        self.assertEqual(metadata, read_metadata(path))
+        self.assertEqual(self.cache.get(path), metadata)
+
+    def test_changed_image(self):
+        path = self.copy_image()
+        self.cache.load(path)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        self.assertIsNone(self.cache.get(path))
+
+    def test_copy_found(self):
+        path = self.copy_image()
+        metadata = self.cache.load(path)
+        copy = self.copy_image('copy.dsk')
+        with mock.patch.object(cache, 'read_metadata') as parse:
+            self.assertEqual(self.cache.load(copy), metadata)
+            parse.assert_not_called()
+
+    def test_big_image_not_hashed(self):
+        # A big volume is parsed (only its directories are read), its
+        # content is never hashed, and the next lookup is a hit
+        path = os.path.join(self.directory, 'big.po')
+        with open(path, 'wb') as fileobj:
+            fileobj.write(prodos_image(blocks=4096, files=4))
+        self.assertGreater(os.path.getsize(path), COPY_MAX_SIZE)
+        with mock.patch.object(cache, 'content_hash') as content_hash:
+            self.assertIsNone(self.cache.get(path))
+            metadata = self.cache.load(path)
+            self.assertEqual(self.cache.get(path), metadata)
+            content_hash.assert_not_called()
+        self.assertEqual(metadata['volume'], 'SYNTH')
+
+    def test_memory_image(self):
+        # Parsed each time, never saved
+        with open(DOS_IMAGE, 'rb') as fileobj:
+            data = fileobj.read()
+        self.assertEqual(self.cache.load(data), read_metadata(DOS_IMAGE))
+        self.assertEqual(self.cache.lookup(data), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
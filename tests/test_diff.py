@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the differences between images (apple.diff)
+"""
+import os
+import tempfile
+import unittest
+
+from apple.diff import changed_units, diff_images, UNIT_BLOCK, UNIT_SECTOR
+from apple.order import reorder_image, ORDER_DOS, ORDER_PRODOS
+from apple.synth import dos_image, prodos_image, SECTOR_SIZE
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+TRACK_SIZE = 4096
+
+
+class TestChangedUnits(unittest.TestCase):
+    def test_changed_units(self):
+        reference = bytes(3 * TRACK_SIZE)
+        other = bytearray(reference)
+        other[10] = 1
+        other[TRACK_SIZE + 300:TRACK_SIZE + 303] = b'abc'
+        other[-1] = 1
+        self.assertEqual(changed_units(reference, reference, SECTOR_SIZE), [])
+        self.assertEqual(changed_units(reference, bytes(other), SECTOR_SIZE),
+                         [(0, 1), (17, 3), (47, 1)])
+        self.assertEqual(changed_units(reference, bytes(other), 512), [(0, 1), (8, 3), (23, 1)])
+
+
+class TestDiffImages(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        diskname = os.path.join(self.directory.name, name)
+        with open(diskname, 'wb') as image:
+            image.write(data)
+        return diskname
+
+    def test_dos(self):
+        image = dos_image(files=3, sectors_per_file=2)
+        reference = self.write('reference.dsk', image)
+        # The same disk in ProDOS order is identical
+        report = diff_images(reference, self.write('same.po', reorder_image(bytes(image), ORDER_DOS, ORDER_PRODOS)))
+        self.assertTrue(report['identical'])
+        self.assertEqual(report['ranges'], [])
+
+        # Change the last byte of the first data sector of the first file
+        # (track $12, sector $0F: the first sector allocated is its T/S list)
+        changed = bytearray(image)
+        changed[0x12 * TRACK_SIZE + 0x0E * SECTOR_SIZE + 0xFF] ^= 0xFF
+        report = diff_images(reference, self.write('changed.dsk', changed))
+        self.assertEqual(report['unit'], UNIT_SECTOR)
+        self.assertFalse(report['identical'])
+        self.assertEqual((report['changed'], report['changed_bytes']), (1, 1))
+        self.assertEqual(report['ranges'], [{'start': [0x12, 0x0E], 'end': [0x12, 0x0E], 'sectors': 1, 'bytes': 1,
+                                             'files': report['files']}])
+        self.assertEqual(len(report['files']), 1)
+        self.assertIn('FILE0000', report['files'][0])
+
+    def test_prodos(self):
+        image = prodos_image(files=2, file_size=1000)
+        changed = bytearray(image)
+        changed[-1] ^= 0xFF
+        report = diff_images(self.write('reference.po', image), self.write('changed.po', changed))
+        self.assertEqual(report['unit'], UNIT_BLOCK)
+        self.assertEqual(report['ranges'], [{'start': 279, 'end': 279, 'blocks': 1, 'bytes': 1, 'files': []}])
+
+
+if __name__ == '__main__':
+    unittest.main()
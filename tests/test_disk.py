@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the storages of a Disk (apple.disk, apple.paged): the array,
+the mapped file and the paged image read the same sectors
+"""
+from array import array
+import os
+import tempfile
+import unittest
+
+from apple.disk import DiskBin, PAGED_THRESHOLD, STORAGE_ARRAY, STORAGE_MMAP, STORAGE_PAGED
+from apple.order import reorder_image, ORDER_DOS, ORDER_PRODOS
+from apple.paged import PagedImage
+from apple.synth import dos_image
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+TRACK_SIZE = 4096
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.image = bytes(dos_image(files=20, sectors_per_file=3))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        diskname = os.path.join(self.directory.name, name)
+        with open(diskname, 'wb') as image:
+            image.write(data)
+        return diskname
+
+    def test_storages(self):
+        # The same sectors and tracks, a copy with the array storage,
+        # a read-only view with the mmap storage
+        diskname = self.write('test.dsk', self.image)
+        for storage, kind in ((STORAGE_ARRAY, array), (STORAGE_MMAP, memoryview)):
+            with self.subTest(storage=storage):
+                with DiskBin(diskname, storage) as dsk:
+                    self.assertEqual(dsk.storage, storage)
+                    sector = dsk.read_ts(0x11, 0x0F)
+                    self.assertIsInstance(sector, kind)
+                    self.assertEqual(bytes(sector), self.image[0x11 * TRACK_SIZE + 0x0F * 256:0x12 * TRACK_SIZE])
+                    track = dsk.read_ts(0x12, None)
+                    self.assertEqual(bytes(track), self.image[0x12 * TRACK_SIZE:0x13 * TRACK_SIZE])
+                    if storage == STORAGE_MMAP:
+                        self.assertTrue(sector.readonly)
+
+    def test_lazy_load(self):
+        # The file is opened on the first read, and again after close
+        diskname = self.write('test.dsk', self.image)
+        dsk = DiskBin(diskname, STORAGE_MMAP)
+        self.assertIsNone(dsk._memdisk)
+        first = bytes(dsk.read_ts(3, 4))
+        self.assertIsNotNone(dsk._memdisk)
+        dsk.close()
+        self.assertIsNone(dsk._memdisk)
+        self.assertEqual(bytes(dsk.read_ts(3, 4)), first)
+        dsk.close()
+
+    def test_close_with_a_view(self):
+        # A view kept by the caller doesn't stop the disk from closing
+        diskname = self.write('test.dsk', self.image)
+        dsk = DiskBin(diskname, STORAGE_MMAP)
+        view = dsk.read_ts(0x11, 0)
+        dsk.close()
+        self.assertEqual(len(view), 256)
+        view.release()
+
+    def test_prodos_order(self):
+        # The sectors of a track in ProDOS order are not contiguous in
+        # the file: a whole track is joined in a new buffer
+        diskname = self.write('test.po', reorder_image(self.image, ORDER_DOS, ORDER_PRODOS))
+        for storage in (STORAGE_ARRAY, STORAGE_MMAP):
+            with self.subTest(storage=storage):
+                with DiskBin(diskname, storage, ORDER_PRODOS) as dsk:
+                    self.assertEqual(bytes(dsk.read_ts(0x12, None)), self.image[0x12 * TRACK_SIZE:0x13 * TRACK_SIZE])
+                    self.assertEqual(bytes(dsk.read_ts(0x12, 3)),
+                                     self.image[0x12 * TRACK_SIZE + 3 * 256:0x12 * TRACK_SIZE + 4 * 256])
+
+    def test_unknown_storage(self):
+        with self.assertRaises(ValueError):
+            DiskBin(self.write('test.dsk', self.image), 'disk')
+
+
+class TestPagedImage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.diskname = os.path.join(self.directory.name, 'test.hdv')
+        self.data = bytes(index * 7 & 0xFF for index in range(PAGED_THRESHOLD + 64 * 1024))
+        with open(self.diskname, 'wb') as image:
+            image.write(self.data)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_big_image_is_paged(self):
+        # A big image opened with the array storage is read by pages
+        with DiskBin(self.diskname) as dsk:
+            self.assertEqual(dsk.storage, STORAGE_PAGED)
+            position = 200 * TRACK_SIZE + 5 * 256
+            self.assertEqual(bytes(dsk.read_ts(200, 5)), self.data[position:position + 256])
+
+    def test_pages(self):
+        image = PagedImage(self.diskname, 16, 10000, page_size=1024, max_pages=2)
+        try:
+            self.assertEqual(len(image), 10000)
+            self.assertEqual(bytes(image[1000:3100]), self.data[1016:3116])
+            self.assertEqual(image[5000], self.data[5016])
+            self.assertEqual(bytes(image[9990:20000]), self.data[10006:10016])
+            # Only 2 pages are kept: the first ones are read again
+            reads = image.reads
+            bytes(image[0:10])
+            self.assertEqual(image.reads, reads + 1)
+
+            # A page written is kept (and read from memory)
+            image[1020:1030] = b'0123456789'
+            for number in range(5, 9):
+                image.page(number)
+            reads = image.reads
+            self.assertEqual(bytes(image[1020:1030]), b'0123456789')
+            self.assertEqual(image.reads, reads)
+            with self.assertRaises(ValueError):
+                image[0:10] = b'short'
+        finally:
+            image.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
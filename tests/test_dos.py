@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the DOS 3.3 reader (apple.dos) on synthetic disks
+"""
+from contextlib import redirect_stdout
+import io
+import unittest
+
+from apple.disk import STORAGE_ARRAY, STORAGE_MMAP
+from apple.dos import CatalogEntry, print_catalog, FILE_TYPE_BINARY, FILE_TYPE_TEXT
+from apple.probe import open_disk
+from apple.source import MemoryImage
+from apple.synth import dos_image, DOS_SECTORS, SECTOR_SIZE, VTOC_TRACK
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+
+class TestCatalog(unittest.TestCase):
+    def test_print_catalog(self):
+        # A locked file is displayed like the others
+        entries = [CatalogEntry('HELLO', FILE_TYPE_BINARY, False, 2, 0x12, 0x0F),
+                   CatalogEntry('LOCKED', FILE_TYPE_BINARY, True, 3, 0x13, 0x0F),
+                   CatalogEntry('GONE', FILE_TYPE_BINARY, False, 4, 0x14, 0x0F, deleted=True)]
+        output = io.StringIO()
+        with redirect_stdout(output):
+            print_catalog(254, entries, 400)
+        self.assertEqual(output.getvalue().splitlines(), [
+            'DISK VOLUME 254',
+            '',
+            ' B 002 HELLO                           [$12:$0F]',
+            ' B 003 LOCKED                          [$13:$0F]',
+            '>B 004 GONE                          <',
+            '',
+            'Sectors free: 400 ',
+        ])
+
+
+def text_image(end):
+    # A disk with one TEXT file of 2 sectors, its first $00 at end
+    image = dos_image(files=1, sectors_per_file=2)
+    fde = (VTOC_TRACK * DOS_SECTORS + DOS_SECTORS - 1) * SECTOR_SIZE + 0x0B
+    image[fde + 0x02] = FILE_TYPE_TEXT
+    ts_list = (image[fde] * DOS_SECTORS + image[fde + 1]) * SECTOR_SIZE
+    text = bytearray()
+    for pair in range(2):
+        track, sector = image[ts_list + 0x0C + 2 * pair:ts_list + 0x0E + 2 * pair]
+        position = (track * DOS_SECTORS + sector) * SECTOR_SIZE
+        image[position:position + SECTOR_SIZE] = bytes(0xC1 + (index % 26) for index in range(SECTOR_SIZE))
+        text += image[position:position + SECTOR_SIZE]
+    if end is not None:
+        position = (image[ts_list + 0x0C + 2 * (end // SECTOR_SIZE)] * DOS_SECTORS +
+                    image[ts_list + 0x0D + 2 * (end // SECTOR_SIZE)]) * SECTOR_SIZE
+        image[position + end % SECTOR_SIZE] = 0x00
+        text = text[:end]
+    return image, bytes(text)
+
+
+class TestTextFile(unittest.TestCase):
+    def test_text_end(self):
+        # A TEXT file stops at its first $00 (in any sector), or at the
+        # end of its sectors
+        for storage in (STORAGE_ARRAY, STORAGE_MMAP):
+            for end in (0, 10, SECTOR_SIZE, SECTOR_SIZE + 200, None):
+                with self.subTest(storage=storage, end=end):
+                    image, text = text_image(end)
+                    with open_disk(MemoryImage(bytes(image), 'test.dsk'), storage) as dsk:
+                        entry = next(dsk.iter_catalog())
+                        self.assertEqual(entry.file_type, FILE_TYPE_TEXT)
+                        self.assertEqual(dsk.read_file(entry), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
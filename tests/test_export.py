@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the export of the catalogs (apple.export) in CSV and NDJSON
+"""
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+from apple.export import export_image, Exporter, FORMAT_CSV, FORMAT_NDJSON, IMAGE_COLUMNS, FILE_COLUMNS
+from apple.synth import dos_image, prodos_image, BLOCK_SIZE, SECTOR_SIZE
+from tests.test_prodos import extend_file
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+
+def read_table(filename, export_format):
+    # The rows of a table as dictionaries, the values as strings
+    # (like in the CSV file), None for a value not known
+    with open(filename, newline='', encoding='utf-8') as table:
+        if export_format == FORMAT_CSV:
+            reader = csv.reader(table)
+            names = next(reader)
+            return names, [{name: value or None for name, value in zip(names, row)} for row in reader]
+        rows = [json.loads(line) for line in table]
+        return None, [{name: None if value is None else str(value).lower() if isinstance(value, bool) else
+                       str(value) for name, value in row.items()} for row in rows]
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dos = os.path.join(self.directory.name, 'dos.dsk')
+        with open(self.dos, 'wb') as image:
+            image.write(dos_image(files=3, sectors_per_file=2))
+        # ProDOS: the first file is an extended file
+        self.prodos = os.path.join(self.directory.name, 'pro.po')
+        volume = prodos_image(files=2, file_size=700)
+        extend_file(volume, 0)
+        with open(self.prodos, 'wb') as image:
+            image.write(volume)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def export(self, export_format):
+        destination = os.path.join(self.directory.name, export_format)
+        with Exporter(destination, export_format) as exporter:
+            for diskname in (self.dos, self.prodos):
+                exporter.add(*export_image(diskname))
+        return [read_table(os.path.join(destination, name + '.' + export_format), export_format)
+                for name in ('images', 'files')]
+
+    def test_export(self):
+        for export_format in (FORMAT_CSV, FORMAT_NDJSON):
+            with self.subTest(format=export_format):
+                (image_names, images), (file_names, files) = self.export(export_format)
+                if export_format == FORMAT_CSV:
+                    self.assertEqual(image_names, [name for name, kind in IMAGE_COLUMNS])
+                    self.assertEqual(file_names, [name for name, kind in FILE_COLUMNS])
+
+                dos, prodos = images
+                self.assertEqual((dos['format'], dos['volume'], dos['dos_release'], dos['first_catalog_track'],
+                                  dos['total_tracks'], dos['files'], dos.get('error')),
+                                 ('dos33', '254', '3', '17', '35', '3', None))
+                self.assertEqual((prodos['format'], prodos['volume'], prodos['total_blocks'], prodos['files'],
+                                  prodos.get('error')), ('prodos', 'SYNTH', '280', '2', None))
+
+                # The length without the header of a B file, the EOF of
+                # the data fork of a ProDOS file
+                rows = {(row['path'], row['name']): row for row in files}
+                for index in range(3):
+                    row = rows[self.dos, 'FILE{:04d}'.format(index)]
+                    self.assertEqual((row['load_address'], row['file_length']),
+                                     (str(0x0800), str(2 * SECTOR_SIZE - 4)))
+                extended = rows[self.prodos, '/SYNTH/FILE0000']
+                self.assertEqual((extended['storage_type'], extended['eof']), ('5', str(BLOCK_SIZE)))
+                for name in ('/SYNTH/FILE0000', '/SYNTH/FILE0001'):
+                    row = rows[self.prodos, name]
+                    self.assertEqual((row['load_address'], row['file_length']), (str(0x2000), '700'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the helpers: the hexa dump (whole or streamed) and the LRU cache
+"""
+import contextlib
+import io
+import random
+import unittest
+
+from apple.helpers import LRUCache, dump_display, dump_dos, dump_header, generate, generate_header, int2ascii, \
+    split_array, BYTES_TO_DISPLAY
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+
+def reference_generate(arraylist, size):
+    # The dump as it was done byte by byte
+    header = ' ' * 5 + ''.join('{:02X} '.format(i) for i in range(size))
+    hexa_list = ' '.join('{:02X}'.format(char) for char in arraylist)
+    char_list = ''.join(int2ascii(char) for char in arraylist)
+    return header, split_array(hexa_list, size * 3), split_array(char_list, size)
+
+
+class TestDump(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(0)
+        self.data = bytes(generator.randrange(256) for _ in range(256 * 3 + 5))
+
+    def test_int2ascii(self):
+        self.assertEqual([int2ascii(char) for char in (0x41, 0xC1, 0x00, 0x7F, 0xFF, 0xA0)],
+                         ['A', 'A', '.', '.', '.', ' '])
+
+    def test_generate(self):
+        self.assertEqual(generate(self.data, BYTES_TO_DISPLAY), reference_generate(self.data, BYTES_TO_DISPLAY))
+        self.assertEqual(generate_header(self.data), reference_generate(self.data, BYTES_TO_DISPLAY))
+
+    def test_streamed_dump(self):
+        # The same text as the dump of the whole value at once
+        data = self.data[:256]
+        expected = io.StringIO()
+        with contextlib.redirect_stdout(expected):
+            header, list_byte, list_text = generate_header(data)
+            print('{}  T${:02X} S${:02X}'.format(header.rstrip(), 0x11, 0))
+            print()
+            dump_display(list_byte, list_text)
+        streamed = io.StringIO()
+        dump_dos(data, 0x11, 0, streamed.write)
+        self.assertEqual(streamed.getvalue(), expected.getvalue())
+        self.assertEqual(dump_header(), header.rstrip())
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evict(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.put('c', 3), [('b', 2)])
+        self.assertEqual([key for key, value in cache.items()], ['a', 'c'])
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_sizeof(self):
+        cache = LRUCache(10, sizeof=len)
+        cache.put('a', b'12345')
+        cache.put('b', b'123456')
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 6)
+        self.assertEqual(cache.pop('b'), b'123456')
+        self.assertEqual(cache.size, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
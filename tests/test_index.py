@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the indexes of a library (apple.index and the dedup, similar
+and search indexes built on it)
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from apple.dedup import DedupIndex, update_index
+from apple.search import Search, SearchIndex, update_search_index
+from apple.similar import SimilarIndex, update_similar
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOS_IMAGE = os.path.join(ROOT, 'adir_catalog.dsk')
+PRODOS_IMAGE = os.path.join(ROOT, 'ProDOS_2_0_3.dsk')
+
+INDEXES = ((DedupIndex, update_index), (SimilarIndex, update_similar), (SearchIndex, update_search_index))
+
+
+class IndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='adir-test-')
+        self.paths = []
+        for name, source in (('dos.dsk', DOS_IMAGE), ('copy.dsk', DOS_IMAGE), ('prodos.dsk', PRODOS_IMAGE)):
+            self.paths.append(os.path.join(self.directory, name))
+            shutil.copyfile(source, self.paths[-1])
+        for name in ('blank1.dsk', 'blank2.dsk'):
+            self.paths.append(os.path.join(self.directory, name))
+            with open(self.paths[-1], 'wb') as fileobj:
+                fileobj.write(bytes(143360))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_incremental(self):
+        # Only the new or changed images are read again, the images
+        # removed are pruned
+        for index_class, update in INDEXES:
+            with self.subTest(index=index_class.__name__):
+                with index_class(os.path.join(self.directory, index_class.__name__ + '.sqlite')) as index:
+                    results = list(update(index, self.paths, workers=1))
+                    self.assertTrue(all(result['indexed'] for result in results))
+                    mtime = os.stat(self.paths[0]).st_mtime_ns
+                    os.utime(self.paths[0], ns=(mtime, mtime + 1000000000))
+                    results = {result['path']: result['indexed'] for result in update(index, self.paths, workers=1)}
+                    self.assertEqual([path for path in self.paths if results[path]], [self.paths[0]])
+
+                    self.assertEqual(len(index.stamps()), len(self.paths))
+                    os.rename(self.paths[1], self.paths[1] + '.old')
+                    self.assertEqual(index.prune(), 1)
+                    self.assertNotIn(self.paths[1], index.stamps())
+                    os.rename(self.paths[1] + '.old', self.paths[1])
+                    self.assertFalse(index.remove(self.paths[1]))
+
+    def test_similar(self):
+        with SimilarIndex(os.path.join(self.directory, 'similar.sqlite')) as index:
+            list(update_similar(index, self.paths, workers=1))
+            self.assertEqual(index.clusters(), [sorted(self.paths[:2])])
+            self.assertEqual([result['path'] for result in index.query(index.signature_of(self.paths[0]))],
+                             sorted(self.paths[:2]))
+            # The blank disks are similar to nothing
+            self.assertEqual(index.query(index.signature_of(self.paths[3])), [])
+
+    def test_search_candidates(self):
+        with SearchIndex(os.path.join(self.directory, 'search.sqlite')) as index:
+            list(update_search_index(index, self.paths, workers=1))
+            search = Search(['ADIR-CATALOG'], [], False)
+            self.assertEqual(index.candidates(search), sorted(self.paths[:2]))
+            self.assertEqual(index.stale, [])
+
+            # Changed after it was indexed: always a candidate
+            os.utime(self.paths[2], ns=(0, 0))
+            self.assertEqual(index.candidates(search), sorted(self.paths[:3]))
+            self.assertEqual(index.stale, [self.paths[2]])
+
+    def test_dedup(self):
+        with DedupIndex(os.path.join(self.directory, 'dedup.sqlite')) as index:
+            list(update_index(index, self.paths, workers=1))
+            unique = index.unique(self.paths[0])
+            self.assertEqual(unique['unique_files'], [])
+            self.assertEqual(unique['files'], 4)
+            # The copy shares everything, the ProDOS disk nothing
+            self.assertEqual(unique['unique_bytes'], 0)
+            self.assertEqual(len(index.unique(self.paths[2])['unique_files']), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the nibble images (apple.nib) on tracks encoded here
+"""
+import unittest
+
+from apple.disk import DiskfileError
+from apple.nib import NibbleImage, WRITE_TABLE, NIB_TRACK_SIZE, SECTOR_SIZE, SECTORS_PER_TRACK
+from apple.order import PHYSICAL_TO_DOS
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+VOLUME = 254
+
+
+def encode_44(value):
+    return bytes([(value >> 1) | 0xAA, value | 0xAA])
+
+
+def encode_62(data):
+    # 256 bytes -> 343 nibbles (the 2 low bits are swapped in the
+    # auxiliary values, each value is XORed with the previous one)
+    aux = [0] * 86
+    for index, byte in enumerate(data):
+        aux[index % 86] |= (((byte & 1) << 1) | ((byte >> 1) & 1)) << (2 * (index // 86))
+    nibbles = bytearray()
+    previous = 0
+    for value in aux + [byte >> 2 for byte in data]:
+        nibbles.append(WRITE_TABLE[value ^ previous])
+        previous = value
+    nibbles.append(WRITE_TABLE[previous])
+    return bytes(nibbles)
+
+
+def address_field(track, sector, checksum=None):
+    if checksum is None:
+        checksum = VOLUME ^ track ^ sector
+    return b'\xD5\xAA\x96' + encode_44(VOLUME) + encode_44(track) + encode_44(sector) + \
+        encode_44(checksum) + b'\xDE\xAA\xEB'
+
+
+def nibble_track(track, sectors, address=address_field):
+    # One raw track with the sectors (DOS order) given
+    raw = bytearray(b'\xFF' * 48)
+    for sector in range(SECTORS_PER_TRACK):
+        logical = PHYSICAL_TO_DOS[sector] * SECTOR_SIZE
+        raw += address(track, sector) + b'\xFF' * 6
+        raw += b'\xD5\xAA\xAD' + encode_62(sectors[logical:logical + SECTOR_SIZE]) + b'\xDE\xAA\xEB' + b'\xFF' * 14
+    return raw + b'\xFF' * (NIB_TRACK_SIZE - len(raw))
+
+
+def track_data(track):
+    return bytes((track * 7 + index) & 0xFF for index in range(SECTOR_SIZE * SECTORS_PER_TRACK))
+
+
+class TestNibbleImage(unittest.TestCase):
+    def test_decode(self):
+        image = NibbleImage(nibble_track(0, track_data(0)) + nibble_track(1, track_data(1)), diskname='test.nib')
+        self.assertEqual(bytes(image[:len(image)]), track_data(0) + track_data(1))
+        self.assertEqual(image.bad_sectors, {})
+
+    def test_sector_around_the_track(self):
+        # A sector which starts at the end of the track
+        raw = nibble_track(0, track_data(0))
+        raw = raw[1000:] + raw[:1000]
+        self.assertEqual(NibbleImage(raw).track(0), track_data(0))
+
+    def test_bad_checksum(self):
+        raw = nibble_track(0, track_data(0), lambda track, sector: address_field(track, sector, checksum=0))
+        with self.assertRaises(DiskfileError) as raised:
+            NibbleImage(raw, diskname='test.nib').track(0)
+        self.assertIn('test.nib', str(raised.exception))
+        self.assertIn('checksum', str(raised.exception))
+
+    def test_wrong_track(self):
+        raw = nibble_track(0, track_data(0)) + nibble_track(5, track_data(1))
+        image = NibbleImage(raw, diskname='test.nib')
+        self.assertEqual(image.track(0), track_data(0))
+        with self.assertRaises(DiskfileError) as raised:
+            image.track(1)
+        self.assertIn('track 5 in track 1', str(raised.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
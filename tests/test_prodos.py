@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the ProDOS reader (apple.prodos) on synthetic volumes
+"""
+import struct
+import unittest
+
+from apple.order import reorder_image, ORDER_DOS, ORDER_PRODOS
+from apple.probe import open_disk
+from apple.prodos import BlockError, DiskProdos, STORAGE_EXTENDED
+from apple.source import MemoryImage
+from apple.synth import prodos_image, BLOCK_SIZE, ENTRY_LENGTH, VOLUME_DIRECTORY_BLOCK
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+
+def entry_position(index):
+    # Position in the volume of the entry index of the volume directory
+    # (the header is the entry 0)
+    return VOLUME_DIRECTORY_BLOCK * BLOCK_SIZE + 0x04 + (index + 1) * ENTRY_LENGTH
+
+
+def extend_file(image, index):
+    # Make the file index of the volume directory an extended file: its
+    # data fork is described by a mini-entry in a new key block (the
+    # last block of the volume)
+    position = entry_position(index)
+    entry = image[position:position + ENTRY_LENGTH]
+    key_block = len(image) // BLOCK_SIZE - 1
+    mini_entry = bytes([entry[0x00] >> 4]) + entry[0x11:0x15] + entry[0x15:0x18]
+    image[key_block * BLOCK_SIZE:key_block * BLOCK_SIZE + len(mini_entry)] = mini_entry
+    image[position] = (STORAGE_EXTENDED << 4) | (entry[0x00] & 0x0F)
+    image[position + 0x11:position + 0x18] = struct.pack('<HH', key_block, 4) + struct.pack('<I', BLOCK_SIZE)[:3]
+
+
+def open_volume(image):
+    return open_disk(MemoryImage(bytes(image), 'test.po'))
+
+
+class TestProdos(unittest.TestCase):
+    def test_files(self):
+        image = prodos_image(blocks=1024, files=3, file_size=lambda index: (100, 5000, 140000)[index])
+        with open_volume(image) as dsk:
+            entries = list(dsk.iter_files())
+            self.assertEqual([entry.path for entry in entries], ['/SYNTH/FILE0000', '/SYNTH/FILE0001',
+                                                                 '/SYNTH/FILE0002'])
+            self.assertEqual([len(dsk.read_file(entry)) for entry in entries], [100, 5000, 140000])
+
+    def test_extended_file(self):
+        # The data fork of an extended file has its own EOF in the key
+        # block, the one of the entry is the size of the key block
+        image = prodos_image(files=1, file_size=1000)
+        with open_volume(image) as dsk:
+            content = dsk.read_file(next(dsk.iter_files()))
+        self.assertEqual(len(content), 1000)
+
+        extend_file(image, 0)
+        with open_volume(image) as dsk:
+            entry = next(dsk.iter_files())
+            self.assertEqual(entry.storage_type, STORAGE_EXTENDED)
+            self.assertEqual(dsk.data_fork(entry)[2], 1000)
+            self.assertEqual(dsk.read_file(entry), content)
+
+    def test_directory_loop(self):
+        # A subdirectory pointing at the volume directory
+        image = prodos_image(files=1, depth=1)
+        with open_volume(image) as dsk:
+            self.assertEqual([entry.path for entry in dsk.iter_files()],
+                             ['/SYNTH/FILE0000', '/SYNTH/DIR00', '/SYNTH/DIR00/FILE0000'])
+        position = entry_position(1)
+        image[position + 0x11:position + 0x13] = struct.pack('<H', VOLUME_DIRECTORY_BLOCK)
+        with open_volume(image) as dsk:
+            with self.assertRaises(BlockError):
+                list(dsk.iter_files())
+
+    def test_order_from_extension(self):
+        # Without an order, a .po is read in ProDOS order and a .dsk in
+        # DOS order
+        image = prodos_image(files=1)
+        for name, order, data in (('test.po', ORDER_PRODOS, image),
+                                  ('test.dsk', ORDER_DOS, reorder_image(bytes(image), ORDER_PRODOS, ORDER_DOS))):
+            with self.subTest(name=name):
+                with DiskProdos(MemoryImage(bytes(data), name)) as dsk:
+                    self.assertEqual(dsk.order, order)
+                    self.assertEqual([entry.path for entry in dsk.iter_files()], ['/SYNTH/FILE0000'])
+
+
+if __name__ == '__main__':
+    unittest.main()
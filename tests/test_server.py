@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the requests of the image server (apple.server), answered
+without a connection (dispatch) and through the event loop
+"""
+import asyncio
+import json
+import os
+import unittest
+from urllib.parse import quote
+
+from apple.server import DiskPool, ImageServer, dispatch
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOS_IMAGE = os.path.join(ROOT, 'adir_catalog.dsk')
+PRODOS_IMAGE = os.path.join(ROOT, 'ProDOS_2_0_3.dsk')
+
+
+class TestRequests(unittest.TestCase):
+    def setUp(self):
+        self.pool = DiskPool()
+
+    def tearDown(self):
+        self.pool.close()
+
+    def get(self, request, path=DOS_IMAGE):
+        return dispatch(self.pool, 'GET', '{}&path={}'.format(request, quote(path)))
+
+    def test_sector(self):
+        status, content_type, body = self.get('/ts?track=17&sector=0&format=raw')
+        self.assertEqual(status, 200)
+        with open(DOS_IMAGE, 'rb') as fileobj:
+            fileobj.seek(17 * 16 * 256)
+            self.assertEqual(body, fileobj.read(256))
+
+    def test_whole_track(self):
+        # No sector: the 16 sectors of the track
+        status, content_type, body = self.get('/ts?track=17&format=raw')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body), 16 * 256)
+
+    def test_negative_numbers(self):
+        # Never read from the end of the image
+        for request in ('/ts?track=-1&sector=0', '/ts?track=17&sector=-1', '/ts?track=$11&sector=0&size=-1'):
+            with self.subTest(request=request):
+                self.assertEqual(self.get(request)[0], 400)
+        self.assertEqual(self.get('/block?block=-1', PRODOS_IMAGE)[0], 400)
+
+    def test_out_of_disk(self):
+        self.assertEqual(self.get('/ts?track=35&sector=0')[0], 404)
+        self.assertEqual(self.get('/ts?track=0&sector=16')[0], 404)
+        self.assertEqual(self.get('/block?block=280', PRODOS_IMAGE)[0], 404)
+
+    def test_catalog_and_file(self):
+        status, content_type, body = self.get('/catalog?')
+        self.assertEqual(status, 200)
+        self.assertEqual([values['name'] for values in body['files']][:2], ['HELLO', 'ADIR-CATALOG'])
+        status, content_type, body = self.get('/file?name=HELLO')
+        self.assertEqual(status, 200)
+        self.assertTrue(body)
+        self.assertEqual(self.get('/file?name=NOTHERE')[0], 404)
+
+    def test_missing_parameter(self):
+        self.assertEqual(dispatch(self.pool, 'GET', '/ts?track=1')[0], 400)
+
+
+class TestServer(unittest.TestCase):
+    def test_connection(self):
+        # Requests answered by the threads of the server, while the
+        # pool closes the disks evicted (a pool of 1 byte)
+        async def run():
+            server = ImageServer(DiskPool(1), workers=4)
+            listener = await asyncio.start_server(server.handle_connection, '127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+
+            async def request(target):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write('GET {} HTTP/1.1\r\nHost: test\r\nConnection: close\r\n\r\n'.format(target).encode())
+                await writer.drain()
+                response = await reader.read()
+                writer.close()
+                return response
+
+            targets = ['/catalog?path=' + quote(path) for path in (DOS_IMAGE, PRODOS_IMAGE)] * 10
+            responses = await asyncio.gather(*[request(target) for target in targets])
+            listener.close()
+            await listener.wait_closed()
+            server._executor.shutdown()
+            server.pool.close()
+            return responses
+
+        for response in asyncio.run(run()):
+            header, body = response.split(b'\r\n\r\n', 1)
+            self.assertTrue(header.startswith(b'HTTP/1.1 200'))
+            self.assertIn(json.loads(body)['format'], ('dos33', 'prodos'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the sources of the images (apple.source, apple.twoimg) and of
+the probe of their system and order (apple.probe)
+"""
+import gzip
+import os
+import tempfile
+import unittest
+import zipfile
+
+from apple.disk import SYSTEM_DOS33, SYSTEM_PRODOS
+from apple.order import reorder_image, ORDER_DOS, ORDER_PRODOS
+from apple.probe import probe, open_disk
+from apple.source import close_archives, image_extension, image_name, split_member, MemoryImage
+from apple.synth import dos_image, prodos_image
+from apple.twoimg import parse_2img_header, TWOIMG_HEADER, TWOIMG_MAGIC, TWOIMG_FORMAT_DOS, TWOIMG_FORMAT_PRODOS
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.1'
+
+
+def twoimg(data, image_format, flags=0):
+    # A 2IMG file: the header then the image
+    return TWOIMG_HEADER.pack(TWOIMG_MAGIC, b'TEST', 64, 1, image_format, flags, len(data) // 512, 64,
+                              len(data)).ljust(64, b'\x00') + data
+
+
+class TestNames(unittest.TestCase):
+    def test_names(self):
+        self.assertEqual(split_member('games.zip!disks/game.dsk'), ('games.zip', 'disks/game.dsk'))
+        self.assertEqual(split_member('game.dsk'), ('game.dsk', None))
+        self.assertEqual(image_name('games.zip!disks/game.po.gz'), 'game.po')
+        self.assertEqual(image_extension('GAME.DSK.GZ'), '.dsk')
+        self.assertEqual(image_extension('games.zip!disks/game.2MG'), '.2mg')
+
+
+class TestTwoimgHeader(unittest.TestCase):
+    def test_header(self):
+        data = bytes(143360)
+        header = parse_2img_header(twoimg(data, TWOIMG_FORMAT_PRODOS, flags=0x80000100 | 254), 64 + len(data))
+        self.assertEqual((header['order'], header['locked'], header['volume'], header['blocks'],
+                          header['data_offset'], header['data_length']), (ORDER_PRODOS, True, 254, 280, 64, len(data)))
+        header = parse_2img_header(twoimg(data, TWOIMG_FORMAT_DOS), 64 + len(data))
+        self.assertEqual((header['order'], header['locked'], header['volume']), (ORDER_DOS, False, None))
+
+    def test_bad_header(self):
+        data = bytes(143360)
+        # Not a 2IMG file, an unknown format, an image after the end
+        self.assertIsNone(parse_2img_header(b'2IMX' + twoimg(data, TWOIMG_FORMAT_DOS)[4:], 64 + len(data)))
+        self.assertIsNone(parse_2img_header(twoimg(data, 7), 64 + len(data)))
+        self.assertIsNone(parse_2img_header(twoimg(data, TWOIMG_FORMAT_DOS), len(data)))
+        self.assertIsNone(parse_2img_header(b'2IMG', 4))
+
+
+class TestSources(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dos = bytes(dos_image(files=5))
+        self.prodos = bytes(prodos_image(files=3))
+
+    def tearDown(self):
+        close_archives()
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def write(self, name, data):
+        with open(self.path(name), 'wb') as image:
+            image.write(data)
+        return self.path(name)
+
+    def test_probe(self):
+        # The system and the order, whatever the extension and the source
+        with gzip.open(self.path('dos.po.gz'), 'wb') as image:
+            image.write(reorder_image(self.dos, ORDER_DOS, ORDER_PRODOS))
+        with zipfile.ZipFile(self.path('disks.zip'), 'w') as archive:
+            archive.writestr('disks/pro.dsk', reorder_image(self.prodos, ORDER_PRODOS, ORDER_DOS))
+            archive.writestr('pro.po.gz', gzip.compress(self.prodos))
+        sources = (
+            (self.write('dos.dsk', self.dos), SYSTEM_DOS33, ORDER_DOS),
+            (self.path('dos.po.gz'), SYSTEM_DOS33, ORDER_PRODOS),
+            (self.write('pro.po', self.prodos), SYSTEM_PRODOS, ORDER_PRODOS),
+            (self.path('disks.zip') + '!disks/pro.dsk', SYSTEM_PRODOS, ORDER_DOS),
+            (self.path('disks.zip') + '!pro.po.gz', SYSTEM_PRODOS, ORDER_PRODOS),
+            (self.write('pro.2mg', twoimg(self.prodos, TWOIMG_FORMAT_PRODOS)), SYSTEM_PRODOS, ORDER_PRODOS),
+            (MemoryImage(self.dos, 'memory.dsk'), SYSTEM_DOS33, ORDER_DOS),
+            (self.prodos, SYSTEM_PRODOS, ORDER_PRODOS),
+        )
+        for source, system, order in sources:
+            with self.subTest(source=source if isinstance(source, (str, MemoryImage)) else 'bytes'):
+                result = probe(source)
+                self.assertEqual((result.system, result.order), (system, order))
+                with open_disk(source) as dsk:
+                    self.assertEqual((dsk.system, dsk.order), (system, order))
+                    if system == SYSTEM_DOS33:
+                        self.assertEqual(len(list(dsk.iter_catalog())), 5)
+                    else:
+                        self.assertEqual(len(list(dsk.iter_files())), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
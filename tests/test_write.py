@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the writes: write_ts/flush, the journal and the patches
+
+Each test works on copies of the images of the repository, in a
+temporary directory. Run with: python -m pytest tests (or unittest)
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from apple import journal
+from apple.batch import patch_image, patch_images
+from apple.disk import DiskfileError, STORAGE_ARRAY, STORAGE_MMAP, STORAGE_PAGED
+from apple.journal import journal_path, replay_journal, write_changes
+from apple.probe import open_disk
+
+__author__ = 'Nicolas Djurovic'
+__version__ = '0.2'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOS_IMAGE = os.path.join(ROOT, 'adir_catalog.dsk')
+
+# A sector not used by the catalog (T$14 S$05)
+TRACK, SECTOR = 0x14, 0x05
+SECTOR_SIZE = 256
+
+
+def read_file(path):
+    with open(path, 'rb') as fileobj:
+        return fileobj.read()
+
+
+class WriteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='adir-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copy_image(self, name='disk.dsk'):
+        path = os.path.join(self.directory, name)
+        shutil.copyfile(DOS_IMAGE, path)
+        return path
+
+
+class TestFlush(WriteTestCase):
+    def test_round_trip(self):
+        # Written, flushed, then read again by another Disk
+        data = bytes(range(SECTOR_SIZE))
+        for storage in (STORAGE_ARRAY, STORAGE_MMAP, STORAGE_PAGED):
+            with self.subTest(storage=storage):
+                path = self.copy_image()
+                before = read_file(path)
+                with open_disk(path, storage) as dsk:
+                    dsk.write_ts(TRACK, SECTOR, data)
+                    self.assertEqual(dsk.dirty_sectors, 1)
+                    # Read back before the flush, the file is not changed yet
+                    self.assertEqual(bytes(dsk.read_ts(TRACK, SECTOR)), data)
+                    self.assertEqual(read_file(path), before)
+                    self.assertEqual(dsk.flush(), 1)
+                    self.assertEqual(dsk.dirty_sectors, 0)
+                self.assertFalse(os.path.exists(journal_path(path)))
+
+                with open_disk(path, storage) as dsk:
+                    self.assertEqual(bytes(dsk.read_ts(TRACK, SECTOR)), data)
+                # Only that sector changed in the file
+                after = read_file(path)
+                self.assertEqual(len(after), len(before))
+                changed = [position for position in range(0, len(after), SECTOR_SIZE)
+                           if after[position:position + SECTOR_SIZE] != before[position:position + SECTOR_SIZE]]
+                self.assertEqual(len(changed), 1)
+
+    def test_same_bytes_not_dirty(self):
+        path = self.copy_image()
+        with open_disk(path, STORAGE_MMAP) as dsk:
+            dsk.write_ts(TRACK, SECTOR, bytes(dsk.read_ts(TRACK, SECTOR)))
+            self.assertEqual(dsk.dirty_sectors, 0)
+            self.assertEqual(dsk.flush(), 0)
+
+    def test_discard(self):
+        path = self.copy_image()
+        before = read_file(path)
+        with open_disk(path, STORAGE_MMAP) as dsk:
+            dsk.write_ts(TRACK, SECTOR, b'\xFF' * SECTOR_SIZE)
+            dsk.discard()
+            self.assertEqual(dsk.flush(), 0)
+            self.assertNotEqual(bytes(dsk.read_ts(TRACK, SECTOR)), b'\xFF' * SECTOR_SIZE)
+        self.assertEqual(read_file(path), before)
+
+
+class TestJournal(WriteTestCase):
+    def test_replay_after_crash(self):
+        # The process stops after the journal is written, before the
+        # image is: the next open applies the journal
+        path = self.copy_image()
+        before = read_file(path)
+        data = b'\xA5' * SECTOR_SIZE
+        with open_disk(path, STORAGE_MMAP) as dsk:
+            dsk.write_ts(TRACK, SECTOR, data)
+            with mock.patch.object(journal, '_apply', side_effect=OSError('crash')):
+                with self.assertRaises(DiskfileError):
+                    dsk.flush()
+        self.assertTrue(os.path.exists(journal_path(path)))
+        self.assertEqual(read_file(path), before)
+
+        with open_disk(path, STORAGE_MMAP) as dsk:
+            self.assertEqual(bytes(dsk.read_ts(TRACK, SECTOR)), data)
+        self.assertFalse(os.path.exists(journal_path(path)))
+        self.assertNotEqual(read_file(path), before)
+
+    def test_incomplete_journal_ignored(self):
+        # Stopped while writing the journal: the image is not changed
+        path = self.copy_image()
+        before = read_file(path)
+        with mock.patch.object(journal, '_apply', side_effect=OSError('crash')):
+            with self.assertRaises(OSError):
+                write_changes(path, [(0, b'\x00' * SECTOR_SIZE)])
+        content = read_file(journal_path(path))
+        with open(journal_path(path), 'wb') as fileobj:
+            fileobj.write(content[:-1])
+
+        self.assertFalse(replay_journal(path))
+        self.assertFalse(os.path.exists(journal_path(path)))
+        self.assertEqual(read_file(path), before)
+
+    @unittest.skipIf(journal.fcntl is None, 'the images are not locked here')
+    def test_replay_waits_for_writer(self):
+        # Another process opens the image while the journal is written:
+        # it waits for the end of the write, the journal is not removed
+        # under the writer
+        path = self.copy_image()
+        data = b'\x5A' * SECTOR_SIZE
+        written, resume = threading.Event(), threading.Event()
+        apply = journal._apply
+
+        def slow_apply(diskfile, runs):
+            written.set()
+            resume.wait(5)
+            apply(diskfile, runs)
+
+        errors, replayed = [], []
+
+        def writer():
+            try:
+                with open_disk(path, STORAGE_MMAP) as dsk:
+                    dsk.write_ts(TRACK, SECTOR, data)
+                    dsk.flush()
+            except Exception as error:
+                errors.append(error)
+
+        with mock.patch.object(journal, '_apply', slow_apply):
+            writing = threading.Thread(target=writer)
+            writing.start()
+            self.assertTrue(written.wait(5))
+            replaying = threading.Thread(target=lambda: replayed.append(replay_journal(path)))
+            replaying.start()
+            replaying.join(0.2)
+            # Still waiting for the lock, the journal is still there
+            self.assertTrue(replaying.is_alive())
+            self.assertTrue(os.path.exists(journal_path(path)))
+            resume.set()
+            writing.join(5)
+            replaying.join(5)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(replayed, [False])
+        self.assertFalse(os.path.exists(journal_path(path)))
+        with open_disk(path, STORAGE_MMAP) as dsk:
+            self.assertEqual(bytes(dsk.read_ts(TRACK, SECTOR)), data)
+
+    def test_coalesce(self):
+        runs = journal.coalesce([(512, b'c'), (0, b'a'), (1, b'b'), (10, b'd')])
+        self.assertEqual([(position, bytes(data)) for position, data in runs], [(0, b'ab'), (10, b'd'), (512, b'c')])
+
+
+class TestPatch(WriteTestCase):
+    def changes(self, expect=None):
+        first = {'track': TRACK, 'sector': SECTOR, 'offset': 0, 'data': 'DEADBEEF'}
+        second = {'track': TRACK, 'sector': SECTOR + 1, 'offset': 16, 'data': 'CAFE'}
+        if expect is not None:
+            second['expect'] = expect
+        return [first, second]
+
+    def test_patch(self):
+        path = self.copy_image()
+        result = patch_image(path, self.changes())
+        self.assertNotIn('error', result)
+        self.assertEqual(result['sectors'], 2)
+        with open_disk(path, STORAGE_MMAP) as dsk:
+            self.assertEqual(bytes(dsk.read_ts(TRACK, SECTOR))[:4], b'\xDE\xAD\xBE\xEF')
+            self.assertEqual(bytes(dsk.read_ts(TRACK, SECTOR + 1))[16:18], b'\xCA\xFE')
+
+    def test_dry_run(self):
+        # The sectors are counted, the file is the same byte for byte
+        path = self.copy_image()
+        before = read_file(path)
+        result = patch_image(path, self.changes(), dry_run=True)
+        self.assertNotIn('error', result)
+        self.assertEqual(result['sectors'], 2)
+        self.assertEqual(read_file(path), before)
+        self.assertFalse(os.path.exists(journal_path(path)))
+
+    def test_all_or_nothing(self):
+        # The second change doesn't find its bytes: the first one is
+        # not written either
+        path = self.copy_image()
+        before = read_file(path)
+        with open_disk(path, STORAGE_MMAP) as dsk:
+            current = bytes(dsk.read_ts(TRACK, SECTOR + 1))[16:18]
+        wrong = bytes(byte ^ 0xFF for byte in current).hex()
+        result = patch_image(path, self.changes(expect=wrong))
+        self.assertIn('skipped', result)
+        self.assertEqual(result['sectors'], 0)
+        self.assertEqual(read_file(path), before)
+
+    def test_one_image_fails(self):
+        # Among several images, the one not matching is left as it is,
+        # the others are patched
+        paths = [self.copy_image('disk{}.dsk'.format(index)) for index in range(3)]
+        with open_disk(paths[0], STORAGE_MMAP) as dsk:
+            current = bytes(dsk.read_ts(TRACK, SECTOR + 1))[16:18]
+        # The bytes expected are only on the images not changed below
+        with open_disk(paths[1], STORAGE_MMAP) as dsk:
+            dsk.write_ts(TRACK, SECTOR + 1, bytes(16) + bytes(byte ^ 0xFF for byte in current) + bytes(238))
+            dsk.flush()
+        before = read_file(paths[1])
+
+        results = {result['path']: result for result in
+                   patch_images(paths, self.changes(expect=current.hex()), workers=1)}
+        self.assertEqual(results[paths[0]]['sectors'], 2)
+        self.assertEqual(results[paths[2]]['sectors'], 2)
+        self.assertIn('skipped', results[paths[1]])
+        self.assertEqual(read_file(paths[1]), before)
+
+    def test_error_leaves_image(self):
+        # A change out of its sector fails the whole image
+        path = self.copy_image()
+        before = read_file(path)
+        changes = self.changes() + [{'track': TRACK, 'sector': SECTOR, 'offset': 255, 'data': 'AABB'}]
+        result = patch_image(path, changes)
+        self.assertIn('error', result)
+        self.assertEqual(read_file(path), before)
+
+
+if __name__ == '__main__':
+    unittest.main()